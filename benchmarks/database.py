@@ -0,0 +1,110 @@
+"""
+Benchmark the user lookups of the database.
+
+Compares opening a connection per lookup against the shared connection of Database,
+with and without the user cache.
+Run with: python -m benchmarks.database [--rows N] [--lookups N] [--active N]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite
+
+from src.client.database import Database
+
+
+async def populate(path: str, rows: int) -> None:
+    """
+    Fill the database with users.
+
+    :param path: The path of the database.
+    :type path: str
+    :param rows: The number of users to insert.
+    :type rows: int
+    """
+    database = Database(path)
+    await database.initialize()
+    db = await database._connection()
+    await db.executemany(
+        "INSERT OR IGNORE INTO users (id, opt_out) VALUES (?, ?)",
+        ((i, i % 2) for i in range(rows)),
+    )
+    await db.commit()
+    await database.close()
+
+
+async def connect_per_call(path: str, ids: list) -> float:
+    """
+    Look up the users by opening a connection for each lookup.
+
+    :param path: The path of the database.
+    :type path: str
+    :param ids: The user ids to look up.
+    :type ids: list
+
+    :return: The lookups per second.
+    :rtype: float
+    """
+    start = time.perf_counter()
+    for user_id in ids:
+        async with aiosqlite.connect(path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(Database.SELECT_USER, (user_id,)) as cursor:
+                await cursor.fetchone()
+    return len(ids) / (time.perf_counter() - start)
+
+
+async def shared_connection(path: str, ids: list, cache_size: int = 0) -> float:
+    """
+    Look up the users through the shared connection of Database.
+
+    :param path: The path of the database.
+    :type path: str
+    :param ids: The user ids to look up.
+    :type ids: list
+    :param cache_size: The size of the user cache, 0 to disable it.
+    :type cache_size: int
+
+    :return: The lookups per second.
+    :rtype: float
+    """
+    database = Database(path, cache_size=cache_size)
+    await database.initialize()
+    start = time.perf_counter()
+    for user_id in ids:
+        await database.get_user(user_id)
+    elapsed = time.perf_counter() - start
+    await database.close()
+    return len(ids) / elapsed
+
+
+async def main(rows: int, lookups: int, active: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "database.db")
+        await populate(path, rows)
+        # a few active authors send most messages, half of them have a row
+        authors = random.sample(range(rows * 2), active)
+        ids = [random.choice(authors) for _ in range(lookups)]
+        before = await connect_per_call(path, ids)
+        after = await shared_connection(path, ids)
+        cached = await shared_connection(path, ids, cache_size=len(ids))
+    print(f"connect per call : {before:>10.0f} lookups/s")
+    print(f"shared connection: {after:>10.0f} lookups/s ({after / before:.1f}x)")
+    print(f"cached lookups   : {cached:>10.0f} lookups/s ({cached / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument("--active", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.lookups, args.active))
@@ -0,0 +1,101 @@
+"""
+Benchmark the token search on large text files.
+
+Compares decoding the buffer to str before matching against matching the raw bytes,
+reporting the throughput and the peak memory allocated by each path.
+Run with: python -m benchmarks.decoder_search [--size MiB] [--rounds N]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils.token_detection import TokenDetector
+
+TOKEN = b"\nMTA3MjYyNTE0OTM3MjgxMzM1NA.ABCDEF.abcdefghijklmnopqrstuvwxyz123456"
+
+
+def generate(size: int) -> bytes:
+    """
+    Generate a log-like text file with a token at the very end.
+
+    :param size: The size of the file in bytes.
+    :type size: int
+
+    :return: The content of the file.
+    :rtype: bytes
+    """
+    words = [
+        "".join(random.choices(string.ascii_letters, k=random.randint(2, 12))) for _ in range(512)
+    ]
+    lines = [" ".join(random.choices(words, k=12)).encode() + b" v1.2.3\n" for _ in range(1024)]
+    block = b"".join(lines)
+    return (block * (size // len(block) + 1))[: size - len(TOKEN)] + TOKEN
+
+
+async def decode_path(data: bytes) -> bool:
+    """
+    The previous implementation, decode then match the str regex.
+
+    :param data: The data to search.
+    :type data: bytes
+
+    :return: Whether the token is detected.
+    :rtype: bool
+    """
+    try:
+        content = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return await TokenDetector.detect(content)
+
+
+async def measure(func, data: bytes, rounds: int) -> tuple:
+    """
+    Measure the throughput and the peak memory of a search function.
+
+    :param func: The search function.
+    :type func: Callable[[bytes], Awaitable[bool]]
+    :param data: The data to search.
+    :type data: bytes
+    :param rounds: The number of rounds to run.
+    :type rounds: int
+
+    :return: The throughput in MiB/s and the peak memory in MiB.
+    :rtype: tuple
+    """
+    assert await func(data)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await func(data)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    await func(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return len(data) * rounds / elapsed / 1024**2, peak / 1024**2
+
+
+async def main(size: int, rounds: int) -> None:
+    data = generate(size * 1024**2)
+    for name, func in (
+        ("decode + str regex", decode_path),
+        ("bytes regex", TokenDetector.decoder_search),
+    ):
+        throughput, peak = await measure(func, data, rounds)
+        print(f"{name:<18}: {throughput:>8.1f} MiB/s, peak {peak:>7.2f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=25, help="size of the file in MiB")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.size, args.rounds))
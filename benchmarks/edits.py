@@ -0,0 +1,100 @@
+"""
+Benchmark the scan of edited messages, rescanning the whole content against scanning only the
+region changed by the edit.
+
+Builds messages of the synthetic chat corpus up to --length characters, then edits each of them
+the way users do: a word fixed in the middle, a line appended at the end, a word removed.
+Run with: python -m benchmarks.edits [--messages N] [--length N] [--rounds N] [--seed N]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import List, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.detect import TOKEN, WORDS
+from benchmarks.detect import generate as generate_chat
+from src.utils.token_detection import TokenDetector
+
+
+def generate(count: int, length: int) -> List[Tuple[str, str]]:
+    """
+    Generate messages and their edited content.
+
+    :param count: The number of messages.
+    :type count: int
+    :param length: The length of the messages in characters.
+    :type length: int
+
+    :return: The previous and the edited content of each message.
+    :rtype: List[Tuple[str, str]]
+    """
+    # the previous content was scanned clean, the corpus has a few tokens
+    lines = [i for i in generate_chat(count * max(length // 30, 2)) if TOKEN not in i]
+    edits = []
+    for i in range(count):
+        previous = ""
+        while len(previous) < length:
+            previous += lines.pop() + "\n"
+        previous = previous[:length]
+        kind = i % 3
+        if kind == 0:
+            position = previous.find(" ", len(previous) // 2)
+            content = previous[:position] + " " + random.choice(WORDS) + previous[position:]
+        elif kind == 1:
+            content = previous + "\n" + " ".join(random.choices(WORDS, k=8))
+        else:
+            position = previous.find(" ", len(previous) // 3)
+            content = previous[:position] + previous[previous.find(" ", position + 1) :]
+        edits.append((previous, content))
+    return edits
+
+
+async def measure(func, edits: List[Tuple[str, str]], rounds: int) -> float:
+    """
+    Measure the throughput of an edit scan.
+
+    :param func: The scan, called with the previous and the edited content.
+    :type func: Callable[[str, str], Awaitable[bool]]
+    :param edits: The edits.
+    :type edits: List[Tuple[str, str]]
+    :param rounds: The number of rounds to run.
+    :type rounds: int
+
+    :return: The edits per second.
+    :rtype: float
+    """
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for previous, content in edits:
+            if await func(previous, content):
+                raise AssertionError(f"a token was detected in {content!r}")
+    return len(edits) * rounds / (time.perf_counter() - start)
+
+
+async def main(args: argparse.Namespace) -> None:
+    edits = generate(args.messages, args.length)
+    before = await measure(lambda _, content: TokenDetector.detect(content), edits, args.rounds)
+    after = await measure(TokenDetector.detect_edit, edits, args.rounds)
+    scanned = sum(
+        end - start for start, end in (TokenDetector.changed_region(*i) for i in edits)
+    ) / sum(len(i[1]) for i in edits)
+    print(f"full rescan : {before:>10.0f} edits/s/core")
+    print(f"incremental : {after:>10.0f} edits/s/core ({after / before:.1f}x)")
+    print(f"  content scanned: {scanned:.1%} of {args.length} characters on average")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--length", type=int, default=2000, help="characters per message")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(main(args))
@@ -0,0 +1,295 @@
+"""
+Report the resident memory the gateway cache of the bot takes per 1000 guilds, with and without
+the lean mode of the [gateway] section.
+
+Launches fresh interpreters that feed synthetic GUILD_CREATE and MESSAGE_CREATE payloads to the
+connection state of a client built with the options of each mode, without connecting to
+discord. The payloads follow the intents of the mode as discord would: voice states and the
+members in voice channels are only sent with the voice states intent.
+Run with: python -m benchmarks.gateway_memory [--guilds N] [--messages N]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = """
+import asyncio, gc, json, sys
+import discord, psutil
+from benchmarks.gateway_memory import guild_payload, message_payload, BOT_ID
+from src.main import Bot
+
+def rss():
+    gc.collect()
+    return psutil.Process().memory_info().rss
+
+async def main():
+    options = Bot.gateway_options({{"lean": {lean}}})
+    client = discord.Client(**options)
+    state = client._connection
+    state.user = discord.ClientUser(
+        state=state, data={{"id": BOT_ID, "username": "bot", "discriminator": "0000", "avatar": None}}
+    )
+    before = rss()
+    for i in range({guilds}):
+        state._add_guild_from_data(guild_payload(i, options["intents"]))
+    loaded = rss()
+    for i in range({messages}):
+        state.parse_message_create(message_payload(i, {guilds}))
+    await asyncio.sleep(0)
+    print(json.dumps({{
+        "guilds": loaded - before,
+        "messages": rss() - loaded,
+        "members": sum(len(i.members) for i in client.guilds),
+        "cached_messages": len(client.cached_messages),
+    }}))
+
+asyncio.run(main())
+"""
+BOT_ID = 1
+ROLES = 20
+TEXT_CHANNELS = 30
+VOICE_CHANNELS = 5
+VOICE_MEMBERS = 4
+EMOJIS = 10
+
+
+def user_payload(user_id: int) -> dict:
+    """
+    Build the payload of a user.
+
+    :param user_id: The id of the user.
+    :type user_id: int
+
+    :return: The user.
+    :rtype: dict
+    """
+    return {
+        "id": str(user_id),
+        "username": f"user{user_id}",
+        "discriminator": "0001",
+        "avatar": "a" * 32,
+        "global_name": f"User {user_id}",
+    }
+
+
+def member_payload(user_id: int, guild_id: int) -> dict:
+    """
+    Build the payload of a guild member.
+
+    :param user_id: The id of the user.
+    :type user_id: int
+    :param guild_id: The id of the guild.
+    :type guild_id: int
+
+    :return: The member.
+    :rtype: dict
+    """
+    return {
+        "user": user_payload(user_id),
+        "roles": [str(guild_id * 1000 + 1 + user_id % ROLES)],
+        "joined_at": "2023-01-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "nick": None,
+    }
+
+
+def guild_payload(index: int, intents) -> dict:
+    """
+    Build the GUILD_CREATE payload of a medium sized guild, as sent with the given intents.
+
+    :param index: The index of the guild.
+    :type index: int
+    :param intents: The intents of the connection.
+    :type intents: discord.Intents
+
+    :return: The guild.
+    :rtype: dict
+    """
+    guild_id = 10**6 + index
+    base = guild_id * 1000
+    overwrites = [
+        {"id": str(base + i), "type": 0, "allow": "1024", "deny": "2048"} for i in range(3)
+    ]
+    channels = [
+        {
+            "id": str(base + 100 + i),
+            "type": 0,
+            "name": f"text-{i}",
+            "position": i,
+            "topic": "a channel topic " * 4,
+            "nsfw": False,
+            "permission_overwrites": overwrites,
+            "rate_limit_per_user": 0,
+        }
+        for i in range(TEXT_CHANNELS)
+    ] + [
+        {
+            "id": str(base + 200 + i),
+            "type": 2,
+            "name": f"voice-{i}",
+            "position": TEXT_CHANNELS + i,
+            "bitrate": 64000,
+            "user_limit": 0,
+            "permission_overwrites": overwrites,
+        }
+        for i in range(VOICE_CHANNELS)
+    ]
+    members = [member_payload(BOT_ID, guild_id)]
+    voice_states = []
+    if intents.voice_states:
+        for i in range(VOICE_MEMBERS):
+            member = member_payload(base + 500 + i, guild_id)
+            members.append(member)
+            voice_states.append(
+                {
+                    "user_id": member["user"]["id"],
+                    "channel_id": str(base + 200 + i % VOICE_CHANNELS),
+                    "session_id": "s" * 32,
+                    "deaf": False,
+                    "mute": False,
+                    "self_deaf": False,
+                    "self_mute": False,
+                    "self_video": False,
+                    "suppress": False,
+                }
+            )
+    return {
+        "id": str(guild_id),
+        "name": f"guild {index}",
+        "owner_id": str(base + 999),
+        "member_count": 500,
+        "preferred_locale": "en-US",
+        "afk_timeout": 300,
+        "verification_level": 1,
+        "default_message_notifications": 1,
+        "features": ["COMMUNITY", "NEWS"],
+        "roles": [
+            {
+                "id": str(base if i == 0 else base + i),
+                "name": "@everyone" if i == 0 else f"role-{i}",
+                "permissions": "104324673",
+                "position": i,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False,
+            }
+            for i in range(ROLES + 1)
+        ],
+        "emojis": [
+            {
+                "id": str(base + 300 + i),
+                "name": f"emoji{i}",
+                "roles": [],
+                "require_colons": True,
+                "managed": False,
+                "animated": False,
+                "available": True,
+            }
+            for i in range(EMOJIS)
+        ],
+        "stickers": [],
+        "channels": channels,
+        "threads": [],
+        "members": members,
+        "voice_states": voice_states,
+        "stage_instances": [],
+        "guild_scheduled_events": [],
+    }
+
+
+def message_payload(index: int, guilds: int) -> dict:
+    """
+    Build the MESSAGE_CREATE payload of a chat message in one of the guilds.
+
+    :param index: The index of the message.
+    :type index: int
+    :param guilds: The number of guilds.
+    :type guilds: int
+
+    :return: The message.
+    :rtype: dict
+    """
+    guild_id = 10**6 + index % guilds
+    base = guild_id * 1000
+    author = base + 600 + index % 50
+    return {
+        "id": str(10**12 + index),
+        "channel_id": str(base + 100 + index % TEXT_CHANNELS),
+        "guild_id": str(guild_id),
+        "author": user_payload(author),
+        "member": {k: v for k, v in member_payload(author, guild_id).items() if k != "user"},
+        "content": f"message {index} " + "some chat about the day " * 4,
+        "timestamp": "2023-01-01T00:00:00+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+
+
+def launch(lean: bool, guilds: int, messages: int) -> dict:
+    """
+    Launch an interpreter that fills the gateway cache.
+
+    :param lean: Whether to use the lean mode.
+    :type lean: bool
+    :param guilds: The number of guilds.
+    :type guilds: int
+    :param messages: The number of messages received.
+    :type messages: int
+
+    :return: The memory taken by the guilds and the messages, the cached members and messages.
+    :rtype: dict
+    """
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            SCRIPT.format(lean=lean, guilds=guilds, messages=messages),
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(guilds: int, messages: int) -> None:
+    results = {}
+    for lean in (False, True):
+        name = "lean" if lean else "default"
+        result = results[name] = launch(lean, guilds, messages)
+        print(
+            f"{name:<8}: {result['guilds'] / guilds * 1000 / 1024 ** 2:>7.2f} MiB per 1k guilds, "
+            f"{result['messages'] / 1024 ** 2:>6.2f} MiB for {messages} messages, "
+            f"{result['members']} members and {result['cached_messages']} messages cached"
+        )
+    default, lean = results["default"], results["lean"]
+    # the message cache is bounded per process, it does not grow with the guilds
+    print(
+        f"lean mode saves {(default['guilds'] - lean['guilds']) / guilds * 1000 / 1024 ** 2:.2f} "
+        f"MiB per 1k guilds ({(1 - lean['guilds'] / default['guilds']) * 100:.0f}%) and "
+        f"{(default['messages'] - lean['messages']) / 1024 ** 2:.2f} MiB of message cache per shard process"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+    main(args.guilds, args.messages)
@@ -0,0 +1,155 @@
+"""
+Benchmark the permission checks of the protection on guilds with many roles and overwrites.
+
+Builds guilds with real channels, roles and bot member from GUILD_CREATE payloads, then
+compares resolving the permissions of the bot on every check, as on_message and delete_message
+did, against the permission cache, for channels where the bot can act and for channels where it
+cannot send messages and the message is skipped.
+Run with: python -m benchmarks.permissions [--roles N] [--overwrites N] [--checks N]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+
+from benchmarks.gateway_memory import BOT_ID, member_payload
+from src.utils.permissions import PermissionCache
+
+GUILDS = 10
+CHANNELS = 50
+SEND_MESSAGES = 1 << 11
+
+
+def guild_payload(index: int, roles: int, overwrites: int, denied: bool) -> dict:
+    """
+    Build the GUILD_CREATE payload of a guild, the bot has every role but administrator.
+
+    :param index: The index of the guild.
+    :type index: int
+    :param roles: The number of roles.
+    :type roles: int
+    :param overwrites: The number of role overwrites of each channel.
+    :type overwrites: int
+    :param denied: Whether the overwrites deny the bot to send messages.
+    :type denied: bool
+
+    :return: The guild.
+    :rtype: dict
+    """
+    guild_id = 10**6 + index
+    base = guild_id * 10000
+    member = member_payload(BOT_ID, guild_id)
+    member["roles"] = [str(base + i) for i in range(1, roles + 1)]
+    return {
+        "id": str(guild_id),
+        "name": f"guild {index}",
+        "owner_id": str(base + 9999),
+        "member_count": 1000,
+        "roles": [
+            {
+                "id": str(guild_id if i == 0 else base + i),
+                "name": "@everyone" if i == 0 else f"role-{i}",
+                "permissions": str(104324673 & ~(1 << 3)),
+                "position": i,
+            }
+            for i in range(roles + 1)
+        ],
+        "channels": [
+            {
+                "id": str(base + 5000 + n),
+                "type": 0,
+                "name": f"text-{n}",
+                "position": n,
+                "permission_overwrites": [
+                    {"id": str(guild_id), "type": 0, "allow": "0", "deny": str(SEND_MESSAGES)}
+                ]
+                + [
+                    {
+                        "id": str(base + i),
+                        "type": 0,
+                        "allow": "0" if denied else str(SEND_MESSAGES),
+                        "deny": str(SEND_MESSAGES) if denied else "0",
+                    }
+                    for i in range(1, overwrites + 1)
+                ],
+            }
+            for n in range(CHANNELS)
+        ],
+        "members": [member],
+    }
+
+
+def measure(channels: list, check, checks: int) -> float:
+    """
+    Measure the messages per second the permission checks of a message allow.
+
+    :param channels: The (guild, channel) pairs the messages are sent in, in turn.
+    :type channels: list
+    :param check: The check, called with a guild and a channel.
+    :type check: Callable
+    :param checks: The number of messages.
+    :type checks: int
+
+    :return: The messages per second.
+    :rtype: float
+    """
+    start = time.perf_counter()
+    for i in range(checks):
+        check(*channels[i % len(channels)])
+    return checks / (time.perf_counter() - start)
+
+
+async def main(args: argparse.Namespace) -> None:
+    client = discord.Client(intents=discord.Intents.none())
+    state = client._connection
+    state.user = discord.ClientUser(
+        state=state,
+        data={"id": BOT_ID, "username": "bot", "discriminator": "0000", "avatar": None},
+    )
+    for denied in (False, True):
+        guilds = [
+            state._add_guild_from_data(
+                guild_payload(i + (GUILDS if denied else 0), args.roles, args.overwrites, denied)
+            )
+            for i in range(GUILDS)
+        ]
+        channels = [(guild, channel) for guild in guilds for channel in guild.text_channels]
+        assert all(c.permissions_for(g.me).send_messages is not denied for g, c in channels)
+        cache = PermissionCache()
+
+        def uncached(guild, channel):
+            # the send check of on_message, then reply and delete checks of delete_message
+            channel.permissions_for(guild.me).send_messages
+            if not denied:
+                channel.permissions_for(guild.me).read_message_history
+                channel.permissions_for(guild.me).manage_messages
+
+        def cached(guild, channel):
+            cache.permissions_for(guild, channel).send_messages
+            if not denied:
+                permissions = cache.permissions_for(guild, channel)
+                permissions.read_message_history
+                permissions.manage_messages
+
+        before = measure(channels, uncached, args.checks)
+        after = measure(channels, cached, args.checks)
+        name = "skipped" if denied else "allowed"
+        print(
+            f"{name:<8}: uncached {before:>10.0f} messages/s, cached {after:>10.0f} messages/s, "
+            f"{after / before:>5.1f}x ({args.roles} roles, {args.overwrites} overwrites)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--roles", type=int, default=100)
+    parser.add_argument("--overwrites", type=int, default=50)
+    parser.add_argument("--checks", type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,182 @@
+"""
+Benchmark the removal of a raid, many messages with tokens posted in one channel at once.
+
+The Discord API is mocked with per-route rate limits, a request over the limit waits for the
+bucket to reset as the library does, and every request takes --http-latency. The raid is
+removed once per message, as delete_message did before, and through the action aggregator of
+the protection cog, which bulk deletes the messages and sends one warning per batch.
+Reports the time until the last message is deleted, the latency percentiles from the message to
+its deletion, and the API calls made.
+Run with: python -m benchmarks.raid [--messages N] [--rate N] [--window SECONDS]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+
+from benchmarks.replay import PERMISSIONS, percentiles
+from src.client.config import Config
+from src.cogs.protection import Protection
+
+# the requests allowed per window of seconds of each route in a channel, as reported by discord
+ROUTES = {"send": (5, 5.0), "delete": (5, 1.0), "bulk": (1, 1.0)}
+
+
+class RateLimitedHTTP:
+    """
+    The API calls of a channel, limited per route with fixed window buckets.
+
+    :ivar calls: The number of requests of each route.
+    :vartype calls: Dict[str, int]
+    :ivar limited: The number of requests that waited for a bucket to reset.
+    :vartype limited: int
+    """
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.calls: Dict[str, int] = {i: 0 for i in ROUTES}
+        self.limited = 0
+        self._buckets: Dict[str, Tuple[int, float]] = {}
+        self._locks = {i: asyncio.Lock() for i in ROUTES}
+
+    async def request(self, route: str) -> None:
+        """
+        Make a request, waiting for the bucket of the route if it is exhausted.
+
+        :param route: The route.
+        :type route: str
+        """
+        limit, per = ROUTES[route]
+        async with self._locks[route]:
+            remaining, reset = self._buckets.get(route, (limit, 0.0))
+            now = time.perf_counter()
+            if now >= reset:
+                remaining, reset = limit, now + per
+            if remaining == 0:
+                self.limited += 1
+                await asyncio.sleep(reset - now)
+                remaining, reset = limit, time.perf_counter() + per
+            self._buckets[route] = (remaining - 1, reset)
+        self.calls[route] += 1
+        await asyncio.sleep(self.latency)
+
+
+def make_messages(count: int, http: RateLimitedHTTP, deleted: Dict[int, float]) -> list:
+    """
+    Make the messages of the raid in one channel.
+
+    :param count: The number of messages.
+    :type count: int
+    :param http: The API of the channel.
+    :type http: RateLimitedHTTP
+    :param deleted: The time each message was deleted at, by id.
+    :type deleted: Dict[int, float]
+
+    :return: The messages.
+    :rtype: list
+    """
+
+    async def delete(message_ids: List[int], route: str) -> None:
+        await http.request(route)
+        for i in message_ids:
+            deleted[i] = time.perf_counter()
+
+    channel = SimpleNamespace(
+        id=1,
+        parent=None,
+        permissions_for=lambda member: PERMISSIONS,
+        send=lambda *args: http.request("send"),
+        delete_messages=lambda messages: delete([i.id for i in messages], "bulk"),
+    )
+    guild = SimpleNamespace(id=1, me=SimpleNamespace(id=0), preferred_locale="en-US")
+    author = SimpleNamespace(id=2, bot=False, mention="<@2>")
+    first = discord.utils.time_snowflake(discord.utils.utcnow())
+    messages = []
+    for message_id in range(first, first + count):
+        messages.append(
+            SimpleNamespace(
+                id=message_id,
+                guild=guild,
+                channel=channel,
+                author=author,
+                reply=lambda *args: http.request("send"),
+                delete=lambda message_id=message_id: delete([message_id], "delete"),
+            )
+        )
+    return messages
+
+
+async def run(args: argparse.Namespace, aggregated: bool) -> dict:
+    """
+    Remove a raid.
+
+    :param args: The command line arguments.
+    :type args: argparse.Namespace
+    :param aggregated: Whether to use the action aggregator, or remove each message on its own.
+    :type aggregated: bool
+
+    :return: The report.
+    :rtype: dict
+    """
+    bot = SimpleNamespace(
+        config=Config(), logger=logging.getLogger("raid"), database=None, session=None
+    )
+    cog = Protection(bot)
+    cog.actions.window = args.window
+    http = RateLimitedHTTP(args.http_latency / 1000)
+    deleted: Dict[int, float] = {}
+    messages = make_messages(args.messages, http, deleted)
+    remove = cog.delete_message if aggregated else lambda *i: cog.delete_messages([i])
+    flagged: Dict[int, float] = {}
+    tasks = []
+    start = time.perf_counter()
+    try:
+        for i, message in enumerate(messages):
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            flagged[message.id] = time.perf_counter()
+            tasks.append(asyncio.create_task(remove(message, "en-US")))
+        await asyncio.gather(*tasks)
+    finally:
+        cog.cog_unload()
+    return {
+        "elapsed": max(deleted.values()) - start,
+        "latencies": [deleted[i] - flagged[i] for i in flagged],
+        "calls": http.calls,
+        "limited": http.limited,
+        "batches": cog.actions.batches,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    print(
+        f"raid of {args.messages} messages at {args.rate:.0f} messages/s, "
+        f"{args.http_latency:.0f} ms per API call"
+    )
+    for aggregated in (False, True):
+        report = await run(args, aggregated)
+        name = f"aggregated ({report['batches']} batches)" if aggregated else "per message"
+        calls = ", ".join(f"{k} {v}" for k, v in report["calls"].items())
+        print(f"{name}: cleared in {report['elapsed']:.2f} s")
+        print(f"  deletion latency: {percentiles(report['latencies'])}")
+        print(f"  api calls       : {calls}, {report['limited']} rate limited")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=50, help="flagged messages per second")
+    parser.add_argument("--window", type=float, default=0.5, help="seconds of the batch window")
+    parser.add_argument("--http-latency", type=float, default=50, help="milliseconds per API call")
+    args = parser.parse_args()
+    asyncio.run(main(args))
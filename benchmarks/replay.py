@@ -0,0 +1,362 @@
+"""
+Replay a stream of messages through Protection.on_message without a gateway.
+
+The bot, guilds, channels and attachments are mocked, the Discord API calls sleep for
+--http-latency and --fetch-latency instead. Messages are read from a JSONL file, or generated,
+and dispatched at --rate messages per second as the gateway would, each in its own task.
+Reports the end-to-end messages per second, the latency percentiles of on_message, the
+event-loop lag and the summed latency of the user lookups in the database.
+Run with: python -m benchmarks.replay [--input FILE] [--rate N] [--messages N]
+
+Each line of the input is a message:
+{"guild": 1, "channel": 2, "author": 3, "content": "text", "attachments": [{"filename": "a.txt",
+"content_type": "text/plain", "path": "tests/assets/plain/safe.txt"}]}
+an attachment has either a "path" to read or the inline "text" of the file.
+Write a synthetic stream to start from with --generate FILE.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+
+from benchmarks.detect import generate as generate_chat
+from src.client.config import Config
+from src.client.database import Database
+from src.cogs.protection import Protection
+
+ASSETS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "assets"
+)
+PERMISSIONS = SimpleNamespace(
+    send_messages=True,
+    send_messages_in_threads=True,
+    read_message_history=True,
+    manage_messages=True,
+)
+MESSAGE_IDS = itertools.count(discord.utils.time_snowflake(discord.utils.utcnow()))
+
+
+class TimedDatabase(Database):
+    """
+    The database of the bot, recording the latency of the user lookups.
+    The lookups run concurrently, so their summed latency includes the waits on the lock and on
+    the event loop, and can exceed the elapsed time of the replay.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+        self.elapsed = 0.0
+
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        start = time.perf_counter()
+        try:
+            return await super().get_user(user_id)
+        finally:
+            self.calls += 1
+            self.elapsed += time.perf_counter() - start
+
+
+class FakeBot:
+    """
+    The attributes of the bot used by the protection cog, with the API calls replaced by sleeps.
+
+    The user ids decoded from the tokens belong to a bot with the probability `bot_ratio`,
+    decided once per user id, so that detected tokens go through the deletion and the warning.
+
+    :ivar fetches: The number of users fetched to validate user ids.
+    :vartype fetches: int
+    """
+
+    def __init__(self, database: Database, fetch_latency: float, bot_ratio: float) -> None:
+        self.config = Config()
+        self.logger = logging.getLogger("replay")
+        self.database = database
+        self.session = None
+        self.fetch_latency = fetch_latency
+        self.bot_ratio = bot_ratio
+        self.fetches = 0
+
+    def get_user(self, user_id: int) -> None:
+        return None
+
+    async def fetch_user(self, user_id: int) -> SimpleNamespace:
+        self.fetches += 1
+        await asyncio.sleep(self.fetch_latency)
+        return SimpleNamespace(id=user_id, bot=random.Random(user_id).random() < self.bot_ratio)
+
+
+def generate(count: int, guilds: int, authors: int, attachment_ratio: float) -> List[dict]:
+    """
+    Generate a stream of messages, chat from a few active authors across guilds and channels,
+    some with attachments from the test assets.
+
+    :param count: The number of messages.
+    :type count: int
+    :param guilds: The number of guilds.
+    :type guilds: int
+    :param authors: The number of authors.
+    :type authors: int
+    :param attachment_ratio: The ratio of messages with an attachment.
+    :type attachment_ratio: float
+
+    :return: The messages.
+    :rtype: List[dict]
+    """
+    assets = [
+        os.path.join(fmt, name)
+        for fmt in sorted(os.listdir(ASSETS))
+        for name in sorted(os.listdir(os.path.join(ASSETS, fmt)))
+    ]
+    records = []
+    for content in generate_chat(count):
+        guild = random.randrange(guilds)
+        record = {
+            "guild": guild,
+            "channel": guild * 100 + random.randrange(5),
+            "author": random.randrange(authors),
+            "content": content,
+            "attachments": [],
+        }
+        if random.random() < attachment_ratio:
+            # most files are safe, tokens are as rare as in the chat
+            asset = random.choice(
+                [i for i in assets if "danger" not in i] if random.random() < 0.99 else assets
+            )
+            record["attachments"].append(
+                {"filename": os.path.basename(asset), "path": os.path.join(ASSETS, asset)}
+            )
+        records.append(record)
+    return records
+
+
+def make_message(record: dict, http_latency: float, stats: Dict[str, int]) -> SimpleNamespace:
+    """
+    Make a message from a record of the stream.
+
+    :param record: The record.
+    :type record: dict
+    :param http_latency: The seconds an API call takes.
+    :type http_latency: float
+    :param stats: The counters of the API calls.
+    :type stats: Dict[str, int]
+
+    :return: The message.
+    :rtype: SimpleNamespace
+    """
+
+    async def request(kind: str, *args) -> None:
+        stats[kind] += 1
+        await asyncio.sleep(http_latency)
+
+    def make_attachment(spec: dict) -> SimpleNamespace:
+        if "path" in spec:
+            with open(spec["path"], "rb") as f:
+                data = f.read()
+        else:
+            data = spec["text"].encode()
+
+        async def read() -> bytes:
+            await asyncio.sleep(http_latency)
+            return data
+
+        return SimpleNamespace(
+            filename=spec["filename"],
+            content_type=spec.get("content_type"),
+            size=len(data),
+            url=spec.get("url", f"https://cdn.example/{id(data)}/{spec['filename']}"),
+            read=read,
+        )
+
+    guild = SimpleNamespace(
+        id=record["guild"], me=SimpleNamespace(id=0), preferred_locale=record.get("locale")
+    )
+    channel = SimpleNamespace(
+        id=record["channel"],
+        parent=None,
+        permissions_for=lambda member: PERMISSIONS,
+        send=lambda *args: request("sent", *args),
+        delete_messages=lambda *args: request("deleted", *args),
+    )
+    return SimpleNamespace(
+        id=next(MESSAGE_IDS),
+        guild=guild,
+        channel=channel,
+        author=SimpleNamespace(id=record["author"], bot=False, mention=f"<@{record['author']}>"),
+        content=record.get("content", ""),
+        attachments=[make_attachment(i) for i in record.get("attachments", [])],
+        reply=lambda *args: request("sent", *args),
+        delete=lambda: request("deleted"),
+    )
+
+
+async def monitor_lag(interval: float, lags: List[float]) -> None:
+    """
+    Record how late the event loop wakes up a task sleeping for `interval` seconds.
+
+    :param interval: The seconds between samples.
+    :type interval: float
+    :param lags: The list the lags are appended to.
+    :type lags: List[float]
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+def percentiles(values: List[float]) -> str:
+    """
+    Format the p50, p99 and max of the values in milliseconds.
+
+    :param values: The values in seconds.
+    :type values: List[float]
+
+    :return: The formatted percentiles.
+    :rtype: str
+    """
+    if len(values) < 2:
+        return "n/a"
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return (
+        f"p50 {quantiles[49] * 1000:.2f} ms, p99 {quantiles[98] * 1000:.2f} ms, "
+        f"max {max(values) * 1000:.2f} ms"
+    )
+
+
+async def replay(records: List[dict], args: argparse.Namespace) -> dict:
+    """
+    Replay the messages through the protection cog.
+
+    :param records: The messages.
+    :type records: List[dict]
+    :param args: The command line arguments.
+    :type args: argparse.Namespace
+
+    :return: The report.
+    :rtype: dict
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        database = TimedDatabase(os.path.join(tmp, "database.db"))
+        await database.initialize()
+        if args.opt_out_ratio > 0:
+            for user_id in range(0, args.authors, max(int(1 / args.opt_out_ratio), 1)):
+                await database.opt_out(user_id)
+        await database.flush()
+        bot = FakeBot(database, args.fetch_latency / 1000, args.bot_ratio)
+        cog = Protection(bot)
+        stats = {"sent": 0, "deleted": 0}
+        messages = [make_message(i, args.http_latency / 1000, stats) for i in records]
+        latencies: List[float] = []
+        lags: List[float] = []
+
+        async def dispatch(message: SimpleNamespace, scheduled: float) -> None:
+            try:
+                await cog.on_message(message)
+            except Exception as e:
+                bot.logger.warning(f"on_message failed: {e!r}")
+            latencies.append(time.perf_counter() - scheduled)
+
+        monitor = asyncio.create_task(monitor_lag(args.lag_interval / 1000, lags))
+        tasks = []
+        start = time.perf_counter()
+        try:
+            for i, message in enumerate(messages):
+                scheduled = start + i / args.rate if args.rate > 0 else start
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(dispatch(message, scheduled)))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - start
+        finally:
+            monitor.cancel()
+            cog.cog_unload()
+            await database.close()
+    return {
+        "messages": len(messages),
+        "elapsed": elapsed,
+        "throughput": len(messages) / elapsed,
+        "latencies": latencies,
+        "lags": lags,
+        "db_calls": database.calls,
+        "db_time": database.elapsed,
+        "fetches": bot.fetches,
+        "shed": cog.scheduler.shed_count,
+        **stats,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    if args.input:
+        with open(args.input) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    else:
+        records = generate(args.messages, args.guilds, args.authors, args.attachment_ratio)
+    if args.generate:
+        with open(args.generate, "w") as f:
+            f.writelines(json.dumps(i) + "\n" for i in records)
+        print(f"{len(records)} messages written to {args.generate}")
+        return
+    report = await replay(records, args)
+    rate = f"{args.rate:.0f} messages/s" if args.rate > 0 else "all at once"
+    print(f"replayed {report['messages']} messages ({rate}) in {report['elapsed']:.2f} s")
+    print(f"throughput: {report['throughput']:.0f} messages/s")
+    print(f"latency   : {percentiles(report['latencies'])}")
+    print(f"loop lag  : {percentiles(report['lags'])}")
+    per_lookup = report["db_time"] / max(report["db_calls"], 1)
+    print(
+        f"database  : {report['db_calls']} lookups, {report['db_time'] * 1000:.1f} ms summed "
+        f"latency in {report['elapsed']:.2f} s, {per_lookup * 1e6:.1f} us per lookup"
+    )
+    print(
+        f"api calls : {report['fetches']} user fetches, {report['sent']} warnings, "
+        f"{report['deleted']} deletions"
+    )
+    print(f"scheduler : {report['shed']} attachment scans shed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", help="JSONL stream of messages, generated if not provided")
+    parser.add_argument("--generate", help="write the generated stream to this file and exit")
+    parser.add_argument(
+        "--rate", type=float, default=1000, help="messages per second, 0 for all at once"
+    )
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--authors", type=int, default=2000)
+    parser.add_argument("--attachment-ratio", type=float, default=0.02)
+    parser.add_argument("--opt-out-ratio", type=float, default=0.01)
+    parser.add_argument(
+        "--bot-ratio",
+        type=float,
+        default=1.0,
+        help="ratio of the user ids of the tokens that belong to a bot, 0 to never delete",
+    )
+    parser.add_argument("--http-latency", type=float, default=50, help="milliseconds per API call")
+    parser.add_argument(
+        "--fetch-latency", type=float, default=50, help="milliseconds per user fetch"
+    )
+    parser.add_argument(
+        "--lag-interval", type=float, default=10, help="milliseconds between lag samples"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(main(args))
@@ -0,0 +1,63 @@
+"""
+Benchmark the startup of the bot, from launch until the extensions are loaded.
+
+Launches fresh interpreters that build the bot without connecting to discord, with and without
+tracemalloc, and reports the median time since launch and which optional backends were imported.
+Run with: python -m benchmarks.startup [--runs N]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = """
+import json, sys, tracemalloc
+if {tracemalloc}:
+    tracemalloc.start(25)
+from src.main import Bot
+bot = Bot()
+print(json.dumps({{
+    "uptime": bot.uptime(),
+    "imported": [i for i in ("py7zr", "rarfile", "magic") if i in sys.modules],
+}}))
+"""
+
+
+def launch(tracing: bool) -> dict:
+    """
+    Launch an interpreter that builds the bot.
+
+    :param tracing: Whether to start tracemalloc first, as start.py does in debug mode.
+    :type tracing: bool
+
+    :return: The seconds from launch until the extensions are loaded, and the imported backends.
+    :rtype: dict
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(tracemalloc=tracing)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(runs: int) -> None:
+    for tracing in (False, True):
+        results = [launch(tracing) for _ in range(runs)]
+        uptime = statistics.median(i["uptime"] for i in results)
+        imported = ", ".join(results[-1]["imported"]) or "none"
+        name = "with tracemalloc" if tracing else "default"
+        print(f"{name:<16}: {uptime:>6.2f} s to extensions loaded, backends imported: {imported}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    main(args.runs)
@@ -0,0 +1,355 @@
+"""
+Benchmark suite of the token detection hot paths.
+
+Generates synthetic corpora, chat messages, large text files and every archive format at
+several sizes and member counts, then measures detect, decoder_search and the scan methods for
+throughput, latency percentiles and peak memory.
+The results are saved as JSON, and compared against a previous run with --baseline, the exit
+code is 1 when a case regressed by more than --tolerance.
+Run with: python -m benchmarks.suite [--output FILE] [--baseline FILE] [--tolerance RATIO]
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tarfile
+import time
+import tracemalloc
+import zipfile
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import py7zr
+
+from benchmarks.decoder_search import generate as generate_text
+from benchmarks.detect import TOKEN as CHAT_TOKEN
+from benchmarks.detect import generate as generate_chat
+from src.utils.token_detection import TokenDetector
+
+ASSETS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "assets"
+)
+
+
+def make_members(size: int, count: int) -> Dict[str, bytes]:
+    """
+    Generate the members of an archive, log-like text with a token at the end of the last member,
+    so that every member is scanned. The count must not exceed TokenDetector.MAX_MEMBERS, the
+    members after it are not scanned.
+
+    :param size: The total size of the members in bytes.
+    :type size: int
+    :param count: The number of members.
+    :type count: int
+
+    :return: The members by name.
+    :rtype: Dict[str, bytes]
+    """
+    text = generate_text(size)
+    member = max(len(text) // count, 1)
+    members = {f"log{i}.txt": text[i * member : (i + 1) * member] for i in range(count - 1)}
+    members[f"log{count - 1}.txt"] = text[(count - 1) * member :]
+    return members
+
+
+def make_archive(fmt: str, members: Dict[str, bytes]) -> bytes:
+    """
+    Build an archive of the given format.
+
+    :param fmt: The format, "zip", "7z", "tar", "gzip" or "bz2", compressed tarballs for the last two.
+    :type fmt: str
+    :param members: The members by name.
+    :type members: Dict[str, bytes]
+
+    :return: The archive.
+    :rtype: bytes
+    """
+    buffer = io.BytesIO()
+    if fmt == "zip":
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, data in members.items():
+                archive.writestr(name, data)
+    elif fmt == "7z":
+        with py7zr.SevenZipFile(buffer, "w") as archive:
+            for name, data in members.items():
+                archive.writef(io.BytesIO(data), name)
+    else:
+        mode = {"tar": "w", "gzip": "w:gz", "bz2": "w:bz2"}[fmt]
+        with tarfile.open(fileobj=buffer, mode=mode) as archive:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def read_attachment(data: bytes, filename: str) -> SimpleNamespace:
+    """
+    Make an attachment that is read at once, without a session.
+
+    :param data: The content of the attachment.
+    :type data: bytes
+    :param filename: The filename of the attachment.
+    :type filename: str
+
+    :return: The attachment.
+    :rtype: SimpleNamespace
+    """
+
+    async def read():
+        return data
+
+    return SimpleNamespace(
+        size=len(data), filename=filename, content_type=None, url=filename, read=read
+    )
+
+
+def build_cases(sizes: List[float], counts: List[int], messages: int) -> List[tuple]:
+    """
+    Build the benchmark cases from the synthetic corpora.
+
+    :param sizes: The sizes of the text files and archive contents in MiB.
+    :type sizes: List[float]
+    :param counts: The numbers of archive members.
+    :type counts: List[int]
+    :param messages: The number of chat messages.
+    :type messages: int
+
+    :return: The cases as (name, unit, items, amount per item, function returning an awaitable).
+        The amount is the number of bytes for MiB/s cases, 1 for items/s cases.
+    :rtype: List[tuple]
+    """
+    scan_methods = {
+        "zip": TokenDetector.scan_zip,
+        "7z": TokenDetector.scan_7z,
+        "tar": TokenDetector.scan_tar,
+        "gzip": TokenDetector.scan_gzip,
+        "bz2": TokenDetector.scan_bz2,
+    }
+    chat = generate_chat(messages) + [f"leaked {CHAT_TOKEN}"]
+    cases = [("detect/chat", "messages/s", chat, 1, TokenDetector.detect)]
+    for size in sizes:
+        data = generate_text(int(size * 1024**2))
+        cases.append(
+            (f"decoder_search/{size}MiB", "MiB/s", [data], len(data), TokenDetector.decoder_search)
+        )
+        cases.append(
+            (
+                f"scan_attachment/text/{size}MiB",
+                "MiB/s",
+                [read_attachment(data, "log.txt")],
+                len(data),
+                lambda attachment: TokenDetector.scan_attachment(attachment, True, True),
+            )
+        )
+        for count in counts:
+            members = make_members(int(size * 1024**2), count)
+            total = sum(map(len, members.values()))
+            for fmt, method in scan_methods.items():
+                archive = make_archive(fmt, members)
+                cases.append(
+                    (
+                        f"scan_{fmt}/{size}MiB/{count}",
+                        "MiB/s",
+                        [archive],
+                        total,
+                        lambda archive, method=method: method(io.BytesIO(archive)),
+                    )
+                )
+            archive = make_archive("zip", members)
+            cases.append(
+                (
+                    f"scan_archive/zip/{size}MiB/{count}",
+                    "MiB/s",
+                    [archive],
+                    total,
+                    lambda archive: TokenDetector.scan_archive("application/zip", archive),
+                )
+            )
+    # rar archives cannot be created without the proprietary tool, the test asset is used instead
+    rar = open(os.path.join(ASSETS, "rar", "danger.rar"), "rb").read()
+    cases.append(
+        (
+            "scan_rar/asset",
+            "archives/s",
+            [rar],
+            1,
+            lambda archive: TokenDetector.scan_rar(io.BytesIO(archive)),
+        )
+    )
+    return cases
+
+
+async def measure(
+    items: list, amount: int, func: Callable[..., Awaitable], rounds: int
+) -> Dict[str, float]:
+    """
+    Measure a case, the last item must contain a token.
+
+    :param items: The inputs, func is called once per item per round.
+    :type items: list
+    :param amount: The amount of work of one item, bytes or 1.
+    :type amount: int
+    :param func: The function to measure.
+    :type func: Callable[..., Awaitable]
+    :param rounds: The number of rounds.
+    :type rounds: int
+
+    :raises AssertionError: Raised when the token is not detected in the last item.
+
+    :return: The throughput, the latency percentiles in milliseconds and the peak memory in MiB.
+    :rtype: Dict[str, float]
+    """
+    latencies = []
+    for _ in range(rounds):
+        for item in items:
+            start = time.perf_counter()
+            await func(item)
+            latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    result = await func(items[-1])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    if not result:
+        raise AssertionError(f"the token was not detected: {result!r}")
+    scale = 1024**2 if amount > 1 else 1
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    else:
+        quantiles = latencies * 99
+    return {
+        "throughput": amount * len(latencies) / sum(latencies) / scale,
+        "p50_ms": quantiles[49] * 1000,
+        "p90_ms": quantiles[89] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "peak_mib": peak / 1024**2,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Compare the results against a baseline run.
+
+    :param results: The results of this run.
+    :type results: dict
+    :param baseline: The results of the baseline run.
+    :type baseline: dict
+    :param tolerance: The relative change allowed before a metric is reported as a regression.
+    :type tolerance: float
+
+    :return: The regressions found.
+    :rtype: List[str]
+    """
+    regressions = []
+    for name, before in baseline["results"].items():
+        after = results["results"].get(name)
+        if after is None or "error" in before:
+            continue
+        if "error" in after:
+            regressions.append(f"{name}: {after['error']}")
+            continue
+        if after["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {before['throughput']:.1f} -> {after['throughput']:.1f}"
+            )
+        for metric in ("p99_ms", "peak_mib"):
+            # ignore the noise of tiny values
+            if after[metric] > max(before[metric] * (1 + tolerance), before[metric] + 0.5):
+                regressions.append(f"{name}: {metric} {before[metric]:.2f} -> {after[metric]:.2f}")
+    return regressions
+
+
+def save(results: dict, path: str) -> None:
+    """
+    Save the results, after each case so that a failing case does not lose the others.
+
+    :param results: The results.
+    :type results: dict
+    :param path: The path of the JSON file.
+    :type path: str
+    """
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+async def main(args: argparse.Namespace) -> int:
+    # the members past MAX_MEMBERS are never scanned, the token of the last member would be missed
+    counts = list(dict.fromkeys(min(i, TokenDetector.MAX_MEMBERS) for i in args.members))
+    if counts != args.members:
+        print(
+            f"archives are scanned up to {TokenDetector.MAX_MEMBERS} members, "
+            f"member counts clamped to {counts}"
+        )
+    # threads keep the scans in this process, so that tracemalloc sees their allocations
+    TokenDetector.configure(
+        executor="thread",
+        timeout=600,
+        archive_max_bytes=max(args.sizes) * 4 * 1024**2,
+        archive_max_ratio=10**6,
+        archive_max_members=max(counts) * 2,
+    )
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        },
+        "results": {},
+    }
+    failed = False
+    try:
+        for name, unit, items, amount, func in build_cases(args.sizes, counts, args.messages):
+            if args.filter and args.filter not in name:
+                continue
+            try:
+                result = await measure(items, amount, func, args.rounds)
+            except AssertionError as e:
+                failed = True
+                results["results"][name] = {"unit": unit, "error": str(e)}
+                print(f"{name:<28}: FAILED {e}")
+            else:
+                results["results"][name] = {"unit": unit, **result}
+                print(
+                    f"{name:<28}: {result['throughput']:>10.1f} {unit:<10} "
+                    f"p50 {result['p50_ms']:>9.3f} ms, p99 {result['p99_ms']:>9.3f} ms, "
+                    f"peak {result['peak_mib']:>7.2f} MiB"
+                )
+            save(results, args.output)
+    finally:
+        TokenDetector.shutdown()
+    save(results, args.output)
+    print(f"results saved to {args.output}")
+    if args.baseline is None:
+        return 1 if failed else 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions or failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--sizes", type=float, nargs="+", default=[0.25, 2, 8], help="sizes of the files in MiB"
+    )
+    parser.add_argument("--members", type=int, nargs="+", default=[1, 10, 25])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--filter", help="only run the cases whose name contains this")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,368 @@
+"""
+The cluster module of the bot.
+Runs the shards in several worker processes, each one a bot with its own event loop, supervised
+by a launcher that restarts crashed workers and relays statistics and cache invalidations
+between them over pipes.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable, Dict, List, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+def split_shards(shard_count: int, workers: int) -> List[List[int]]:
+    """
+    Split the shard ids across the workers as evenly as possible.
+
+    :param shard_count: The total number of shards.
+    :type shard_count: int
+    :param workers: The number of workers, workers without a shard are dropped.
+    :type workers: int
+
+    :return: The shard ids of each worker.
+    :rtype: List[List[int]]
+    """
+    return [i for i in (list(range(shard_count))[n::workers] for n in range(workers)) if i]
+
+
+async def recommended_shards(token: str) -> int:
+    """
+    Get the number of shards recommended by discord for the bot.
+
+    :param token: The token of the bot.
+    :type token: str
+
+    :return: The number of shards.
+    :rtype: int
+    """
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            "https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}
+        ) as resp:
+            resp.raise_for_status()
+            return (await resp.json())["shards"]
+
+
+class ClusterClient:
+    """
+    The end of the IPC channel in a worker.
+    Statistics are published to the launcher, which sends back the totals of every worker, and
+    user ids whose settings changed are relayed to the other workers so they drop their cached
+    copy.
+
+    :ivar cluster_id: The id of the worker.
+    :vartype cluster_id: int
+    :ivar totals: The latest totals of the statistics of every worker.
+    :vartype totals: Dict[str, Any]
+    :ivar on_invalidate: Called on the event loop with the user ids changed by another worker.
+    :vartype on_invalidate: Optional[Callable[[List[int]], None]]
+    """
+
+    def __init__(self, conn: Connection, cluster_id: int) -> None:
+        self.conn = conn
+        self.cluster_id = cluster_id
+        self.totals: Dict[str, Any] = {}
+        self.on_invalidate: Optional[Callable[[List[int]], None]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._send_lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Start receiving the messages of the launcher, on a thread so the event loop never blocks.
+        """
+        self._loop = asyncio.get_running_loop()
+        threading.Thread(target=self._receive, name="cluster-ipc", daemon=True).start()
+
+    def _receive(self) -> None:
+        """
+        Receive the messages of the launcher until the pipe is closed.
+        This is an internal method and should not be called directly.
+        """
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                return
+            if "totals" in message:
+                self.totals = message["totals"]
+            elif "invalidate" in message and self.on_invalidate is not None:
+                self._loop.call_soon_threadsafe(self.on_invalidate, message["invalidate"])
+
+    def _send(self, message: dict) -> None:
+        """
+        Send a message to the launcher, a closed pipe is ignored.
+        This is an internal method and should not be called directly.
+
+        :param message: The message.
+        :type message: dict
+        """
+        try:
+            with self._send_lock:
+                self.conn.send(message)
+        except (BrokenPipeError, OSError):
+            logger.warning("The cluster launcher is gone, dropping an IPC message")
+
+    def publish(self, stats: Dict[str, Any]) -> None:
+        """
+        Publish the statistics of this worker.
+
+        :param stats: The statistics, numbers are summed across the workers.
+        :type stats: Dict[str, Any]
+        """
+        self._send({"stats": stats})
+
+    def invalidate(self, user_ids: List[int]) -> None:
+        """
+        Tell the other workers that the settings of the users changed.
+
+        :param user_ids: The user ids.
+        :type user_ids: List[int]
+        """
+        self._send({"invalidate": user_ids})
+
+    def total(self, key: str, default: Any) -> Any:
+        """
+        Get the total of a statistic across the workers.
+
+        :param key: The statistic.
+        :type key: str
+        :param default: The value returned before the launcher sent any total.
+        :type default: Any
+
+        :return: The total.
+        :rtype: Any
+        """
+        return self.totals.get(key, default)
+
+
+def run_worker(
+    token: str, cluster_id: int, shard_ids: List[int], shard_count: int, conn: Connection
+) -> None:
+    """
+    The entrypoint of a worker process, run the bot with the given shards.
+
+    :param token: The token of the bot.
+    :type token: str
+    :param cluster_id: The id of the worker.
+    :type cluster_id: int
+    :param shard_ids: The shards of the worker.
+    :type shard_ids: List[int]
+    :param shard_count: The total number of shards.
+    :type shard_count: int
+    :param conn: The end of the IPC pipe of the worker.
+    :type conn: Connection
+    """
+    from src.main import Bot
+
+    Bot(shard_ids=shard_ids, shard_count=shard_count, cluster=ClusterClient(conn, cluster_id)).run(
+        token
+    )
+
+
+class Worker:
+    """
+    A worker process supervised by the launcher.
+    """
+
+    def __init__(self, cluster_id: int, shard_ids: List[int]) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn: Optional[Connection] = None
+        self.started = 0.0
+        self.failures = 0
+        self.restart_at: Optional[float] = None
+        self.stats: Dict[str, Any] = {}
+
+
+class ClusterLauncher:
+    """
+    Run the shards of the bot in several worker processes.
+    Workers that exit while the launcher is running are restarted, after a delay that doubles
+    with each consecutive crash up to a minute. The statistics published by the workers are
+    summed and sent back to every worker, and user invalidations are relayed to the other
+    workers.
+
+    :ivar restarts: The number of worker restarts.
+    :vartype restarts: int
+    """
+
+    MAX_RESTART_DELAY = 60.0
+    STABLE_AFTER = 60.0
+
+    def __init__(
+        self,
+        token: str,
+        shard_count: int,
+        workers: int,
+        restart_delay: float = 1.0,
+        target: Callable[..., None] = run_worker,
+    ) -> None:
+        self.token = token
+        self.shard_count = shard_count
+        self.restart_delay = restart_delay
+        self.target = target
+        self.workers = [Worker(n, i) for n, i in enumerate(split_shards(shard_count, workers))]
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = threading.Event()
+
+    def totals(self) -> Dict[str, Any]:
+        """
+        Sum the numeric statistics of every worker.
+
+        :return: The totals.
+        :rtype: Dict[str, Any]
+        """
+        totals: Dict[str, Any] = {}
+        for worker in self.workers:
+            for key, value in worker.stats.items():
+                if isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def _start(self, worker: Worker) -> None:
+        """
+        Start the process of a worker.
+        This is an internal method and should not be called directly.
+
+        :param worker: The worker.
+        :type worker: Worker
+        """
+        parent, child = self._context.Pipe()
+        worker.conn = parent
+        worker.process = self._context.Process(
+            target=self.target,
+            args=(self.token, worker.cluster_id, worker.shard_ids, self.shard_count, child),
+            name=f"cluster-{worker.cluster_id}",
+        )
+        worker.process.start()
+        child.close()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        logger.info(f"Started worker {worker.cluster_id} with shards {worker.shard_ids}")
+
+    def _on_exit(self, worker: Worker) -> None:
+        """
+        Schedule the restart of a worker whose process exited.
+        This is an internal method and should not be called directly.
+
+        :param worker: The worker.
+        :type worker: Worker
+        """
+        worker.process.join()
+        worker.conn.close()
+        worker.stats = {}
+        if time.monotonic() - worker.started >= self.STABLE_AFTER:
+            worker.failures = 0
+        delay = min(self.restart_delay * 2**worker.failures, self.MAX_RESTART_DELAY)
+        worker.failures += 1
+        worker.restart_at = time.monotonic() + delay
+        logger.warning(
+            f"Worker {worker.cluster_id} exited with code {worker.process.exitcode}, "
+            f"restarting in {delay:.1f}s"
+        )
+
+    def _on_message(self, worker: Worker, message: dict) -> None:
+        """
+        Handle a message of a worker.
+        This is an internal method and should not be called directly.
+
+        :param worker: The worker that sent the message.
+        :type worker: Worker
+        :param message: The message.
+        :type message: dict
+        """
+        if "stats" in message:
+            worker.stats = message["stats"]
+            self._broadcast({"totals": self.totals()})
+        elif "invalidate" in message:
+            self._broadcast(message, exclude=worker)
+
+    def _broadcast(self, message: dict, exclude: Optional[Worker] = None) -> None:
+        """
+        Send a message to every running worker.
+        This is an internal method and should not be called directly.
+
+        :param message: The message.
+        :type message: dict
+        :param exclude: A worker the message is not sent to.
+        :type exclude: Optional[Worker]
+        """
+        for worker in self.workers:
+            if worker is exclude or worker.restart_at is not None:
+                continue
+            try:
+                worker.conn.send(message)
+            except (BrokenPipeError, OSError):
+                pass  # the exit of the worker is handled by its sentinel
+
+    def run(self) -> None:
+        """
+        Start the workers and supervise them until :meth:`stop` is called or the launcher
+        receives SIGINT or SIGTERM.
+        """
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, lambda *_: self.stop())
+        for worker in self.workers:
+            self._start(worker)
+        try:
+            while not self._stopping.is_set():
+                now = time.monotonic()
+                for worker in self.workers:
+                    if worker.restart_at is not None and worker.restart_at <= now:
+                        self.restarts += 1
+                        self._start(worker)
+                running = [i for i in self.workers if i.restart_at is None]
+                handles = {i.process.sentinel: i for i in running}
+                handles.update({i.conn: i for i in running})
+                for handle in wait(list(handles), timeout=0.5):
+                    worker = handles[handle]
+                    if worker.restart_at is not None:
+                        continue
+                    if handle is worker.conn:
+                        try:
+                            self._on_message(worker, worker.conn.recv())
+                        except (EOFError, OSError):
+                            pass  # the exit of the worker is handled by its sentinel
+                    else:
+                        self._on_exit(worker)
+        finally:
+            self._shutdown()
+
+    def stop(self) -> None:
+        """
+        Stop the launcher and its workers.
+        """
+        self._stopping.set()
+
+    def _shutdown(self, timeout: float = 30.0) -> None:
+        """
+        Ask every worker to stop, and kill the ones still running after the timeout.
+        This is an internal method and should not be called directly.
+
+        :param timeout: The seconds the workers have to stop.
+        :type timeout: float
+        """
+        running = [i.process for i in self.workers if i.process and i.process.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in running:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        for worker in self.workers:
+            if worker.conn is not None:
+                worker.conn.close()
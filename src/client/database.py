@@ -2,24 +2,83 @@
 The database module of the bot.
 """
 
-from typing import Dict
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
 
 import aiosqlite
 
+from src.utils.cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
 
 class Database:
     """
     The database class of the bot.
+    A single long-lived connection is opened by :meth:`initialize` and shared by every query,
+    it must be closed with :meth:`close` on shutdown.
+    Users are cached in memory, including users without a row, and the cache is kept up to date
+    by the write methods.
+    Writes are queued and merged per user, then flushed in a single transaction every
+    `flush_interval` seconds or once `flush_threshold` users are pending.
+    Attachment scan results are persisted in the `scan_results` table, expired rows are removed
+    on :meth:`initialize`.
+    Several processes can share the database file, writers wait for each other, and
+    `on_flush` is called with the users written by a flush so that the other processes can
+    :meth:`invalidate` their cached copy.
     """
 
-    def __init__(self, path: str) -> None:
+    DEFAULT_USER = {"opt_out": 0, "language": "en-US"}
+
+    SELECT_USER = "SELECT * FROM users WHERE id = ?"
+    SELECT_SCAN_RESULT = (
+        "SELECT result FROM scan_results WHERE key = ? AND rules = ? AND expires > ?"
+    )
+    UPSERT_SCAN_RESULT = (
+        "INSERT INTO scan_results (key, result, rules, expires) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET result = excluded.result, rules = excluded.rules, "
+        "expires = excluded.expires"
+    )
+
+    def __init__(
+        self,
+        path: str,
+        cached_statements: int = 64,
+        cache_size: int = 10000,
+        cache_ttl: Optional[float] = 3600,
+        flush_interval: float = 1.0,
+        flush_threshold: int = 100,
+    ) -> None:
         self.path = path
+        self.cached_statements = cached_statements
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._db: Optional[aiosqlite.Connection] = None
+        self._lock = asyncio.Lock()
+        self._cache_lock = asyncio.Lock()
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._flush_event = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.on_flush: Optional[Callable[[List[int]], None]] = None
 
     async def initialize(self) -> None:
         """
         Initializes the database.
+        Opens the shared connection in WAL mode and creates the tables if needed.
+        Calling this method again while the connection is open does nothing.
         """
-        async with aiosqlite.connect(self.path) as db:
+        async with self._lock:
+            if self._db is not None:
+                return
+            db = await aiosqlite.connect(self.path, cached_statements=self.cached_statements)
+            db.row_factory = aiosqlite.Row
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=NORMAL")
+            # wait for the writers of the other processes instead of failing at once
+            await db.execute("PRAGMA busy_timeout=5000")
             await db.execute(
                 """
                 CREATE TABLE IF NOT EXISTS users (
@@ -29,34 +88,206 @@ class Database:
                 )
                 """
             )
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS scan_results (
+                    key TEXT PRIMARY KEY,
+                    result INTEGER NOT NULL,
+                    rules TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )
+                """
+            )
+            await db.execute("DELETE FROM scan_results WHERE expires <= ?", (time.time(),))
+            await db.commit()
+            self._db = db
+            if self.flush_interval > 0:
+                self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        """
+        Flushes the pending writes and closes the shared connection.
+        """
+        async with self._lock:
+            if self._db is None:
+                return
+            if self._flush_task is not None:
+                self._flush_task.cancel()
+                await asyncio.gather(self._flush_task, return_exceptions=True)
+                self._flush_task = None
+            await self.flush()
+            await self._db.close()
+            self._db = None
+
+    async def _flush_loop(self) -> None:
+        """
+        The loop that flushes the pending writes periodically or when the queue is large.
+        This is an internal method and should not be called directly.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush the pending database writes")
+
+    async def flush(self) -> None:
+        """
+        Writes every pending upsert in a single transaction.
+        The writes are queued again if the transaction fails.
+        """
+        if not self._pending or self._db is None:
+            return
+        async with self._cache_lock:
+            pending, self._pending = self._pending, {}
+            groups: Dict[tuple, list] = {}
+            for user_id, values in pending.items():
+                columns = tuple(sorted(values))
+                groups.setdefault(columns, []).append((user_id, *(values[i] for i in columns)))
+            try:
+                for columns, rows in groups.items():
+                    await self._db.executemany(self._upsert_query(columns), rows)
+                await self._db.commit()
+            except BaseException:
+                await self._db.rollback()
+                for user_id, values in pending.items():
+                    self._pending[user_id] = {**values, **self._pending.get(user_id, {})}
+                raise
+        if self.on_flush is not None:
+            self.on_flush(list(pending))
+
+    @staticmethod
+    def _upsert_query(columns: tuple) -> str:
+        """
+        Build the upsert query of the users table for the given columns.
+        This is an internal method and should not be called directly.
+
+        :param columns: The columns to write, besides the id.
+        :type columns: tuple
+
+        :return: The query.
+        :rtype: str
+        """
+        return (
+            f"INSERT INTO users (id, {', '.join(columns)}) VALUES (?{', ?' * len(columns)}) "
+            f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{i} = excluded.{i}' for i in columns)}"
+        )
+
+    async def _connection(self) -> aiosqlite.Connection:
+        """
+        Get the shared connection, opening it first if :meth:`initialize` has not been called.
+        This is an internal method and should not be called directly.
+
+        :return: The shared connection.
+        :rtype: aiosqlite.Connection
+        """
+        if self._db is None:
+            await self.initialize()
+        return self._db
+
+    async def _write(self, user_id: int, key: str, value: Any) -> None:
+        """
+        Queue a write of a user column, and apply it to the cached user if the user is cached.
+        This is an internal method and should not be called directly.
+
+        :param user_id: The id of the user.
+        :type user_id: int
+        :param key: The column to write.
+        :type key: str
+        :param value: The value to write.
+        :type value: Any
+        """
+        await self._connection()
+        self._pending.setdefault(user_id, {})[key] = value
+        cached = self.cache.peek(user_id)
+        if cached is not MISSING:
+            base = cached or dict(self.DEFAULT_USER, id=user_id)
+            self.cache.set(user_id, {**base, key: value})
+        if self.flush_interval <= 0:
+            await self.flush()
+        elif len(self._pending) >= self.flush_threshold:
+            self._flush_event.set()
 
-    async def get_user(self, user_id: int) -> Dict[str, str]:
+    def invalidate(self, user_ids: List[int]) -> None:
+        """
+        Drop the cached users, after another process changed their settings.
+
+        :param user_ids: The ids of the users.
+        :type user_ids: List[int]
+        """
+        for user_id in user_ids:
+            if user_id not in self._pending:
+                self.cache.pop(user_id)
+
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """
         Gets a user from the database.
+        Served from the cache when possible, None is returned if the user has no row.
+        Pending writes of the user are included.
         """
-        async with aiosqlite.connect(self.path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM users WHERE id = ?", (user_id,)) as cursor:
-                return await cursor.fetchone()
+        user = self.cache.get(user_id)
+        if user is not MISSING:
+            return user
+        db = await self._connection()
+        async with self._cache_lock:
+            user = self.cache.peek(user_id)
+            if user is not MISSING:
+                return user
+            async with db.execute(self.SELECT_USER, (user_id,)) as cursor:
+                row = await cursor.fetchone()
+            user = dict(row) if row else None
+            if user_id in self._pending:
+                user = {**(user or dict(self.DEFAULT_USER, id=user_id)), **self._pending[user_id]}
+            self.cache.set(user_id, user)
+            return user
 
     async def opt_out(self, user_id: int, opt_out: bool = True) -> None:
         """
         Opt out of the bot.
         """
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT INTO users (id, opt_out) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET opt_out = ?",
-                (user_id, opt_out, opt_out),
-            )
-            await db.commit()
+        await self._write(user_id, "opt_out", int(opt_out))
 
     async def set_language(self, user_id: int, language: str) -> None:
         """
         Sets the language of a user or guild.
         """
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                "INSERT INTO users (id, language) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET language = ?",
-                (user_id, language, language),
-            )
+        await self._write(user_id, "language", language)
+
+    async def get_scan_result(self, key: str, rules: str) -> Optional[int]:
+        """
+        Gets the persisted result of an attachment scan.
+
+        :param key: The key of the scanned file.
+        :type key: str
+        :param rules: The version of the detection rules the result must have been produced by.
+        :type rules: str
+
+        :return: The result, or None if there is no unexpired result for these rules.
+        :rtype: Optional[int]
+        """
+        db = await self._connection()
+        async with db.execute(self.SELECT_SCAN_RESULT, (key, rules, time.time())) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def set_scan_result(self, key: str, result: int, rules: str, ttl: float) -> None:
+        """
+        Persists the result of an attachment scan.
+
+        :param key: The key of the scanned file.
+        :type key: str
+        :param result: The result.
+        :type result: int
+        :param rules: The version of the detection rules that produced the result.
+        :type rules: str
+        :param ttl: The seconds the result is valid.
+        :type ttl: float
+        """
+        db = await self._connection()
+        async with self._cache_lock:
+            await db.execute(self.UPSERT_SCAN_RESULT, (key, result, rules, time.time() + ttl))
             await db.commit()
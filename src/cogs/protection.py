@@ -2,11 +2,26 @@
 Cog module for the token protection functions.
 """
 
+import asyncio
+from collections import Counter
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
 import discord
 
 from src.client.i18n import I18n
 from src.main import BaseCog, Bot
-from src.utils.token_detection import TokenDetector
+from src.utils.actions import ActionAggregator
+from src.utils.cache import TTLCache
+from src.utils.metrics import MESSAGES, SCANS, STAGE_SECONDS
+from src.utils.permissions import PermissionCache
+from src.utils.scheduler import ScanScheduler, ScanShed
+from src.utils.token_detection import ScanCache, ScanResult, TokenDetector
+
+CONTENT_SECONDS = STAGE_SECONDS.labels(stage="content")
+EDIT_SECONDS = STAGE_SECONDS.labels(stage="edit")
+# with a margin for the time the messages wait in the batch
+BULK_DELETE_MAX_AGE = timedelta(days=14, minutes=-5)
 
 
 class Protection(BaseCog):
@@ -21,28 +36,202 @@ class Protection(BaseCog):
         self.check_attachments = self._features["check-attachments"]
         self.check_textfile = self._features["check-textfile"]
         self.check_archive = self._features["check-archive"]
+        self.check_edits = self._features.get("check-edits", True)
+
+        scanner = self.config.get("scanner", {})
+        self.attachment_concurrency = scanner.get("attachment-concurrency", 4)
+        TokenDetector.configure(
+            executor=scanner.get("executor", "thread"),
+            workers=scanner.get("workers"),
+            timeout=scanner.get("timeout", 30.0),
+            archive_max_bytes=scanner.get("archive-max-size", 100) * 1024 * 1024,
+            archive_max_ratio=scanner.get("archive-max-ratio", 100),
+            archive_max_members=scanner.get("archive-max-members", 100),
+            archive_max_depth=scanner.get("archive-max-depth", 3),
+        )
+        TokenDetector.configure_validation(
+            cache_size=scanner.get("validation-cache-size", 10000),
+            positive_ttl=scanner.get("validation-positive-ttl", 86400),
+            negative_ttl=scanner.get("validation-negative-ttl", 600),
+            concurrency=scanner.get("validation-concurrency", 5),
+        )
+        # results depend on the token pattern, the features and the limits of a scan, a change in
+        # any of them invalidates the cached results, the operational settings such as the
+        # executor or the concurrency do not
+        rules = ScanCache.rules_version(
+            TokenDetector.TOKEN_REGEX.pattern,
+            {i: self._features[i] for i in ("validate-userid", "check-textfile", "check-archive")},
+            TokenDetector.MAX_MEMBERS,
+            TokenDetector.archive_max_bytes,
+            TokenDetector.archive_max_ratio,
+            TokenDetector.archive_max_members,
+            TokenDetector.archive_max_depth,
+        )
+        self.scan_cache = ScanCache(
+            rules,
+            size=scanner.get("result-cache-size", 10000),
+            ttl=scanner.get("result-cache-ttl", 86400),
+            database=self.bot.database if scanner.get("result-cache-persistent", False) else None,
+        )
+        self.scheduler = ScanScheduler(
+            concurrency=scanner.get("scan-concurrency", 8),
+            max_queue=scanner.get("scan-queue-size", 100),
+            shed=scanner.get("shed-policy", "newest"),
+        )
+        gateway = self.config.get("gateway", {})
+        self.permissions = PermissionCache(
+            size=gateway.get("permission-cache-size", 10000),
+            ttl=gateway.get("permission-cache-ttl", 300),
+        )
+        # the content of the messages scanned clean, so that an edit only scans what changed
+        self.edits = TTLCache(
+            scanner.get("edit-cache-size", 10000), scanner.get("edit-cache-ttl", 3600)
+        )
+        raid = self.config.get("raid", {})
+        self.actions: ActionAggregator[Tuple[discord.Message, str]] = ActionAggregator(
+            self.delete_messages, window=raid.get("window", 0.5), max_batch=100
+        )
+
+    def cog_unload(self) -> None:
+        """
+        The function that is called when the cog is unloaded.
+        """
+        TokenDetector.shutdown()
+        self.actions.close()
+
+    async def scan_attachments(
+        self,
+        attachments: List[discord.Attachment],
+        client: Optional[Bot] = None,
+        guild_id: Optional[int] = None,
+    ) -> bool:
+        """
+        Scan the attachments concurrently, the remaining scans are cancelled once a token is found.
+        The scans go through the scheduler shared by every guild, text files before archives,
+        and the scans shed by the overloaded scheduler count as clean.
+
+        :param attachments: The attachments to scan.
+        :type attachments: List[discord.Attachment]
+        :param client: The bot client, will be used to validate user id if provided.
+        :type client: Optional[Bot]
+        :param guild_id: The id of the guild the attachments were sent in.
+        :type guild_id: Optional[int]
+
+        :return: Whether a token is detected in any of the attachments.
+        :rtype: bool
+        """
+        semaphore = asyncio.Semaphore(self.attachment_concurrency)
+
+        async def run(attachment: discord.Attachment) -> ScanResult:
+            with STAGE_SECONDS.time(stage="attachment"):
+                return await TokenDetector.scan_attachment(
+                    attachment,
+                    self.check_textfile,
+                    self.check_archive,
+                    client,
+                    self.bot.session,
+                    self.scan_cache,
+                )
+
+        async def scan(attachment: discord.Attachment) -> bool:
+            # skipped attachments are not downloaded, they do not need a slot
+            if not TokenDetector.needs_download(
+                attachment, self.check_textfile, self.check_archive
+            ):
+                return False
+            ft = TokenDetector.declared_type(attachment)
+            priority = (
+                ScanScheduler.ARCHIVE
+                if ft and TokenDetector.archive_format(ft)
+                else ScanScheduler.TEXT
+            )
+            async with semaphore:
+                try:
+                    result = await self.scheduler.run(guild_id, priority, lambda: run(attachment))
+                    SCANS.inc(result=ScanResult(result).name.lower())
+                    return result
+                except ScanShed:
+                    SCANS.inc(result="shed")
+                    self.logger.debug(f"Shed the scan of attachment {attachment.url}")
+                    return False
+                except Exception as e:
+                    SCANS.inc(result="error")
+                    self.logger.warning(f"Failed to scan attachment {attachment.url}: {e!r}")
+                    return False
+
+        tasks = [asyncio.create_task(scan(i)) for i in attachments]
+        try:
+            for future in asyncio.as_completed(tasks):
+                if await future:
+                    return True
+            return False
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def delete_message(self, message: discord.Message, locale: str) -> None:
         """
         Delete the message and send a warning.
+        The messages flagged in the same channel during a raid are deleted together, see
+        :meth:`delete_messages`.
 
         :param message: The message object.
         :type message: discord.Message
         :param locale: The locale for the warning message.
         :type locale: str
         """
-        func = (
-            message.reply
-            if message.channel.permissions_for(message.guild.me).read_message_history
-            else message.channel.send
-        )
-        if message.channel.permissions_for(message.guild.me).manage_messages:
-            await func(I18n.get("event.protection.deleted", locale, author=message.author.mention))
-            await message.delete()
-        else:
-            await func(
-                I18n.get("event.protection.missing-perms", locale, author=message.author.mention)
+        with STAGE_SECONDS.time(stage="delete"):
+            await self.actions.submit(message.channel.id, (message, locale))
+
+    async def delete_messages(self, messages: List[Tuple[discord.Message, str]]) -> None:
+        """
+        Delete the messages of a channel and send one warning.
+        A single message is replied to when possible, several messages are removed with bulk
+        deletes and one combined warning is sent in the most common locale.
+
+        :param messages: The messages and the locales of their warnings.
+        :type messages: List[Tuple[discord.Message, str]]
+        """
+        message, locale = messages[0]
+        permissions = self.permissions.permissions_for(message.guild, message.channel)
+        if len(messages) == 1:
+            func = message.reply if permissions.read_message_history else message.channel.send
+            if permissions.manage_messages:
+                await func(
+                    I18n.get("event.protection.deleted", locale, author=message.author.mention)
+                )
+                await message.delete()
+            else:
+                await func(
+                    I18n.get(
+                        "event.protection.missing-perms", locale, author=message.author.mention
+                    )
+                )
+            return
+
+        locale = Counter(i for _, i in messages).most_common(1)[0][0]
+        authors = ", ".join(dict.fromkeys(i.author.mention for i, _ in messages))
+        if not permissions.manage_messages:
+            await message.channel.send(
+                I18n.get(
+                    "event.protection.missing-perms-bulk",
+                    locale,
+                    count=len(messages),
+                    authors=authors,
+                )
             )
+            return
+        # messages older than 14 days cannot be bulk deleted
+        oldest = discord.utils.time_snowflake(discord.utils.utcnow() - BULK_DELETE_MAX_AGE)
+        recent = [i for i, _ in messages if i.id > oldest]
+        for i, _ in messages:
+            if i.id <= oldest:
+                await i.delete()
+        if recent:
+            await message.channel.delete_messages(recent)
+        await message.channel.send(
+            I18n.get("event.protection.deleted-bulk", locale, count=len(messages), authors=authors)
+        )
 
     @BaseCog.listener()
     async def on_message(self, message: discord.Message) -> None:
@@ -59,33 +248,188 @@ class Protection(BaseCog):
         ):
             return
 
-        is_thread = hasattr(message.channel, "parent") and message.channel.parent
+        locale = await self.warning_locale(message)
+        if locale is None:
+            return
+
+        client = self.bot if self.validate_userid else None
+
+        if message.content:
+            with CONTENT_SECONDS.time():
+                detected = await TokenDetector.detect(message.content, client)
+            if detected:
+                MESSAGES.inc(outcome="detected_content")
+                return await self.delete_message(message, locale)
 
         if (
-            is_thread
-            and not message.channel.permissions_for(message.guild.me).send_messages_in_threads
-        ) or (
-            not is_thread and not message.channel.permissions_for(message.guild.me).send_messages
+            self.check_attachments
+            and message.attachments
+            and await self.scan_attachments(message.attachments, client, message.guild.id)
         ):
+            MESSAGES.inc(outcome="detected_attachment")
+            return await self.delete_message(message, locale)
+
+        if self.check_edits and message.content:
+            self.edits.set(message.id, message.content)
+        MESSAGES.inc(outcome="clean")
+
+    @BaseCog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
+        """
+        The event handler for the raw message edit event, received whether the message is in
+        the message cache or not.
+        When the content was scanned before, only the part changed by the edit is scanned. The
+        attachments were scanned when the message was sent.
+
+        :param payload: The payload of the event.
+        :type payload: discord.RawMessageUpdateEvent
+        """
+        content = payload.data.get("content")
+        if not self.check_edits or payload.guild_id is None or not content:
+            return
+        previous = self.edits.get(payload.message_id, None)
+        if content == previous:
+            return  # only the embeds changed
+        message = self._edited_message(payload)
+        if message is None or message.author.bot:
             return
 
-        user = await self.database.get_user(message.author.id)
+        locale = await self.warning_locale(message)
+        if locale is None:
+            return
+
+        client = self.bot if self.validate_userid else None
+        with EDIT_SECONDS.time():
+            if previous is None:
+                detected = await TokenDetector.detect(content, client)
+            else:
+                detected = await TokenDetector.detect_edit(previous, content, client)
+        if detected:
+            self.edits.pop(message.id)
+            MESSAGES.inc(outcome="detected_edit")
+            return await self.delete_message(message, locale)
+
+        self.edits.set(message.id, content)
+        MESSAGES.inc(outcome="clean_edit")
+
+    def _edited_message(self, payload: discord.RawMessageUpdateEvent) -> Optional[discord.Message]:
+        """
+        Build the edited message from the payload of the event.
+        This is an internal method and should not be called directly.
+
+        :param payload: The payload of the event.
+        :type payload: discord.RawMessageUpdateEvent
+
+        :return: The message, None if its channel is not cached or the payload is partial.
+        :rtype: Optional[discord.Message]
+        """
+        guild = self.bot.get_guild(payload.guild_id)
+        channel = guild.get_channel_or_thread(payload.channel_id) if guild else None
+        if channel is None or "author" not in payload.data:
+            return None
+        try:
+            return discord.Message(state=self.bot._connection, channel=channel, data=payload.data)
+        except KeyError:
+            return None
+
+    async def warning_locale(self, message: discord.Message) -> Optional[str]:
+        """
+        Get the locale of the warning for a message, if the message should be checked.
+        Messages are not checked in channels where the bot cannot send the warning, nor for
+        the users who opted out.
+
+        :param message: The message object.
+        :type message: discord.Message
+
+        :return: The locale, None if the message should not be checked.
+        :rtype: Optional[str]
+        """
+        is_thread = hasattr(message.channel, "parent") and message.channel.parent
+        permissions = self.permissions.permissions_for(message.guild, message.channel)
+
+        if (is_thread and not permissions.send_messages_in_threads) or (
+            not is_thread and not permissions.send_messages
+        ):
+            return None
+
+        with STAGE_SECONDS.time(stage="get_user"):
+            user = await self.database.get_user(message.author.id)
         if user and user["opt_out"]:
-            return  # user has opted out of protection
+            MESSAGES.inc(outcome="opted_out")
+            return None  # user has opted out of protection
 
-        locale = user["language"] if user else message.guild.preferred_locale or "en-US"
+        return user["language"] if user else message.guild.preferred_locale or "en-US"
 
-        client = self.bot if self.validate_userid else None
+    @BaseCog.listener()
+    async def on_guild_channel_update(
+        self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel
+    ) -> None:
+        """
+        The event handler for the channel update event, the overwrites may have changed.
 
-        if message.content and await TokenDetector.detect(message.content, client):
-            return await self.delete_message(message, locale)
+        :param before: The channel before the update.
+        :type before: discord.abc.GuildChannel
+        :param after: The channel after the update.
+        :type after: discord.abc.GuildChannel
+        """
+        self.permissions.invalidate_channel(after.guild.id, after.id)
 
-        if self.check_attachments:
-            for i in message.attachments:
-                if await TokenDetector.scan_attachment(
-                    i, self.check_textfile, self.check_archive, client
-                ):
-                    return await self.delete_message(message, locale)
+    @BaseCog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel) -> None:
+        """
+        The event handler for the channel delete event.
+
+        :param channel: The deleted channel.
+        :type channel: discord.abc.GuildChannel
+        """
+        self.permissions.invalidate_channel(channel.guild.id, channel.id)
+
+    @BaseCog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role) -> None:
+        """
+        The event handler for the role update event.
+
+        :param before: The role before the update.
+        :type before: discord.Role
+        :param after: The role after the update.
+        :type after: discord.Role
+        """
+        self.permissions.invalidate_guild(after.guild.id)
+
+    @BaseCog.listener()
+    async def on_guild_role_delete(self, role: discord.Role) -> None:
+        """
+        The event handler for the role delete event.
+
+        :param role: The deleted role.
+        :type role: discord.Role
+        """
+        self.permissions.invalidate_guild(role.guild.id)
+
+    @BaseCog.listener()
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild) -> None:
+        """
+        The event handler for the guild update event, the owner may have changed.
+
+        :param before: The guild before the update.
+        :type before: discord.Guild
+        :param after: The guild after the update.
+        :type after: discord.Guild
+        """
+        self.permissions.invalidate_guild(after.id)
+
+    @BaseCog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
+        """
+        The event handler for the member update event, only the roles of the bot matter.
+
+        :param before: The member before the update.
+        :type before: discord.Member
+        :param after: The member after the update.
+        :type after: discord.Member
+        """
+        if after.id == after.guild.me.id:
+            self.permissions.invalidate_guild(after.guild.id)
 
 
 def setup(bot: Bot) -> None:
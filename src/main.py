@@ -3,23 +3,41 @@ The main module of the bot.
 """
 
 import logging
+import time
 import tracemalloc
+from typing import List, Optional
 
+import aiohttp
 import discord
+import psutil
 from discord.ext import commands, tasks
 
+from src.client.cluster import ClusterClient
 from src.client.config import Config
 from src.client.database import Database
 from src.client.logging import InterceptHandler, Logging
+from src.utils.metrics import MetricsServer, registry
+from src.utils.watchdog import LoopWatchdog
 
 
 class Bot(discord.AutoShardedBot):
     """
     The modified discord bot client.
+    In cluster mode, each worker process runs a bot with a part of the shards, and `cluster`
+    connects it to the launcher.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        shard_ids: Optional[List[int]] = None,
+        shard_count: Optional[int] = None,
+        cluster: Optional[ClusterClient] = None,
+    ) -> None:
         self._client_ready = False
+        self.cluster = cluster
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.metrics_server: Optional[MetricsServer] = None
+        self.watchdog: Optional[LoopWatchdog] = None
         self.current_presence = 0
         self.config = Config()
         self.logger = Logging(
@@ -31,35 +49,157 @@ class Bot(discord.AutoShardedBot):
             level=0 if self.config["bot"]["debug-mode"] else logging.INFO,
             force=True,
         )
-        self.database = Database(self.config["database"]["path"])
+        self.database = Database(
+            self.config["database"]["path"],
+            cache_size=self.config["database"].get("cache-size", 10000),
+            cache_ttl=self.config["database"].get("cache-ttl", 3600),
+            flush_interval=self.config["database"].get("flush-interval", 1.0),
+            flush_threshold=self.config["database"].get("flush-threshold", 100),
+        )
+        if cluster is not None:
+            # the workers share the database, changed users are dropped from the other caches
+            self.database.on_flush = cluster.invalidate
+            cluster.on_invalidate = self.database.invalidate
 
-        intents = discord.Intents.default()
-        intents.message_content = True
-        super().__init__(owner_ids=self.config["bot"]["owners"], intents=intents)
+        watchdog = self.config.get("watchdog", {})
+        if watchdog.get("enabled", False):
+            self.watchdog = LoopWatchdog(
+                interval=watchdog.get("interval", 0.1), threshold=watchdog.get("threshold", 0.5)
+            )
+
+        super().__init__(
+            owner_ids=self.config["bot"]["owners"],
+            shard_ids=shard_ids,
+            shard_count=shard_count,
+            **self.gateway_options(self.config.get("gateway", {})),
+        )
 
         for k, v in self.load_extension("src.cogs", recursive=True, store=True).items():
             if v is True:
                 self.logger.debug(f"Loaded extension {k}")
             else:
                 self.logger.error(f"Failed to load extension {k} with exception: {v}")
+        self.logger.info(f"Loaded extensions {self.uptime():.2f}s after launch")
 
     async def on_start(self) -> None:
         """
         The event that is triggered when the bot is started.
         """
         await self.database.initialize()
+        metrics = self.config.get("metrics", {})
+        if metrics.get("enabled", False):
+            # each worker of a cluster serves its own metrics on the next port
+            port = metrics.get("port", 9100) + (self.cluster.cluster_id if self.cluster else 0)
+            self.metrics_server = MetricsServer(registry, metrics.get("host", "127.0.0.1"), port)
+            await self.metrics_server.start()
+            self.logger.info(
+                f"Serving metrics on http://{self.metrics_server.host}:{self.metrics_server.port}/metrics"
+            )
         self.update_presence.start()
         self.logger.info(
             f"""
 -------------------------
 Logged in as: {self.user.name}#{self.user.discriminator} ({self.user.id})
 Shards Count: {self.shard_count}
-Memory Usage: {tracemalloc.get_traced_memory()[0] / 1024 ** 2:.2f} MB
+Memory Usage: {self.memory_usage() / 1024 ** 2:.2f} MB
+Startup Time: {self.uptime():.2f} s
  API Latency: {self.latency * 1000:.2f} ms
 Guilds Count: {len(self.guilds)}
 -------------------------"""
         )
 
+    @staticmethod
+    def gateway_options(gateway: dict) -> dict:
+        """
+        Get the intents and the cache options of the gateway connection.
+        In lean mode, only the guild and guild message events are received, no member is cached
+        but the bot itself, guilds are not chunked at startup and no message is cached. The
+        protection only reads the messages it receives and the permissions of the bot, so
+        everything else is memory spent on every guild.
+
+        :param gateway: The gateway section of the config.
+        :type gateway: dict
+
+        :return: The keyword arguments of the client.
+        :rtype: dict
+        """
+        if gateway.get("lean", False):
+            intents = discord.Intents.none()
+            intents.guilds = True
+            intents.guild_messages = True
+            member_cache_flags = discord.MemberCacheFlags.none()
+            max_messages = 0
+        else:
+            intents = discord.Intents.default()
+            member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+            max_messages = gateway.get("message-cache", 1000)
+        intents.message_content = True
+        return {
+            "intents": intents,
+            "member_cache_flags": member_cache_flags,
+            "chunk_guilds_at_startup": False,
+            # the library falls back to 1000 messages for 0, None disables the cache
+            "max_messages": max_messages or None,
+        }
+
+    @staticmethod
+    def uptime() -> float:
+        """
+        Get the seconds since the process was launched.
+
+        :return: The seconds since launch.
+        :rtype: float
+        """
+        return time.time() - psutil.Process().create_time()
+
+    @staticmethod
+    def memory_usage() -> int:
+        """
+        Get the memory used by the bot, traced by tracemalloc when it is enabled, the resident
+        set size of the process otherwise.
+
+        :return: The memory used in bytes.
+        :rtype: int
+        """
+        if tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+        return psutil.Process().memory_info().rss
+
+    async def start(self, *args, **kwargs) -> None:
+        """
+        Start the loop watchdog if it is enabled, then connect to discord.
+        """
+        if self.watchdog is not None:
+            self.watchdog.start()
+        if self.cluster is not None:
+            self.cluster.start()
+        await super().start(*args, **kwargs)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The HTTP session used to download attachments, created on first use.
+
+        :return: The HTTP session.
+        :rtype: aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self) -> None:
+        """
+        Close the connection to discord and release the resources held by the bot.
+        """
+        await super().close()
+        if self.watchdog is not None:
+            await self.watchdog.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        if self._session is not None:
+            await self._session.close()
+        await self.database.close()
+
     async def on_ready(self) -> None:
         """
         The event that is triggered when the bot is ready.
@@ -74,12 +214,25 @@ Guilds Count: {len(self.guilds)}
         """
         The loop that changes the bot's presence.
         """
-        names = ["Leaked Tokens", f"{len(self.guilds)} Guilds"]
+        names = ["Leaked Tokens", f"{self.guild_count()} Guilds"]
         self.current_presence += 1
         if self.current_presence >= len(names):
             self.current_presence = 0
         await self.change_presence(activity=discord.Game(names[self.current_presence]))
 
+    def guild_count(self) -> int:
+        """
+        Get the number of guilds of the bot, across every worker in cluster mode.
+        The guild count of this worker is published to the launcher on the way.
+
+        :return: The number of guilds.
+        :rtype: int
+        """
+        if self.cluster is None:
+            return len(self.guilds)
+        self.cluster.publish({"guilds": len(self.guilds)})
+        return self.cluster.total("guilds", len(self.guilds))
+
     @update_presence.before_loop
     async def before_update_presence(self) -> None:
         """
@@ -0,0 +1,111 @@
+"""
+The aggregator of the moderation actions.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class ActionAggregator(Generic[T]):
+    """
+    Coalesce the actions on the same key, such as the deletions in a channel, into batches.
+    The first item of a key is acted on at once. The items added while a batch is in progress,
+    or within `window` seconds after it, are acted on together in the next batch, so that a
+    burst of items costs a few API calls instead of a few per item.
+
+    :ivar action: The coroutine function acting on a batch of items of a key.
+    :vartype action: Callable[[List[T]], Awaitable[None]]
+    :ivar window: The seconds to wait for more items after a batch.
+    :vartype window: float
+    :ivar max_batch: The maximum number of items in a batch.
+    :vartype max_batch: int
+    :ivar batches: The number of batches acted on.
+    :vartype batches: int
+    """
+
+    def __init__(
+        self,
+        action: Callable[[List[T]], Awaitable[None]],
+        window: float = 0.5,
+        max_batch: int = 100,
+    ) -> None:
+        self.action = action
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self._pending: Dict[Hashable, List[Tuple[T, asyncio.Future]]] = {}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return sum(map(len, self._pending.values()))
+
+    async def submit(self, key: Hashable, item: T) -> None:
+        """
+        Add an item and wait until its batch is acted on.
+
+        :param key: The key the item is batched by.
+        :type key: Hashable
+        :param item: The item.
+        :type item: T
+
+        :raises Exception: The exception raised by the action on the batch of the item.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append((item, future))
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+        # the batch goes on for the other items if this caller is cancelled
+        await asyncio.shield(future)
+
+    async def _run(self, key: Hashable) -> None:
+        """
+        Act on the batches of a key until no item was added for a window.
+        This is an internal method and should not be called directly.
+
+        :param key: The key.
+        :type key: Hashable
+        """
+        pending = self._pending[key]
+        try:
+            while True:
+                if not pending:
+                    await asyncio.sleep(self.window)
+                    if not pending:
+                        return
+                batch = pending[: self.max_batch]
+                del pending[: self.max_batch]
+                self.batches += 1
+                try:
+                    await self.action([i for i, _ in batch])
+                except asyncio.CancelledError:
+                    for _, future in batch:
+                        future.cancel()
+                    raise
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._pending[key], self._tasks[key]
+            for _, future in pending:
+                future.cancel()
+
+    def close(self) -> None:
+        """
+        Cancel the batches in progress and the waiting items.
+        """
+        for task in self._tasks.values():
+            task.cancel()
+        # a task cancelled before it started never cleans up after itself
+        for pending in self._pending.values():
+            for _, future in pending:
+                future.cancel()
+        self._pending.clear()
+        self._tasks.clear()
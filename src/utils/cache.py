@@ -0,0 +1,136 @@
+"""
+This module contains the in-memory cache used by the bot.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterator, Optional, Tuple
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    A bounded LRU cache whose entries also expire after a time-to-live.
+    Hits and misses are counted so the cache can be sized.
+
+    :ivar maxsize: The maximum number of entries.
+    :vartype maxsize: int
+    :ivar ttl: The default time-to-live of the entries in seconds, None to never expire.
+    :vartype ttl: Optional[float]
+    :ivar hits: The number of lookups that found an entry.
+    :vartype hits: int
+    :ivar misses: The number of lookups that found nothing.
+    :vartype misses: int
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key) is not MISSING
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._data))
+
+    def peek(self, key: Hashable, default: Any = MISSING) -> Any:
+        """
+        Get an entry without counting the lookup or refreshing its recency.
+
+        :param key: The key of the entry.
+        :type key: Hashable
+        :param default: The value returned when the entry is missing or expired.
+        :type default: Any, optional
+
+        :return: The value of the entry.
+        :rtype: Any
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return default
+        return entry[1]
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """
+        Get an entry and mark it as recently used.
+
+        :param key: The key of the entry.
+        :type key: Hashable
+        :param default: The value returned when the entry is missing or expired.
+        :type default: Any, optional
+
+        :return: The value of the entry, or `default` if there is none.
+        :rtype: Any
+        """
+        value = self.peek(key)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Add or replace an entry, evicting the least recently used one if the cache is full.
+
+        :param key: The key of the entry.
+        :type key: Hashable
+        :param value: The value of the entry, None is a valid value.
+        :type value: Any
+        :param ttl: The time-to-live of this entry, defaults to the ttl of the cache.
+        :type ttl: Optional[float]
+        """
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = float("inf") if ttl is None else time.monotonic() + ttl
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove an entry.
+
+        :param key: The key of the entry.
+        :type key: Hashable
+        :param default: The value returned when the entry is missing.
+        :type default: Any, optional
+
+        :return: The value of the removed entry.
+        :rtype: Any
+        """
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        """
+        Remove every entry, the counters are kept.
+        """
+        self._data.clear()
+
+    def info(self) -> dict:
+        """
+        Get the statistics of the cache.
+
+        :return: The hits, misses, current size and maximum size of the cache.
+        :rtype: dict
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
@@ -0,0 +1,440 @@
+"""
+The metrics module of the bot.
+Counters, gauges and histograms kept in memory, and a local HTTP endpoint that serves them in
+the Prometheus text format.
+"""
+
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from aiohttp import web
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+BYTE_BUCKETS = tuple(1024 * 4**i for i in range(10))  # 1 KiB to 256 MiB
+
+
+class Metric(ABC):
+    """
+    The base class of the metrics, a value per combination of label values.
+
+    :ivar name: The name of the metric.
+    :vartype name: str
+    :ivar documentation: The help text of the metric.
+    :vartype documentation: str
+    :ivar labelnames: The names of the labels.
+    :vartype labelnames: Tuple[str, ...]
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """
+        Get the label values in the order of the label names.
+        This is an internal method and should not be called directly.
+
+        :param labels: The labels.
+        :type labels: Dict[str, str]
+
+        :raises ValueError: Raised when the labels do not match the label names.
+
+        :return: The label values.
+        :rtype: Tuple[str, ...]
+        """
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {labels}")
+        return tuple(str(labels[i]) for i in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        """
+        Format the labels of a sample.
+        This is an internal method and should not be called directly.
+
+        :param key: The label values.
+        :type key: Tuple[str, ...]
+        :param extra: An extra label already formatted, such as the bucket of a histogram.
+        :type extra: str
+
+        :return: The formatted labels, empty if there are none.
+        :rtype: str
+        """
+        labels = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        """
+        Yield the samples of the metric in the Prometheus text format.
+
+        :return: The lines of the samples.
+        :rtype: Iterator[str]
+        """
+
+    def render(self) -> str:
+        """
+        Render the metric in the Prometheus text format.
+
+        :return: The metric.
+        :rtype: str
+        """
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(f"{i}\n" for i in self.samples())
+
+
+class Counter(Metric):
+    """
+    A value that only goes up.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """
+        Increase the counter.
+
+        :param amount: The amount to increase by.
+        :type amount: float
+        :param labels: The labels of the value.
+        :type labels: str
+        """
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        """
+        Get the value of the counter.
+
+        :param labels: The labels of the value.
+        :type labels: str
+
+        :return: The value.
+        :rtype: float
+        """
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.values.items():
+            yield f"{self.name}{self._format_labels(key)} {value}"
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, or is read from a function when the metrics are rendered.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, **labels: str) -> None:
+        """
+        Set the gauge.
+
+        :param value: The value.
+        :type value: float
+        :param labels: The labels of the value.
+        :type labels: str
+        """
+        self.values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        """
+        Decrease the gauge.
+
+        :param amount: The amount to decrease by.
+        :type amount: float
+        :param labels: The labels of the value.
+        :type labels: str
+        """
+        self.inc(-amount, **labels)
+
+    def samples(self) -> Iterator[str]:
+        if self.function is not None:
+            yield f"{self.name} {self.function()}"
+            return
+        yield from super().samples()
+
+
+class HistogramChild:
+    """
+    The distribution of a histogram for one combination of label values.
+    Hot paths should keep the child from :meth:`Histogram.labels` instead of passing the labels on
+    every observation.
+
+    :ivar counts: The count of each bucket, not cumulative, with +Inf last.
+    :vartype counts: List[int]
+    :ivar total: The sum of the observed values.
+    :vartype total: float
+    """
+
+    __slots__ = ("buckets", "counts", "total")
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Observe a value.
+
+        :param value: The value.
+        :type value: float
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """
+        Observe the seconds spent in the block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    """
+    The distribution of observed values in cumulative buckets, with their count and sum.
+
+    :ivar buckets: The upper bounds of the buckets, in ascending order.
+    :vartype buckets: Tuple[float, ...]
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        labelnames: Sequence[str] = (),
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple[str, ...], HistogramChild] = {}
+
+    def labels(self, **labels: str) -> HistogramChild:
+        """
+        Get the distribution of the given label values.
+
+        :param labels: The labels.
+        :type labels: str
+
+        :return: The distribution.
+        :rtype: HistogramChild
+        """
+        key = self._key(labels)
+        child = self.values.get(key)
+        if child is None:
+            child = self.values[key] = HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Observe a value.
+
+        :param value: The value.
+        :type value: float
+        :param labels: The labels of the value.
+        :type labels: str
+        """
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels: str) -> ContextManager[None]:
+        """
+        Observe the seconds spent in the block.
+
+        :param labels: The labels of the value.
+        :type labels: str
+
+        :return: The context manager timing the block.
+        :rtype: ContextManager[None]
+        """
+        return self.labels(**labels).time()
+
+    def count(self, **labels: str) -> int:
+        """
+        Get the number of observed values.
+
+        :param labels: The labels of the values.
+        :type labels: str
+
+        :return: The number of values.
+        :rtype: int
+        """
+        child = self.values.get(self._key(labels))
+        return sum(child.counts) if child else 0
+
+    def samples(self) -> Iterator[str]:
+        for key, child in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), child.counts):
+                cumulative += count
+                labels = self._format_labels(key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {child.total}"
+            yield f"{self.name}_count{self._format_labels(key)} {cumulative}"
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    """
+    The collection of metrics rendered by the endpoint.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        """
+        Register a metric.
+
+        :param metric: The metric.
+        :type metric: M
+
+        :raises ValueError: Raised when a metric with the same name is already registered.
+
+        :return: The metric.
+        :rtype: M
+        """
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text format.
+
+        :return: The metrics.
+        :rtype: str
+        """
+        return "".join(i.render() for i in self.metrics.values())
+
+
+class MetricsServer:
+    """
+    The local HTTP endpoint serving the metrics of a registry on /metrics.
+    """
+
+    def __init__(self, registry: Registry, host: str = "127.0.0.1", port: int = 9100) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        """
+        Serve the metrics.
+        This is an internal method and should not be called directly.
+        """
+        return web.Response(text=self.registry.render(), content_type="text/plain")
+
+    async def start(self) -> None:
+        """
+        Start serving the metrics.
+        """
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self) -> None:
+        """
+        Stop serving the metrics.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(
+    Histogram(
+        "token_protector_stage_seconds",
+        "Seconds spent in each stage of the message protection.",
+        labelnames=("stage",),
+    )
+)
+STAGE_BYTES = registry.register(
+    Histogram(
+        "token_protector_stage_bytes",
+        "Bytes processed by each stage of the attachment scan.",
+        BYTE_BUCKETS,
+        labelnames=("stage",),
+    )
+)
+MESSAGES = registry.register(
+    Counter(
+        "token_protector_messages_total",
+        "Messages checked by the protection, by outcome.",
+        labelnames=("outcome",),
+    )
+)
+SCANS = registry.register(
+    Counter(
+        "token_protector_attachment_scans_total",
+        "Attachment scans, by result.",
+        labelnames=("result",),
+    )
+)
+SCANS_WAITING = registry.register(
+    Gauge("token_protector_attachment_scans_waiting", "Attachment scans waiting for a slot.")
+)
+SCANS_RUNNING = registry.register(
+    Gauge("token_protector_attachment_scans_running", "Attachment scans in progress.")
+)
+SCANS_SHED = registry.register(
+    Counter(
+        "token_protector_attachment_scans_shed_total",
+        "Attachment scans dropped by the overloaded scheduler, by priority.",
+        labelnames=("priority",),
+    )
+)
+LOOP_LAG = registry.register(
+    Histogram("token_protector_loop_lag_seconds", "Seconds the event loop woke up late.")
+)
+LOOP_STALLS = registry.register(
+    Counter("token_protector_loop_stalls_total", "Times the event loop was blocked too long.")
+)
+LOOP_STALL_SECONDS = registry.register(
+    Histogram("token_protector_loop_stall_seconds", "Seconds the event loop was blocked.")
+)
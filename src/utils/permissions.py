@@ -0,0 +1,88 @@
+"""
+The cache of the permissions of the bot.
+"""
+
+import itertools
+from typing import Dict
+
+import discord
+
+from src.utils.cache import MISSING, TTLCache
+
+
+class PermissionCache:
+    """
+    The permissions of the bot in each channel, resolved from the roles and the overwrites once
+    instead of on every message.
+    Threads share the entry of their parent channel, as their permissions are inherited. The
+    entries of a channel are dropped when the channel changes, and the entries of a whole guild
+    are dropped at once by moving the guild to a new generation, when its roles, the guild or
+    the bot member change. The ttl bounds how long a missed event leaves an entry stale, the bot
+    member updates are not received without the members intent.
+
+    :ivar cache: The permissions by channel and guild generation.
+    :vartype cache: TTLCache
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 300) -> None:
+        self.cache = TTLCache(size, ttl)
+        self._generations: Dict[int, int] = {}
+        self._counter = itertools.count(1)
+
+    def _key(self, guild_id: int, channel_id: int) -> tuple:
+        """
+        Get the key of a channel in the current generation of its guild.
+        This is an internal method and should not be called directly.
+
+        :param guild_id: The id of the guild.
+        :type guild_id: int
+        :param channel_id: The id of the channel.
+        :type channel_id: int
+
+        :return: The key.
+        :rtype: tuple
+        """
+        return channel_id, self._generations.get(guild_id, 0)
+
+    def permissions_for(
+        self, guild: discord.Guild, channel: discord.abc.GuildChannel
+    ) -> discord.Permissions:
+        """
+        Get the permissions of the bot in a channel, the returned object must not be modified.
+
+        :param guild: The guild of the channel.
+        :type guild: discord.Guild
+        :param channel: The channel or thread.
+        :type channel: discord.abc.GuildChannel
+
+        :return: The permissions of the bot.
+        :rtype: discord.Permissions
+        """
+        channel = getattr(channel, "parent", None) or channel
+        key = self._key(guild.id, channel.id)
+        permissions = self.cache.get(key)
+        if permissions is MISSING:
+            permissions = channel.permissions_for(guild.me)
+            self.cache.set(key, permissions)
+        return permissions
+
+    def invalidate_channel(self, guild_id: int, channel_id: int) -> None:
+        """
+        Drop the permissions of a channel.
+
+        :param guild_id: The id of the guild.
+        :type guild_id: int
+        :param channel_id: The id of the channel.
+        :type channel_id: int
+        """
+        self.cache.pop(self._key(guild_id, channel_id))
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        """
+        Drop the permissions of every channel of a guild, the stale entries are evicted as the
+        cache fills up.
+
+        :param guild_id: The id of the guild.
+        :type guild_id: int
+        """
+        self._generations[guild_id] = next(self._counter)
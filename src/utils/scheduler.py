@@ -0,0 +1,218 @@
+"""
+The scheduler of the attachment scans.
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from src.utils.metrics import SCANS_RUNNING, SCANS_SHED, SCANS_WAITING
+
+T = TypeVar("T")
+
+
+class ScanShed(Exception):
+    """
+    Raised to the caller of a scan that was shed because the scheduler is overloaded.
+    """
+
+
+class ScanScheduler:
+    """
+    Admission control of the attachment scans shared by every guild.
+    At most `concurrency` scans run at once and at most `max_queue` wait. Waiting scans are
+    started by priority, text files before archives, and within a priority the guilds take turns
+    so that one guild cannot starve the others.
+    When the queue is full, the `shed` policy decides which scan is dropped: "newest" rejects the
+    incoming scan, "oldest" drops the oldest waiting scan of the guild with the most waiting scans
+    at the lowest waiting priority, unless the incoming scan has a lower priority than all of them.
+
+    :ivar concurrency: The maximum number of running scans.
+    :vartype concurrency: int
+    :ivar max_queue: The maximum number of waiting scans.
+    :vartype max_queue: int
+    :ivar shed: The shedding policy, "newest" or "oldest".
+    :vartype shed: str
+    :ivar running: The number of running scans.
+    :vartype running: int
+    :ivar shed_count: The number of scans shed.
+    :vartype shed_count: int
+    """
+
+    TEXT = 0
+    ARCHIVE = 1
+    PRIORITY_NAMES = ("text", "archive")
+    SHED_POLICIES = ("newest", "oldest")
+
+    def __init__(self, concurrency: int = 8, max_queue: int = 100, shed: str = "newest") -> None:
+        if shed not in self.SHED_POLICIES:
+            raise ValueError(f"Unknown shed policy {shed!r}, expected 'newest' or 'oldest'")
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.shed = shed
+        self.running = 0
+        self.shed_count = 0
+        # per priority, the waiting scans of each guild in the order the guilds take turns
+        self._queues: List["OrderedDict[Optional[int], Deque[asyncio.Future]]"] = [
+            OrderedDict() for _ in self.PRIORITY_NAMES
+        ]
+        self._queued = 0
+
+    def __len__(self) -> int:
+        return self._queued
+
+    async def run(
+        self, guild_id: Optional[int], priority: int, func: Callable[[], Awaitable[T]]
+    ) -> T:
+        """
+        Run a scan once the scheduler admits it.
+
+        :param guild_id: The id of the guild the scan belongs to.
+        :type guild_id: Optional[int]
+        :param priority: The priority of the scan, TEXT or ARCHIVE.
+        :type priority: int
+        :param func: The function starting the scan.
+        :type func: Callable[[], Awaitable[T]]
+
+        :raises ScanShed: Raised when the scan is shed.
+
+        :return: The result of the scan.
+        :rtype: T
+        """
+        await self._acquire(guild_id, priority)
+        try:
+            return await func()
+        finally:
+            self._release()
+
+    async def _acquire(self, guild_id: Optional[int], priority: int) -> None:
+        """
+        Wait for a slot to run a scan.
+        This is an internal method and should not be called directly.
+
+        :param guild_id: The id of the guild the scan belongs to.
+        :type guild_id: Optional[int]
+        :param priority: The priority of the scan.
+        :type priority: int
+
+        :raises ScanShed: Raised when the scan is shed.
+        """
+        if self.running < self.concurrency and not self._queued:
+            self.running += 1
+            self._update()
+            return
+        if self._queued >= self.max_queue:
+            victim = self._victim(priority)
+            if victim is None:
+                self._count_shed(priority)
+                raise ScanShed("The scan queue is full")
+            victim_guild, victim_priority = victim
+            future = self._queues[victim_priority][victim_guild][0]
+            self._remove(victim_guild, victim_priority, future)
+            # a cancelled scan may still be queued until its task runs again
+            if not future.done():
+                self._count_shed(victim_priority)
+                future.set_exception(ScanShed("The scan was dropped from the full scan queue"))
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(guild_id, deque()).append(future)
+        self._queued += 1
+        self._update()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.done() or future.cancelled():
+                self._remove(guild_id, priority, future)
+            elif future.exception() is None:
+                # the slot was handed over right before the cancellation
+                self._release()
+            raise
+
+    def _victim(self, priority: int) -> Optional[Tuple[Optional[int], int]]:
+        """
+        Choose the waiting scan to drop for an incoming scan, following the shed policy.
+        This is an internal method and should not be called directly.
+
+        :param priority: The priority of the incoming scan.
+        :type priority: int
+
+        :return: The guild and the priority of the queue whose oldest scan is dropped, None to
+            reject the incoming scan instead.
+        :rtype: Optional[Tuple[Optional[int], int]]
+        """
+        if self.shed == "newest":
+            return None
+        for level in range(len(self._queues) - 1, priority - 1, -1):
+            guilds = self._queues[level]
+            if guilds:
+                return max(guilds, key=lambda i: len(guilds[i])), level
+        return None
+
+    def _remove(self, guild_id: Optional[int], priority: int, future: asyncio.Future) -> None:
+        """
+        Remove a scan from the queue, if it is still waiting.
+        This is an internal method and should not be called directly.
+
+        :param guild_id: The id of the guild the scan belongs to.
+        :type guild_id: Optional[int]
+        :param priority: The priority of the scan.
+        :type priority: int
+        :param future: The waiting scan.
+        :type future: asyncio.Future
+        """
+        queue = self._queues[priority].get(guild_id)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self._queued -= 1
+        if not queue:
+            del self._queues[priority][guild_id]
+        self._update()
+
+    def _release(self) -> None:
+        """
+        Free the slot of a finished scan, and start the next waiting scans.
+        This is an internal method and should not be called directly.
+        """
+        self.running -= 1
+        while self.running < self.concurrency and self._queued:
+            for guilds in self._queues:
+                if guilds:
+                    break
+            # the guild at the front takes its turn and goes to the back
+            guild_id, queue = guilds.popitem(last=False)
+            future = queue.popleft()
+            if queue:
+                guilds[guild_id] = queue
+            self._queued -= 1
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+        self._update()
+
+    def _count_shed(self, priority: int) -> None:
+        """
+        Count a shed scan.
+        This is an internal method and should not be called directly.
+
+        :param priority: The priority of the scan.
+        :type priority: int
+        """
+        self.shed_count += 1
+        SCANS_SHED.inc(priority=self.PRIORITY_NAMES[priority])
+
+    def _update(self) -> None:
+        """
+        Publish the queue depth and the running scans.
+        This is an internal method and should not be called directly.
+        """
+        SCANS_WAITING.set(self._queued)
+        SCANS_RUNNING.set(self.running)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the state of the scheduler.
+
+        :return: The running, waiting and shed scans.
+        :rtype: Dict[str, int]
+        """
+        return {"running": self.running, "waiting": self._queued, "shed": self.shed_count}
@@ -2,22 +2,186 @@
 This module contains the functions for token detection.
 """
 
+import asyncio
 import binascii
 import bz2
+import enum
 import gzip
+import hashlib
 import io
+import json
+import logging
+import mimetypes
+import multiprocessing
 import re
 import tarfile
+import time
 import zipfile
 from base64 import b64decode
-from typing import Optional
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import (
+    IO,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
+import aiohttp
 import discord
-import magic
-import py7zr
-import rarfile
 
+from src.client.database import Database
 from src.main import Bot
+from src.utils.cache import MISSING, TTLCache
+from src.utils.metrics import STAGE_BYTES, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+
+class ScanResult(enum.IntEnum):
+    """
+    The result of a scan.
+    Only DETECTED is truthy, so a result can be used where a bool was expected. The results
+    other than CLEAN and DETECTED are inconclusive, part of the file was not scanned.
+    """
+
+    CLEAN = 0
+    DETECTED = 1
+    BUDGET_EXCEEDED = 2
+    TIMED_OUT = 3
+    TRUNCATED = 4
+
+    def __bool__(self) -> bool:
+        return self is ScanResult.DETECTED
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when an archive scan exceeds its budget.
+    """
+
+
+class ScanTimedOut(BudgetExceeded):
+    """
+    Raised when an archive scan runs past its deadline.
+    """
+
+
+class DownloadTruncated(Exception):
+    """
+    Raised when a download is cut off at the maximum attachment size.
+    """
+
+
+class ScanBudget:
+    """
+    The budget of an archive scan, shared by every archive nested in it.
+    The ratio is only enforced once more than `RATIO_FLOOR` bytes have been decompressed, so
+    small but highly compressible files are still scanned.
+
+    :ivar compressed: The size of the outermost archive in bytes.
+    :vartype compressed: int
+    :ivar max_bytes: The maximum number of decompressed bytes.
+    :vartype max_bytes: int
+    :ivar max_ratio: The maximum ratio of decompressed bytes to the size of the archive.
+    :vartype max_ratio: float
+    :ivar max_members: The maximum number of members, counted across nested archives.
+    :vartype max_members: int
+    :ivar max_depth: The maximum nesting depth, the outermost archive is at depth 0.
+    :vartype max_depth: int
+    :ivar deadline: The time.monotonic() deadline of the scan, None for no deadline.
+    :vartype deadline: Optional[float]
+    :ivar used: The number of decompressed bytes so far.
+    :vartype used: int
+    :ivar members: The number of members so far.
+    :vartype members: int
+    """
+
+    RATIO_FLOOR = 1024 * 1024
+
+    def __init__(
+        self,
+        compressed: int,
+        max_bytes: int,
+        max_ratio: float,
+        max_members: int = 100,
+        max_depth: int = 3,
+        deadline: Optional[float] = None,
+    ) -> None:
+        self.compressed = compressed
+        self.max_bytes = max_bytes
+        self.max_ratio = max_ratio
+        self.max_members = max_members
+        self.max_depth = max_depth
+        self.deadline = deadline
+        self.used = 0
+        self.members = 0
+
+    def _exceeded(self, used: int) -> bool:
+        """
+        Whether the amount of decompressed bytes is over the budget.
+        This is an internal method and should not be called directly.
+
+        :param used: The amount of decompressed bytes.
+        :type used: int
+
+        :return: Whether the budget is exceeded.
+        :rtype: bool
+        """
+        return used > self.max_bytes or (
+            used > self.RATIO_FLOOR and used > self.compressed * self.max_ratio
+        )
+
+    def check(self, size: int) -> None:
+        """
+        Check the declared size of a member before it is decompressed, and count the member.
+
+        :param size: The declared size of the member.
+        :type size: int
+
+        :raises BudgetExceeded: Raised when the member would exceed the budget.
+        """
+        self.members += 1
+        if self.members > self.max_members:
+            raise BudgetExceeded(f"more than {self.max_members} members")
+        if self._exceeded(self.used + size):
+            raise BudgetExceeded(f"member of {size} bytes exceeds the budget")
+
+    def enter(self, depth: int) -> None:
+        """
+        Check the depth of a nested archive before it is opened.
+
+        :param depth: The depth of the nested archive.
+        :type depth: int
+
+        :raises BudgetExceeded: Raised when the archive is nested too deep.
+        """
+        if depth > self.max_depth:
+            raise BudgetExceeded(f"archive nested deeper than {self.max_depth}")
+
+    def consume(self, size: int) -> None:
+        """
+        Account for decompressed bytes.
+
+        :param size: The number of bytes decompressed.
+        :type size: int
+
+        :raises BudgetExceeded: Raised when the budget is exceeded.
+        :raises ScanTimedOut: Raised when the deadline has passed.
+        """
+        self.used += size
+        if self._exceeded(self.used):
+            raise BudgetExceeded(f"{self.used} bytes decompressed from {self.compressed} bytes")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise ScanTimedOut(f"deadline passed after {self.used} bytes")
 
 
 class TokenDetector:
@@ -26,7 +190,164 @@ class TokenDetector:
     """
 
     TOKEN_REGEX = re.compile(r"[a-zA-Z0-9_-]{23,28}\.[a-zA-Z0-9_-]{6,7}\.[a-zA-Z0-9_-]{27,}")
-    MIME = magic.Magic(mime=True)
+    TOKEN_REGEX_BYTES = re.compile(TOKEN_REGEX.pattern.encode("ascii"))
+    # the middle part of a token between its two dots, anchored on a literal so it is cheap to
+    # search for, a token always starts at most 28 characters before it
+    MIDDLE_REGEX = re.compile(r"\.[a-zA-Z0-9_-]{6,7}\.")
+    MIDDLE_REGEX_BYTES = re.compile(MIDDLE_REGEX.pattern.encode("ascii"))
+    MIN_TOKEN_LENGTH = 23 + 1 + 6 + 1 + 27
+    # shorter edited content is rescanned whole, which is as fast as finding what changed
+    INCREMENTAL_MIN_LENGTH = 512
+    # the characters a token is made of, a token never spans any other character
+    TOKEN_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-.")
+    _magic: Optional[Any] = None
+    MAX_ATTACHMENT_SIZE = 25 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    CHUNK_OVERLAP = 256
+    MAX_MEMBERS = 25
+    SNIFF_SIZE = 4 * 1024
+    SKIPPED_TYPES = ("image/", "video/", "audio/")
+    ARCHIVE_FORMATS = (
+        ("/zip", "zip"),
+        ("/x-7z-compressed", "7z"),
+        ("/x-rar", "rar"),
+        ("/x-tar", "tar"),
+        ("/gzip", "gzip"),
+        ("/x-gzip", "gzip"),
+        ("x-bzip2", "bz2"),
+    )
+
+    executor: Optional[Executor] = None
+    scan_timeout: float = 30.0
+    archive_max_bytes: int = 100 * 1024 * 1024
+    archive_max_ratio: float = 100.0
+    archive_max_members: int = 100
+    archive_max_depth: int = 3
+    prefilter_rejections: Dict[str, int] = {"length": 0, "dots": 0, "middle": 0}
+    validation_cache = TTLCache(10000)
+    positive_ttl: float = 86400.0
+    negative_ttl: float = 600.0
+    validation_concurrency: int = 5
+    _inflight: Dict[int, asyncio.Future] = {}
+
+    @classmethod
+    def configure(
+        cls,
+        executor: str = "thread",
+        workers: Optional[int] = None,
+        timeout: float = 30.0,
+        archive_max_bytes: int = 100 * 1024 * 1024,
+        archive_max_ratio: float = 100.0,
+        archive_max_members: int = 100,
+        archive_max_depth: int = 3,
+    ) -> None:
+        """
+        Configure the executor that runs the CPU-bound scanning, and the limits of a scan.
+        The worker processes are spawned rather than forked, forking the threads of the bot
+        could leave a lock held forever in the child. The prefilter rejections counted in the
+        worker processes are not added to `prefilter_rejections` of the bot.
+
+        :param executor: The kind of executor, "process" or "thread".
+        :type executor: str
+        :param workers: The number of workers, defaults to the executor's own default.
+        :type workers: Optional[int]
+        :param timeout: The wall-clock timeout of a single scan in seconds.
+        :type timeout: float
+        :param archive_max_bytes: The decompressed bytes budget of an archive.
+        :type archive_max_bytes: int
+        :param archive_max_ratio: The compression ratio budget of an archive.
+        :type archive_max_ratio: float
+        :param archive_max_members: The members budget of an archive, nested ones included.
+        :type archive_max_members: int
+        :param archive_max_depth: The nesting depth budget of an archive.
+        :type archive_max_depth: int
+
+        :raises ValueError: Raised when the kind of executor is unknown.
+        """
+        if executor not in ("process", "thread"):
+            raise ValueError(f"Unknown executor {executor!r}, expected 'process' or 'thread'")
+        cls.shutdown()
+        if executor == "process":
+            cls.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            cls.executor = ThreadPoolExecutor(max_workers=workers)
+        cls.scan_timeout = timeout
+        cls.archive_max_bytes = archive_max_bytes
+        cls.archive_max_ratio = archive_max_ratio
+        cls.archive_max_members = archive_max_members
+        cls.archive_max_depth = archive_max_depth
+
+    @classmethod
+    def configure_validation(
+        cls,
+        cache_size: int = 10000,
+        positive_ttl: float = 86400.0,
+        negative_ttl: float = 600.0,
+        concurrency: int = 5,
+    ) -> None:
+        """
+        Configure the cache and the concurrency of the user id validation.
+
+        :param cache_size: The number of user ids to cache.
+        :type cache_size: int
+        :param positive_ttl: The seconds a user id that belongs to a bot is cached.
+        :type positive_ttl: float
+        :param negative_ttl: The seconds a user id that does not belong to a bot is cached.
+        :type negative_ttl: float
+        :param concurrency: The number of user ids of one scan looked up at once.
+        :type concurrency: int
+        """
+        cls.validation_cache = TTLCache(cache_size)
+        cls.positive_ttl = positive_ttl
+        cls.negative_ttl = negative_ttl
+        cls.validation_concurrency = concurrency
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """
+        Shut down the executor, the pending scans are cancelled.
+        """
+        if cls.executor is not None:
+            cls.executor.shutdown(wait=False, cancel_futures=True)
+            cls.executor = None
+
+    @classmethod
+    def sniff(cls, data: bytes) -> str:
+        """
+        Get the MIME type of the data with libmagic.
+        libmagic and the archive backends are only imported when they are first needed, so the
+        bot starts without them when attachments are not checked.
+
+        :param data: The head of the file.
+        :type data: bytes
+
+        :return: The MIME type.
+        :rtype: str
+        """
+        if cls._magic is None:
+            import magic
+
+            cls._magic = magic.Magic(mime=True)
+        return cls._magic.from_buffer(data)
+
+    @staticmethod
+    def decode_user_id(token: str) -> Optional[int]:
+        """
+        Decode the user id from the first part of the token, without any network lookup.
+
+        :param token: The possible token.
+        :type token: str
+
+        :return: The user id, or None if the first part is not an encoded user id.
+        :rtype: Optional[int]
+        """
+        try:
+            decoded = b64decode(token.split(".")[0] + "==")
+        except binascii.Error:
+            return None
+        return int(decoded) if decoded.isdigit() else None
 
     async def validate(token: str, client: Optional[Bot] = None) -> bool:
         """
@@ -40,16 +361,133 @@ class TokenDetector:
         :return: Whether the token is valid.
         :rtype: bool
         """
+        user_id = TokenDetector.decode_user_id(token)
+        if not client or user_id is None:
+            return user_id is not None
+        return await TokenDetector.is_bot(user_id, client)
+
+    @classmethod
+    async def is_bot(cls, user_id: int, client: Bot) -> bool:
+        """
+        Determine whether the user id belongs to a bot.
+        Results are cached, and concurrent lookups of the same user id share one request.
+
+        :param user_id: The user id.
+        :type user_id: int
+        :param client: The bot client used to look up the user.
+        :type client: Bot
+
+        :return: Whether the user is a bot.
+        :rtype: bool
+        """
+        cached = cls.validation_cache.get(user_id)
+        if cached is not MISSING:
+            return cached
+        future = cls._inflight.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(cls._fetch_is_bot(user_id, client))
+            cls._inflight[user_id] = future
+            future.add_done_callback(lambda _: cls._inflight.pop(user_id, None))
+        # shielded so a cancelled caller does not cancel the lookup shared with the others
+        return await asyncio.shield(future)
+
+    @classmethod
+    async def _fetch_is_bot(cls, user_id: int, client: Bot) -> bool:
+        """
+        Look up whether the user id belongs to a bot and cache the result.
+        Only a user that exists or a user id that is not found is cached, a failed request says
+        nothing about the user and is looked up again by the next scan.
+        This is an internal method and should not be called directly.
+
+        :param user_id: The user id.
+        :type user_id: int
+        :param client: The bot client used to look up the user.
+        :type client: Bot
+
+        :return: Whether the user is a bot, False if the lookup failed.
+        :rtype: bool
+        """
+        user = client.get_user(user_id)
+        if user is None:
+            with STAGE_SECONDS.time(stage="validate"):
+                try:
+                    user = await client.fetch_user(user_id)
+                except discord.NotFound:
+                    pass
+                except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning(f"Failed to look up user {user_id}: {e!r}")
+                    return False
+        result = user is not None and user.bot
+        cls.validation_cache.set(
+            user_id, result, ttl=cls.positive_ttl if result else cls.negative_ttl
+        )
+        return result
+
+    @classmethod
+    def prefilter(cls, content: Union[str, bytes, bytearray, memoryview]) -> int:
+        """
+        Run the cheap checks that reject content which cannot contain a token, before the token
+        regex runs. The stages are a length gate, a dot count and a search for the middle part
+        of a token, the number of inputs rejected by each stage is kept in
+        `prefilter_rejections`.
+
+        :param content: The content to check.
+        :type content: str | bytes | bytearray | memoryview
+
+        :return: The position to start the token search from, or -1 if the content is rejected.
+        :rtype: int
+        """
+        is_str = isinstance(content, str)
+        if len(content) < cls.MIN_TOKEN_LENGTH:
+            stage = "length"
+        elif not isinstance(content, memoryview) and content.count("." if is_str else b".") < 2:
+            stage = "dots"
+        else:
+            match = (cls.MIDDLE_REGEX if is_str else cls.MIDDLE_REGEX_BYTES).search(content)
+            if match:
+                return max(match.start() - 28, 0)
+            stage = "middle"
+        cls.prefilter_rejections[stage] += 1
+        return -1
+
+    @classmethod
+    async def validate_any(cls, tokens: Iterable[str], client: Optional[Bot] = None) -> bool:
+        """
+        Determine whether any of the possible tokens is valid.
+        The tokens are deduplicated by their user id and checked offline first, the remaining
+        user ids are then looked up concurrently, up to `validation_concurrency` at a time, and
+        the lookups left are cancelled as soon as one is confirmed.
+
+        :param tokens: The possible tokens to validate.
+        :type tokens: Iterable[str]
+        :param client: The bot client, will be used to validate user id if provided.
+        :type client: Optional[Bot]
+
+        :return: Whether a token is valid.
+        :rtype: bool
+        """
+        user_ids = {cls.decode_user_id(i) for i in tokens}
+        user_ids.discard(None)
+        if not client or not user_ids:
+            return bool(user_ids)
+        if len(user_ids) == 1:
+            return await cls.is_bot(user_ids.pop(), client)
+
+        semaphore = asyncio.Semaphore(cls.validation_concurrency)
+
+        async def check(user_id: int) -> bool:
+            async with semaphore:
+                return await cls.is_bot(user_id, client)
+
+        tasks = [asyncio.create_task(check(i)) for i in user_ids]
         try:
-            decoded = b64decode(token.split(".")[0] + "==")
-        except binascii.Error:
+            for future in asyncio.as_completed(tasks):
+                if await future:
+                    return True
             return False
-        else:
-            isdigit = decoded.isdigit()
-            if not client or not isdigit:
-                return isdigit
-            user = await client.get_or_fetch_user(int(decoded))
-            return user is not None and user.bot
+        finally:
+            for task in tasks:
+                task.cancel()
 
     @classmethod
     async def detect(cls, content: str, client: Optional[Bot] = None) -> bool:
@@ -64,34 +502,498 @@ class TokenDetector:
         :return: Whether the token is detected.
         :rtype: bool
         """
-        possible_tokens = cls.TOKEN_REGEX.findall(content)
-        for token in possible_tokens:
-            if await cls.validate(token, client):
-                return True
-        return False
+        tokens = cls.find_tokens(content, client is None)
+        if not tokens:
+            return False
+        return await cls.validate_any(tokens, client)
 
     @classmethod
-    async def decoder_search(cls, data: bytes, client: Optional[Bot] = None) -> bool:
+    async def detect_edit(cls, previous: str, content: str, client: Optional[Bot] = None) -> bool:
         """
-        Search for tokens in the encoded data.
+        Determine whether the edited content contains a token, given that the previous content
+        was scanned and contained none. Only the region returned by :meth:`changed_region` is
+        searched, unless the content is short.
+
+        :param previous: The previous content, scanned without a detected token.
+        :type previous: str
+        :param content: The edited content.
+        :type content: str
+        :param client: The bot client, will be used to validate user id if provided.
+        :type client: Optional[Bot]
+
+        :return: Whether the token is detected.
+        :rtype: bool
+        """
+        if len(content) < cls.INCREMENTAL_MIN_LENGTH:
+            return await cls.detect(content, client)
+        start, end = cls.changed_region(previous, content)
+        if end - start < cls.MIN_TOKEN_LENGTH:
+            return False
+        return await cls.detect(content[start:end], client)
+
+    @classmethod
+    def changed_region(cls, previous: str, content: str) -> Tuple[int, int]:
+        """
+        Get the region of the edited content that may contain a token the previous content did
+        not. The changed characters are found from the common prefix and suffix, then widened
+        to the runs of token characters around them, since a token cannot span any other
+        character and the runs outside the region are the same as before.
+
+        :param previous: The previous content.
+        :type previous: str
+        :param content: The edited content.
+        :type content: str
+
+        :return: The start and the end of the region, empty if only other characters changed.
+        :rtype: Tuple[int, int]
+        """
+        if previous == content:
+            return len(content), len(content)
+        limit = min(len(previous), len(content))
+        # binary searches, as comparing slices is much faster than comparing characters
+        low, high = 0, limit
+        while low < high:
+            middle = (low + high + 1) // 2
+            if previous[:middle] == content[:middle]:
+                low = middle
+            else:
+                high = middle - 1
+        start = low
+        low, high = 0, limit - start
+        while low < high:
+            middle = (low + high + 1) // 2
+            if previous[len(previous) - middle :] == content[len(content) - middle :]:
+                low = middle
+            else:
+                high = middle - 1
+        end = len(content) - low
+        while start > 0 and content[start - 1] in cls.TOKEN_CHARS:
+            start -= 1
+        while end < len(content) and content[end] in cls.TOKEN_CHARS:
+            end += 1
+        return start, end
+
+    @classmethod
+    def find_tokens(
+        cls, data: Union[str, bytes, bytearray, memoryview], stop_at_first: bool = False
+    ) -> List[str]:
+        """
+        Find the unique possible tokens in the content that pass the offline user id check.
+        This is the candidate stage shared by text, attachment and archive scanning, it is
+        synchronous and safe to run in an executor.
+
+        :param data: The content, or the encoded data, to search.
+        :type data: str | bytes | bytearray | memoryview
+        :param stop_at_first: Whether to stop at the first possible token.
+        :type stop_at_first: bool
+
+        :return: The unique possible tokens.
+        :rtype: List[str]
+        """
+        found = {}
+        start = cls.prefilter(data)
+        if start < 0:
+            return []
+        is_str = isinstance(data, str)
+        for match in (cls.TOKEN_REGEX if is_str else cls.TOKEN_REGEX_BYTES).finditer(data, start):
+            token = match.group() if is_str else match.group().decode("ascii")
+            if token not in found and cls.decode_user_id(token) is not None:
+                found[token] = None
+                if stop_at_first:
+                    break
+        return list(found)
+
+    @classmethod
+    def find_tokens_until(cls, data: bytes, stop_at_first: bool, deadline: float) -> List[str]:
+        """
+        Find the unique possible tokens like :meth:`find_tokens`, one chunk at a time, and stop
+        once the deadline has passed. This is the search run in the executor, a timed out job
+        would otherwise keep its worker busy until the end of the data.
 
         :param data: The encoded data to search.
         :type data: bytes
+        :param stop_at_first: Whether to stop at the first possible token.
+        :type stop_at_first: bool
+        :param deadline: The time.monotonic() time to stop at.
+        :type deadline: float
+
+        :raises ScanTimedOut: Raised when the deadline has passed.
+
+        :return: The unique possible tokens.
+        :rtype: List[str]
+        """
+        scanner = ChunkScanner()
+        view = memoryview(data)
+        found = []
+        for start in range(0, len(data), cls.CHUNK_SIZE):
+            if time.monotonic() > deadline:
+                raise ScanTimedOut(f"deadline passed after {start} bytes")
+            found += scanner.feed(view[start : start + cls.CHUNK_SIZE])
+            if found and stop_at_first:
+                return found
+        return found + scanner.flush()
+
+    @classmethod
+    async def decoder_search(
+        cls, data: Union[bytes, bytearray, memoryview], client: Optional[Bot] = None
+    ) -> bool:
+        """
+        Search for tokens in the encoded data.
+        The raw bytes are scanned directly, since the token alphabet is pure ASCII the data does
+        not need to be decoded, nor be valid UTF-8.
+        Data larger than a chunk is searched in the executor, up to the scan timeout.
+
+        :param data: The encoded data to search.
+        :type data: bytes | bytearray | memoryview
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
 
         :return: Whether the token is detected.
         :rtype: bool
         """
-        try:
-            content = data.decode("utf-8")
-        except UnicodeDecodeError:
+        if len(data) <= cls.CHUNK_SIZE:
+            tokens = cls.find_tokens(data, client is None)
+        else:
+            try:
+                tokens = await cls._run(
+                    cls.find_tokens_until,
+                    bytes(data),
+                    client is None,
+                    time.monotonic() + cls.scan_timeout,
+                )
+            except (asyncio.TimeoutError, ScanTimedOut):
+                logger.warning(f"Scanning {len(data)} bytes timed out after {cls.scan_timeout}s")
+                return False
+        if not tokens:
             return False
+        return await cls.validate_any(tokens, client)
+
+    @classmethod
+    async def _run(cls, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run a CPU-bound function in the executor, bounded by the scan timeout.
+        A timeout only stops the wait, the function keeps its worker until it returns, so every
+        function run here must stop itself at a deadline of its own: the archive scans through
+        their ScanBudget and decoder_search through :meth:`find_tokens_until`.
+        This is an internal method and should not be called directly.
+
+        :param func: The function to run, it must be picklable for a process pool.
+        :type func: Callable[..., T]
+        :param args: The arguments of the function.
+        :type args: Any
+
+        :raises asyncio.TimeoutError: Raised when the function does not finish in time.
+
+        :return: The result of the function.
+        :rtype: T
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(cls.executor, func, *args)
+        return await asyncio.wait_for(future, cls.scan_timeout)
+
+    @classmethod
+    def _iter_zip(cls, file_obj: io.BytesIO, budget: ScanBudget) -> Iterator[IO[bytes]]:
+        """
+        Yield the members of the zip archive as streams.
+        This is an internal method and should not be called directly.
+
+        :param file_obj: The zip archive.
+        :type file_obj: io.BytesIO
+        :param budget: The budget the declared member sizes are checked against.
+        :type budget: ScanBudget
+
+        :return: The streams of the members.
+        :rtype: Iterator[IO[bytes]]
+        """
+        zf = zipfile.ZipFile(file_obj)
+        for i in zf.infolist()[: cls.MAX_MEMBERS]:
+            if not i.is_dir():
+                budget.check(i.file_size)
+                yield zf.open(i)
+
+    @classmethod
+    def _iter_7z(cls, file_obj: io.BytesIO, budget: ScanBudget) -> Iterator[IO[bytes]]:
+        """
+        Yield the members of the 7z archive as streams.
+        py7zr can only extract whole members, so each member is checked against the budget
+        with its declared size before it is extracted.
+        This is an internal method and should not be called directly.
+
+        :param file_obj: The 7z archive.
+        :type file_obj: io.BytesIO
+        :param budget: The budget the declared member sizes are checked against.
+        :type budget: ScanBudget
+
+        :return: The streams of the members.
+        :rtype: Iterator[IO[bytes]]
+        """
+        import py7zr
+
+        zf = py7zr.SevenZipFile(file_obj)
+        for i in zf.list()[: cls.MAX_MEMBERS]:
+            if not i.is_directory:
+                budget.check(i.uncompressed)
+                zf.reset()
+                yield zf.read([i.filename])[i.filename]
+
+    @classmethod
+    def _iter_rar(cls, file_obj: io.BytesIO, budget: ScanBudget) -> Iterator[IO[bytes]]:
+        """
+        Yield the members of the rar archive as streams.
+        This is an internal method and should not be called directly.
+
+        :param file_obj: The rar archive.
+        :type file_obj: io.BytesIO
+        :param budget: The budget the declared member sizes are checked against.
+        :type budget: ScanBudget
+
+        :return: The streams of the members.
+        :rtype: Iterator[IO[bytes]]
+        """
+        import rarfile
+
+        zf = rarfile.RarFile(file_obj)
+        for i in zf.infolist()[: cls.MAX_MEMBERS]:
+            if not i.is_dir():
+                budget.check(i.file_size)
+                yield zf.open(i)
+
+    @classmethod
+    def _iter_tar(cls, file_obj: IO[bytes], budget: ScanBudget) -> Iterator[IO[bytes]]:
+        """
+        Yield the members of the tar archive as streams, the archive is read sequentially.
+        This is an internal method and should not be called directly.
+
+        :param file_obj: The tar archive.
+        :type file_obj: IO[bytes]
+        :param budget: The budget the declared member sizes are checked against.
+        :type budget: ScanBudget
+
+        :return: The streams of the members.
+        :rtype: Iterator[IO[bytes]]
+        """
+        zf = tarfile.open(fileobj=file_obj, mode="r|")
+        for count, i in enumerate(zf):
+            if count >= cls.MAX_MEMBERS:
+                break
+            if i.isfile():
+                budget.check(i.size)
+                yield zf.extractfile(i)
+
+    @classmethod
+    def _iter_compressed(cls, stream: IO[bytes], budget: ScanBudget) -> Iterator[IO[bytes]]:
+        """
+        Yield the members of a decompressing stream if it is a tar archive, or the stream itself.
+        This is an internal method and should not be called directly.
+
+        :param stream: The decompressing stream, it must support seeking back to the start.
+        :type stream: IO[bytes]
+        :param budget: The budget the declared member sizes are checked against.
+        :type budget: ScanBudget
+
+        :return: The streams of the members.
+        :rtype: Iterator[IO[bytes]]
+        """
+        try:
+            members = cls._iter_tar(stream, budget)
+            first = next(members, None)
+        except tarfile.TarError:
+            stream.seek(0)
+            yield stream
         else:
-            return await cls.detect(content, client)
+            if first is not None:
+                yield first
+                yield from members
+
+    @classmethod
+    def _iter_gzip(cls, file_obj: io.BytesIO, budget: ScanBudget) -> Iterator[IO[bytes]]:
+        """
+        Yield the gzip stream, or its members as streams if it is a tar archive.
+        This is an internal method and should not be called directly.
+
+        :param file_obj: The gzip stream.
+        :type file_obj: io.BytesIO
+        :param budget: The budget the declared member sizes are checked against.
+        :type budget: ScanBudget
+
+        :return: The streams of the members.
+        :rtype: Iterator[IO[bytes]]
+        """
+        yield from cls._iter_compressed(gzip.GzipFile(fileobj=file_obj), budget)
+
+    @classmethod
+    def _iter_bz2(cls, file_obj: io.BytesIO, budget: ScanBudget) -> Iterator[IO[bytes]]:
+        """
+        Yield the bz2 stream, or its members as streams if it is a tar archive.
+        This is an internal method and should not be called directly.
+
+        :param file_obj: The bz2 stream.
+        :type file_obj: io.BytesIO
+        :param budget: The budget the declared member sizes are checked against.
+        :type budget: ScanBudget
+
+        :return: The streams of the members.
+        :rtype: Iterator[IO[bytes]]
+        """
+        yield from cls._iter_compressed(bz2.BZ2File(file_obj), budget)
+
+    @classmethod
+    def archive_format(cls, ft: str) -> Optional[str]:
+        """
+        Get the archive format of a MIME type.
+
+        :param ft: The MIME type.
+        :type ft: str
+
+        :return: The format, one of the values of ARCHIVE_FORMATS, or None if not an archive.
+        :rtype: Optional[str]
+        """
+        for suffix, fmt in cls.ARCHIVE_FORMATS:
+            if ft.endswith(suffix):
+                return fmt
+        return None
+
+    @classmethod
+    def new_budget(cls, size: int) -> ScanBudget:
+        """
+        Create the budget of an archive scan from the configured limits.
+
+        :param size: The size of the archive in bytes.
+        :type size: int
+
+        :return: The budget, with its deadline set from the scan timeout.
+        :rtype: ScanBudget
+        """
+        return ScanBudget(
+            size,
+            cls.archive_max_bytes,
+            cls.archive_max_ratio,
+            cls.archive_max_members,
+            cls.archive_max_depth,
+            time.monotonic() + cls.scan_timeout,
+        )
+
+    @classmethod
+    def collect_archive(
+        cls,
+        fmt: str,
+        data: bytes,
+        stop_at_first: bool = False,
+        budget: Optional[ScanBudget] = None,
+    ) -> Tuple[List[str], ScanResult]:
+        """
+        Decompress the archive and find the possible tokens in its members.
+        Members are read as streams and sniffed, nested archives and compressed streams are
+        scanned recursively and everything else is scanned chunk by chunk. The scan stops once
+        the budget shared by the whole tree is exceeded.
+        This method is synchronous and safe to run in an executor.
+
+        :param fmt: The format of the archive, one of the values of ARCHIVE_FORMATS.
+        :type fmt: str
+        :param data: The archive.
+        :type data: bytes
+        :param stop_at_first: Whether to stop at the first possible token.
+        :type stop_at_first: bool
+        :param budget: The budget of the scan, defaults to a new budget from the configuration.
+        :type budget: Optional[ScanBudget]
+
+        :return: The unique possible tokens, and CLEAN if the whole archive was scanned,
+            BUDGET_EXCEEDED or TIMED_OUT if the scan stopped early.
+        :rtype: Tuple[List[str], ScanResult]
+        """
+        budget = budget or cls.new_budget(len(data))
+        found: Dict[str, None] = {}
+        try:
+            cls._collect(fmt, io.BytesIO(data), budget, 0, found, stop_at_first)
+        except ScanTimedOut:
+            return list(found), ScanResult.TIMED_OUT
+        except BudgetExceeded:
+            return list(found), ScanResult.BUDGET_EXCEEDED
+        except Exception:
+            pass
+        return list(found), ScanResult.CLEAN
+
+    @classmethod
+    def _collect(
+        cls,
+        fmt: str,
+        file_obj: IO[bytes],
+        budget: ScanBudget,
+        depth: int,
+        found: Dict[str, None],
+        stop_at_first: bool,
+    ) -> None:
+        """
+        Find the possible tokens in the members of an archive, recursing into nested archives.
+        This is an internal method and should not be called directly.
+
+        :param fmt: The format of the archive, one of the values of ARCHIVE_FORMATS.
+        :type fmt: str
+        :param file_obj: The archive.
+        :type file_obj: IO[bytes]
+        :param budget: The budget shared by the whole tree.
+        :type budget: ScanBudget
+        :param depth: The depth of the archive.
+        :type depth: int
+        :param found: The possible tokens found so far, updated in place.
+        :type found: Dict[str, None]
+        :param stop_at_first: Whether to stop at the first possible token.
+        :type stop_at_first: bool
+
+        :raises BudgetExceeded: Raised when the budget is exceeded.
+        """
+        budget.enter(depth)
+        for member in getattr(cls, f"_iter_{fmt}")(file_obj, budget):
+            head = member.read(cls.CHUNK_SIZE)
+            budget.consume(len(head))
+            nested = cls.archive_format(cls.sniff(head[: cls.SNIFF_SIZE])) if head else None
+            if nested is not None:
+                buffer = bytearray(head)
+                for chunk in iter(lambda: member.read(cls.CHUNK_SIZE), b""):
+                    budget.consume(len(chunk))
+                    buffer += chunk
+                cls._collect(nested, io.BytesIO(buffer), budget, depth + 1, found, stop_at_first)
+            else:
+                scanner = ChunkScanner()
+                chunk = head
+                while chunk and not (stop_at_first and found):
+                    found.update(dict.fromkeys(scanner.feed(chunk)))
+                    chunk = member.read(cls.CHUNK_SIZE)
+                    budget.consume(len(chunk))
+                found.update(dict.fromkeys(scanner.flush()))
+            if stop_at_first and found:
+                return
 
     @classmethod
-    async def scan_zip(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> bool:
+    async def _scan_format(cls, fmt: str, data: bytes, client: Optional[Bot] = None) -> ScanResult:
+        """
+        Scan the archive for tokens in the executor.
+        This is an internal method and should not be called directly.
+
+        :param fmt: The format of the archive, one of the values of ARCHIVE_FORMATS.
+        :type fmt: str
+        :param data: The archive.
+        :type data: bytes
+        :param client: The bot client, will be used to validate user id if provided.
+        :type client: Optional[Bot]
+
+        :return: The result of the scan.
+        :rtype: ScanResult
+        """
+        try:
+            tokens, result = await cls._run(
+                cls.collect_archive, fmt, data, client is None, cls.new_budget(len(data))
+            )
+        except asyncio.TimeoutError:
+            result, tokens = ScanResult.TIMED_OUT, []
+        if await cls.validate_any(tokens, client):
+            return ScanResult.DETECTED
+        if result is not ScanResult.CLEAN:
+            logger.warning(f"Scanning {fmt} archive of {len(data)} bytes stopped: {result.name}")
+        return result
+
+    @classmethod
+    async def scan_zip(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> ScanResult:
         """
         Scan the zip archive for tokens.
 
@@ -100,23 +1002,13 @@ class TokenDetector:
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
 
-        :return: Whether the token is detected.
-        :rtype: bool
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
         """
-        try:
-            zf = zipfile.ZipFile(file_obj)
-        except Exception:
-            return False
-        else:
-            files = zf.namelist()
-            files = files if len(files) <= 25 else files[:25]
-            for i in files:
-                if await cls.decoder_search(zf.read(i), client):
-                    return True
-            return False
+        return await cls._scan_format("zip", file_obj.getvalue(), client)
 
     @classmethod
-    async def scan_7z(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> bool:
+    async def scan_7z(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> ScanResult:
         """
         Scan the 7z archive for tokens.
 
@@ -125,23 +1017,13 @@ class TokenDetector:
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
 
-        :return: Whether the token is detected.
-        :rtype: bool
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
         """
-        try:
-            zf = py7zr.SevenZipFile(file_obj)
-        except Exception:
-            return
-        else:
-            files = zf.getnames()
-            files = files if len(files) <= 25 else files[:25]
-            for i in files:
-                if await cls.decoder_search(zf.read(i)[i].read(), client):
-                    return True
-            return False
+        return await cls._scan_format("7z", file_obj.getvalue(), client)
 
     @classmethod
-    async def scan_rar(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> bool:
+    async def scan_rar(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> ScanResult:
         """
         Scan the rar archive for tokens.
 
@@ -150,23 +1032,13 @@ class TokenDetector:
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
 
-        :return: Whether the token is detected.
-        :rtype: bool
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
         """
-        try:
-            zf = rarfile.RarFile(file_obj)
-        except Exception:
-            return False
-        else:
-            files = zf.namelist()
-            files = files if len(files) <= 25 else files[:25]
-            for i in files:
-                if await cls.decoder_search(zf.read(i), client):
-                    return True
-            return False
+        return await cls._scan_format("rar", file_obj.getvalue(), client)
 
     @classmethod
-    async def scan_tar(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> bool:
+    async def scan_tar(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> ScanResult:
         """
         Scan the tar archive for tokens.
 
@@ -175,24 +1047,13 @@ class TokenDetector:
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
 
-        :return: Whether the token is detected.
-        :rtype: bool
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
         """
-        try:
-            file_obj.seek(0)
-            zf = tarfile.open(fileobj=file_obj)
-        except Exception:
-            return False
-        else:
-            files = zf.getmembers()
-            files = files if len(files) <= 25 else files[:25]
-            for i in files:
-                if await cls.decoder_search(zf.extractfile(i).read(), client):
-                    return True
-            return False
+        return await cls._scan_format("tar", file_obj.getvalue(), client)
 
     @classmethod
-    async def scan_gzip(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> bool:
+    async def scan_gzip(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> ScanResult:
         """
         Scan the gzip archive for tokens.
 
@@ -201,23 +1062,13 @@ class TokenDetector:
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
 
-        :return: Whether the token is detected.
-        :rtype: bool
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
         """
-        try:
-            buf = gzip.decompress(file_obj.read())
-        except Exception:
-            return False
-        else:
-            zf = io.BytesIO(buf)
-            return (
-                await cls.scan_tar(zf)
-                if tarfile.is_tarfile(zf)
-                else await cls.decoder_search(buf, client)
-            )
+        return await cls._scan_format("gzip", file_obj.getvalue(), client)
 
     @classmethod
-    async def scan_bz2(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> bool:
+    async def scan_bz2(cls, file_obj: io.BytesIO, client: Optional[Bot] = None) -> ScanResult:
         """
         Scan the bz2 archive for tokens.
 
@@ -226,23 +1077,15 @@ class TokenDetector:
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
 
-        :return: Whether the token is detected.
-        :rtype: bool
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
         """
-        try:
-            buf = bz2.decompress(file_obj.read())
-        except Exception:
-            return False
-        else:
-            zf = io.BytesIO(buf)
-            return (
-                await cls.scan_tar(zf)
-                if tarfile.is_tarfile(zf)
-                else await cls.decoder_search(buf, client)
-            )
+        return await cls._scan_format("bz2", file_obj.getvalue(), client)
 
     @classmethod
-    async def scan_archive(cls, ft: str, buffer: bytes, client: Optional[Bot] = None) -> bool:
+    async def scan_archive(
+        cls, ft: str, buffer: bytes, client: Optional[Bot] = None
+    ) -> ScanResult:
         """
         Scan the archive for tokens.
 
@@ -253,23 +1096,156 @@ class TokenDetector:
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
 
-        :return: Whether the token is detected.
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
+        """
+        fmt = cls.archive_format(ft)
+        if fmt is None:
+            return ScanResult.CLEAN
+        STAGE_BYTES.observe(len(buffer), stage="archive")
+        with STAGE_SECONDS.time(stage="archive"):
+            return await cls._scan_format(fmt, buffer, client)
+
+    @classmethod
+    async def scan_stream(
+        cls,
+        stream: AsyncIterator[bytes],
+        check_textfile: bool,
+        check_archive: bool,
+        client: Optional[Bot] = None,
+        cache: Optional["ScanCache"] = None,
+        url: Optional[str] = None,
+    ) -> ScanResult:
+        """
+        Scan a file received in chunks for tokens.
+        Text files are scanned chunk by chunk and the rest of the stream is not consumed once a
+        token is detected, archives are buffered before being scanned. When the stream raises
+        :class:`DownloadTruncated`, the data received is scanned and a clean result is reported
+        as TRUNCATED.
+        With a cache, archives whose content was scanned before are not scanned again, and the
+        complete results are stored under the content hash and the url of the file.
+
+        :param stream: The chunks of the file.
+        :type stream: AsyncIterator[bytes]
+        :param check_textfile: Whether to check text files.
+        :type check_textfile: bool
+        :param check_archive: Whether to check archives.
+        :type check_archive: bool
+        :param client: The bot client, will be used to validate user id if provided.
+        :type client: Optional[Bot]
+        :param cache: The cache of scan results.
+        :type cache: Optional[ScanCache]
+        :param url: The url of the file, to remember the result of this file in the cache.
+        :type url: Optional[str]
+
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
+        """
+        if not check_textfile:
+            return ScanResult.CLEAN
+        truncated = False
+
+        async def receive() -> AsyncIterator[bytes]:
+            nonlocal truncated
+            try:
+                async for chunk in stream:
+                    yield chunk
+            except DownloadTruncated:
+                truncated = True
+
+        chunks = receive()
+        head = b""
+        async for chunk in chunks:
+            head += chunk
+            if len(head) >= cls.CHUNK_SIZE:
+                break
+        # the header is enough to tell text and archives apart
+        with STAGE_SECONDS.time(stage="sniff"):
+            ft = cls.sniff(head[: cls.SNIFF_SIZE])
+
+        digest, size, complete = hashlib.sha256(head), len(head), True
+        if ft.startswith("text"):
+            scanner = ChunkScanner()
+            # the rest of the file is not downloaded once a token is detected, so the content
+            # hash is incomplete and the result is not cached
+            result = ScanResult(await cls.validate_any(scanner.feed(head), client))
+            complete = not result
+            if complete:
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    if await cls.validate_any(scanner.feed(chunk), client):
+                        result, complete = ScanResult.DETECTED, False
+                        break
+                else:
+                    result = ScanResult(await cls.validate_any(scanner.flush(), client))
+        elif check_archive and ft.startswith("application"):
+            buffer = bytearray(head)
+            async for chunk in chunks:
+                digest.update(chunk)
+                buffer += chunk
+            size = len(buffer)
+            result = None
+            if cache is not None:
+                result = await cache.get(ScanCache.key(digest.hexdigest(), size))
+            if result is None:
+                result = await cls.scan_archive(ft, bytes(buffer), client)
+        else:
+            result, complete = ScanResult.CLEAN, False
+
+        STAGE_BYTES.observe(size, stage="download")
+        if truncated:
+            # the end of the file was not scanned, it may hold a token
+            logger.warning(f"Downloading {url or 'a file'} stopped after {size} bytes")
+            complete = False
+            if result is ScanResult.CLEAN:
+                result = ScanResult.TRUNCATED
+        if cache is not None and complete:
+            await cache.set(ScanCache.key(digest.hexdigest(), size), result, url)
+        return result
+
+    @staticmethod
+    def declared_type(attachment: discord.Attachment) -> Optional[str]:
+        """
+        Get the MIME type of an attachment from its metadata, without downloading it.
+
+        :param attachment: The attachment.
+        :type attachment: discord.Attachment
+
+        :return: The content type sent by Discord, or the type guessed from the filename
+            extension, None if both are unknown.
+        :rtype: Optional[str]
+        """
+        return attachment.content_type or mimetypes.guess_type(attachment.filename)[0]
+
+    @classmethod
+    def needs_download(
+        cls, attachment: discord.Attachment, check_textfile: bool, check_archive: bool
+    ) -> bool:
+        """
+        Check whether an attachment has to be downloaded to be scanned, from its metadata only.
+        Attachments that are too large, images, video and audio are never scanned, neither are
+        archives when archives are not checked. Attachments of an unknown type are downloaded and
+        sniffed.
+
+        :param attachment: The attachment.
+        :type attachment: discord.Attachment
+        :param check_textfile: Whether to check text files.
+        :type check_textfile: bool
+        :param check_archive: Whether to check archives.
+        :type check_archive: bool
+
+        :return: Whether the attachment has to be downloaded.
         :rtype: bool
         """
-        file_obj = io.BytesIO(buffer)
-        if ft.endswith("/zip"):
-            return await cls.scan_zip(file_obj, client)
-        elif ft.endswith("/x-7z-compressed"):
-            return await cls.scan_7z(file_obj, client)
-        elif ft.endswith("/x-rar"):
-            return await cls.scan_rar(file_obj, client)
-        elif ft.endswith("/x-tar"):
-            return await cls.scan_tar(file_obj, client)
-        elif ft.endswith("/gzip") or ft.endswith("/x-gzip"):
-            return await cls.scan_gzip(file_obj, client)
-        elif ft.endswith("x-bzip2"):
-            return await cls.scan_bz2(file_obj, client)
-        return False
+        if not check_textfile or attachment.size > cls.MAX_ATTACHMENT_SIZE:
+            return False
+        ft = cls.declared_type(attachment)
+        if ft is None:
+            return True
+        if ft.startswith(cls.SKIPPED_TYPES):
+            return False
+        return check_archive or cls.archive_format(ft) is None
 
     @classmethod
     async def scan_attachment(
@@ -278,7 +1254,9 @@ class TokenDetector:
         check_textfile: bool,
         check_archive: bool,
         client: Optional[Bot] = None,
-    ) -> bool:
+        session: Optional[aiohttp.ClientSession] = None,
+        cache: Optional["ScanCache"] = None,
+    ) -> ScanResult:
         """
         Scan the attachment for tokens.
 
@@ -290,19 +1268,279 @@ class TokenDetector:
         :type check_archive: bool
         :param client: The bot client, will be used to validate user id if provided.
         :type client: Optional[Bot]
+        :param session: The session to stream the attachment with, read at once if not provided.
+        :type session: Optional[aiohttp.ClientSession]
+        :param cache: The cache of scan results, a known attachment is not downloaded again.
+        :type cache: Optional[ScanCache]
 
-        :return: Whether the token is detected.
-        :rtype: bool
+        :return: The result of the scan, truthy if the token is detected.
+        :rtype: ScanResult
         """
-        if attachment.size > 25 * 1024 * 1024:
-            return False
-        buffer = await attachment.read()
-        ft = cls.MIME.from_buffer(buffer)
-        if not check_textfile:
-            return False
+        if not cls.needs_download(attachment, check_textfile, check_archive):
+            return ScanResult.CLEAN
+        url = None
+        if cache is not None:
+            url = attachment.url
+            result = await cache.get_url(url)
+            if result is not None:
+                return result
+        if session is None:
+            return await cls.scan_stream(
+                cls._iter_buffer(await attachment.read()),
+                check_textfile,
+                check_archive,
+                client,
+                cache,
+                url,
+            )
+        # leaving the context before the body is read closes the connection, which stops the
+        # download when a token is detected early
+        async with session.get(attachment.url) as resp:
+            if resp.status != 200:
+                return ScanResult.CLEAN
+            return await cls.scan_stream(
+                cls._iter_response(resp),
+                check_textfile,
+                check_archive,
+                client,
+                cache,
+                url,
+            )
 
-        if ft.startswith("text"):
-            return await cls.decoder_search(buffer, client)
-        elif check_archive and ft.startswith("application"):
-            return await cls.scan_archive(ft, buffer, client)
-        return False
+    @staticmethod
+    async def _iter_buffer(buffer: bytes) -> AsyncIterator[bytes]:
+        """
+        Yield a buffer that has already been read as a single chunk.
+        This is an internal method and should not be called directly.
+
+        :param buffer: The buffer.
+        :type buffer: bytes
+
+        :return: The chunks of the buffer.
+        :rtype: AsyncIterator[bytes]
+        """
+        yield buffer
+
+    @classmethod
+    async def _iter_response(cls, resp: aiohttp.ClientResponse) -> AsyncIterator[bytes]:
+        """
+        Yield the body of a response in chunks, up to the maximum attachment size.
+        This is an internal method and should not be called directly.
+
+        :param resp: The response.
+        :type resp: aiohttp.ClientResponse
+
+        :raises DownloadTruncated: Raised when the body is larger than the maximum attachment size.
+
+        :return: The chunks of the body.
+        :rtype: AsyncIterator[bytes]
+        """
+        received = 0
+        async for chunk in resp.content.iter_chunked(cls.CHUNK_SIZE):
+            received += len(chunk)
+            if received > cls.MAX_ATTACHMENT_SIZE:
+                raise DownloadTruncated(f"the body is larger than {cls.MAX_ATTACHMENT_SIZE} bytes")
+            yield chunk
+
+
+class ChunkScanner:
+    """
+    Find possible tokens in data received in chunks, that pass the offline user id check.
+    The last bytes of each chunk are kept and scanned again with the next one, so tokens split
+    across a chunk boundary are still found.
+
+    :ivar overlap: The number of bytes kept between chunks, longer than any token.
+    :vartype overlap: int
+    """
+
+    def __init__(self, overlap: int = TokenDetector.CHUNK_OVERLAP) -> None:
+        self.overlap = overlap
+        self._tail = b""
+        self._seen = set()
+
+    def _search(self, buffer: bytes, final: bool) -> List[str]:
+        """
+        Find the possible tokens in the buffer that have not been found before.
+        This is an internal method and should not be called directly.
+
+        :param buffer: The buffer to search.
+        :type buffer: bytes
+        :param final: Whether no more data follows, otherwise a match ending at the end of the
+            buffer is left for the next chunk as it may continue there.
+        :type final: bool
+
+        :return: The possible tokens.
+        :rtype: List[str]
+        """
+        found = []
+        start = TokenDetector.prefilter(buffer)
+        if start < 0:
+            return found
+        for match in TokenDetector.TOKEN_REGEX_BYTES.finditer(buffer, start):
+            if not final and match.end() == len(buffer):
+                break
+            token = match.group()
+            if token not in self._seen:
+                self._seen.add(token)
+                token = token.decode("ascii")
+                if TokenDetector.decode_user_id(token) is not None:
+                    found.append(token)
+        return found
+
+    def feed(self, chunk: Union[bytes, bytearray, memoryview]) -> List[str]:
+        """
+        Scan the next chunk.
+
+        :param chunk: The chunk.
+        :type chunk: bytes | bytearray | memoryview
+
+        :return: The possible tokens found in this chunk.
+        :rtype: List[str]
+        """
+        buffer = self._tail + bytes(chunk)
+        self._tail = buffer[-self.overlap :]
+        return self._search(buffer, final=False)
+
+    def flush(self) -> List[str]:
+        """
+        Scan the end of the data, once the last chunk has been fed.
+
+        :return: The possible tokens found at the end of the data.
+        :rtype: List[str]
+        """
+        tail, self._tail = self._tail, b""
+        return self._search(tail, final=True)
+
+
+class ScanCache:
+    """
+    The cache of attachment scan results, keyed by the content hash and the size of the file.
+    Results are kept in a memory LRU and, when a database is given, persisted in it. Only
+    complete results are cached, and entries are tied to the version of the detection rules, so
+    they expire when the rules or the configuration change.
+    The url of a scanned attachment is mapped to its key, so the same attachment is not
+    downloaded again.
+
+    :ivar rules: The version of the detection rules.
+    :vartype rules: str
+    :ivar ttl: The seconds a result is cached.
+    :vartype ttl: float
+    :ivar memory: The memory tier.
+    :vartype memory: TTLCache
+    :ivar database: The persistent tier.
+    :vartype database: Optional[Database]
+    """
+
+    CACHEABLE = (ScanResult.CLEAN, ScanResult.DETECTED)
+
+    def __init__(
+        self,
+        rules: str,
+        size: int = 10000,
+        ttl: float = 86400.0,
+        database: Optional[Database] = None,
+    ) -> None:
+        self.rules = rules
+        self.ttl = ttl
+        self.memory = TTLCache(size, ttl)
+        self.database = database
+        self._urls = TTLCache(size, ttl)
+
+    @staticmethod
+    def rules_version(*parts: Any) -> str:
+        """
+        Get the version of the detection rules from everything a result depends on.
+
+        :param parts: The rules and the configuration, they must be JSON serializable.
+        :type parts: Any
+
+        :return: The version.
+        :rtype: str
+        """
+        dumped = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(dumped.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def key(digest: str, size: int) -> str:
+        """
+        Get the key of a file.
+
+        :param digest: The SHA-256 hex digest of the content.
+        :type digest: str
+        :param size: The size of the file in bytes.
+        :type size: int
+
+        :return: The key.
+        :rtype: str
+        """
+        return f"{digest}:{size}"
+
+    @staticmethod
+    def _strip_url(url: str) -> str:
+        """
+        Remove the query of an attachment url, which changes with every signature.
+        This is an internal method and should not be called directly.
+
+        :param url: The url.
+        :type url: str
+
+        :return: The url without its query.
+        :rtype: str
+        """
+        return url.split("?", 1)[0]
+
+    async def get(self, key: str) -> Optional[ScanResult]:
+        """
+        Get the result of a file.
+
+        :param key: The key of the file.
+        :type key: str
+
+        :return: The result, or None if the file is not cached.
+        :rtype: Optional[ScanResult]
+        """
+        result = self.memory.get(key)
+        if result is not MISSING:
+            return result
+        if self.database is None:
+            return None
+        value = await self.database.get_scan_result(key, self.rules)
+        if value is None:
+            return None
+        result = ScanResult(value)
+        self.memory.set(key, result)
+        return result
+
+    async def get_url(self, url: str) -> Optional[ScanResult]:
+        """
+        Get the result of an attachment that has been scanned before.
+
+        :param url: The url of the attachment.
+        :type url: str
+
+        :return: The result, or None if the attachment is not cached.
+        :rtype: Optional[ScanResult]
+        """
+        key = self._urls.get(self._strip_url(url))
+        return None if key is MISSING else await self.get(key)
+
+    async def set(self, key: str, result: ScanResult, url: Optional[str] = None) -> None:
+        """
+        Cache the result of a file, incomplete results are ignored.
+
+        :param key: The key of the file.
+        :type key: str
+        :param result: The result.
+        :type result: ScanResult
+        :param url: The url of the attachment the file was downloaded from.
+        :type url: Optional[str]
+        """
+        if result not in self.CACHEABLE:
+            return
+        if url is not None:
+            self._urls.set(self._strip_url(url), key)
+        if self.memory.peek(key) is result:
+            return
+        self.memory.set(key, result)
+        if self.database is not None:
+            await self.database.set_scan_result(key, int(result), self.rules, self.ttl)
@@ -0,0 +1,124 @@
+"""
+The event loop watchdog of the bot.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from src.utils.metrics import LOOP_LAG, LOOP_STALL_SECONDS, LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """
+    Measure the lag of the event loop, and log the stack of the code blocking it.
+    A task on the loop records a heartbeat every `interval` seconds and the lag of each wake-up,
+    while a thread checks the heartbeat. Once the loop has not run for `threshold` seconds, the
+    thread logs the current stack of the loop thread, which is the frame blocking it. The
+    duration of the stall is recorded when the loop runs again.
+
+    :ivar interval: The seconds between heartbeats.
+    :vartype interval: float
+    :ivar threshold: The seconds of lag that make a stall, larger than the interval.
+    :vartype threshold: float
+    :ivar stalls: The number of stalls.
+    :vartype stalls: int
+    :ivar stalled: The total seconds the loop was stalled.
+    :vartype stalled: float
+    :ivar longest: The seconds of the longest stall.
+    :vartype longest: float
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.5) -> None:
+        if threshold <= interval:
+            raise ValueError("The threshold of the watchdog must be larger than its interval")
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = 0
+        self.stalled = 0.0
+        self.longest = 0.0
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        """
+        Whether the watchdog is running.
+
+        :return: Whether the watchdog is running.
+        :rtype: bool
+        """
+        return self._task is not None
+
+    def start(self) -> None:
+        """
+        Start watching the running event loop.
+        """
+        if self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        """
+        Stop watching the event loop.
+        """
+        if not self.running:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._stop.set()
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+
+    async def _heartbeat(self) -> None:
+        """
+        Record a heartbeat and the lag of every wake-up.
+        This is an internal method and should not be called directly.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                self.stalls += 1
+                self.stalled += lag
+                self.longest = max(self.longest, lag)
+                LOOP_STALLS.inc()
+                LOOP_STALL_SECONDS.observe(lag)
+
+    def _monitor(self) -> None:
+        """
+        Log the stack of the loop thread once per stall.
+        This is an internal method and should not be called directly.
+        """
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unavailable\n"
+            logger.warning(
+                f"The event loop has been blocked for {blocked:.3f}s, "
+                f"stack of the blocking frame:\n{stack.rstrip()}"
+            )
@@ -4,11 +4,30 @@ Start the application.
 
 import tracemalloc
 
-tracemalloc.start(25)  # Used in src/client/client.py on_ready function.
+from src.client.config import Config
+
+# tracing slows down every allocation, it is only used to report the memory usage on start
+_bot = Config.get("bot", {})
+if _bot.get("debug-mode") or _bot.get("tracemalloc"):
+    tracemalloc.start(25)
 
 if __name__ == "__main__":
     import decouple
 
-    from src.main import Bot
+    token = decouple.config("token")
+    cluster = Config.get("cluster", {})
+    if cluster.get("enabled", False):
+        import asyncio
+        import logging
+
+        from src.client.cluster import ClusterLauncher, recommended_shards
+
+        logging.basicConfig(level=logging.INFO)
+        shard_count = cluster.get("shards", 0) or asyncio.run(recommended_shards(token))
+        ClusterLauncher(
+            token, shard_count, cluster.get("workers", 2), cluster.get("restart-delay", 1.0)
+        ).run()
+    else:
+        from src.main import Bot
 
-    Bot().run(decouple.config("token"))
+        Bot().run(token)
@@ -0,0 +1,87 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+
+import pytest
+
+from src.utils.actions import ActionAggregator
+
+
+def recorder(delay=0.05, error=None):
+    batches = []
+
+    async def action(items):
+        batches.append(items)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+
+    return batches, action
+
+
+async def test_first_item_at_once():
+    batches, action = recorder(delay=0)
+    aggregator = ActionAggregator(action, window=5)
+    await asyncio.wait_for(aggregator.submit(1, "a"), 1)
+    assert batches == [["a"]]
+    aggregator.close()
+
+
+async def test_burst_is_batched():
+    batches, action = recorder()
+    aggregator = ActionAggregator(action, window=0.05)
+    first = asyncio.create_task(aggregator.submit(1, 0))
+    await asyncio.sleep(0.01)
+    await asyncio.gather(first, *(aggregator.submit(1, i) for i in range(1, 10)))
+    # the first item goes alone, the others arrived while it was acted on
+    assert batches == [[0], list(range(1, 10))]
+    await asyncio.sleep(0.1)
+    assert len(aggregator) == 0 and not aggregator._tasks
+
+
+async def test_window():
+    batches, action = recorder(delay=0)
+    aggregator = ActionAggregator(action, window=0.1)
+    await aggregator.submit(1, "a")
+    await asyncio.sleep(0.05)
+    await asyncio.gather(aggregator.submit(1, "b"), aggregator.submit(1, "c"))
+    await asyncio.sleep(0.15)
+    await aggregator.submit(1, "d")
+    assert batches == [["a"], ["b", "c"], ["d"]]
+    aggregator.close()
+
+
+async def test_keys_and_max_batch():
+    batches, action = recorder()
+    aggregator = ActionAggregator(action, window=0, max_batch=2)
+    await asyncio.gather(*(aggregator.submit(i % 2, i) for i in range(6)))
+    assert sorted(batches) == [[0, 2], [1, 3], [4], [5]]
+    assert aggregator.batches == 4
+
+
+async def test_error_reaches_every_caller():
+    batches, action = recorder(error=ValueError("boom"))
+    aggregator = ActionAggregator(action, window=0)
+    results = await asyncio.gather(
+        *(aggregator.submit(1, i) for i in range(3)), return_exceptions=True
+    )
+    assert all(isinstance(i, ValueError) for i in results)
+    # the key keeps working after a failed batch
+    batches, aggregator.action = recorder(delay=0)
+    await aggregator.submit(1, 3)
+    assert batches == [[3]]
+
+
+async def test_close():
+    batches, action = recorder(delay=5)
+    aggregator = ActionAggregator(action, window=0)
+    tasks = [asyncio.create_task(aggregator.submit(1, i)) for i in range(3)]
+    await asyncio.sleep(0.01)
+    aggregator.close()
+    for task in tasks:
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    assert len(aggregator) == 0
@@ -0,0 +1,39 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils.cache import MISSING, TTLCache
+
+
+def test_lru_eviction():
+    cache = TTLCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert len(cache) == 2
+
+
+def test_none_is_cached():
+    cache = TTLCache(2)
+    cache.set("a", None)
+    assert cache.get("a") is None
+    assert cache.get("b") is MISSING
+    assert cache.info() == {"hits": 1, "misses": 1, "size": 1, "maxsize": 2}
+
+
+def test_ttl_expiry():
+    cache = TTLCache(2, ttl=60)
+    cache.set("a", 1, ttl=-1)
+    cache.set("b", 2)
+    assert cache.get("a", "expired") == "expired"
+    assert cache.get("b") == 2
+
+
+def test_zero_size():
+    cache = TTLCache(0)
+    cache.set("a", 1)
+    assert len(cache) == 0
@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import threading
+import time
+
+from src.client.cluster import ClusterLauncher, split_shards
+
+
+def fake_worker(path, cluster_id, shard_ids, shard_count, conn):
+    """
+    A worker that crashes once on its first start if it is worker 0, then publishes its guild
+    count and records what the launcher sends, worker 1 also changes a user.
+    """
+    marker = os.path.join(path, "crashed")
+    if cluster_id == 0 and not os.path.exists(marker):
+        open(marker, "w").close()
+        sys.exit(1)
+    conn.send({"stats": {"guilds": len(shard_ids) * 10, "name": "worker"}})
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        kind = next(iter(message))
+        with open(os.path.join(path, f"{kind}{cluster_id}.json"), "w") as f:
+            json.dump(message[kind], f)
+        if kind == "totals" and cluster_id == 1:
+            conn.send({"invalidate": [42]})
+
+
+def read(path, name):
+    try:
+        with open(os.path.join(path, name)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def test_split_shards():
+    assert split_shards(5, 2) == [[0, 2, 4], [1, 3]]
+    assert split_shards(2, 4) == [[0], [1]]
+
+
+def test_launcher(tmp_path):
+    path = str(tmp_path)
+    launcher = ClusterLauncher(path, 4, 2, restart_delay=0.1, target=fake_worker)
+    thread = threading.Thread(target=launcher.run)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if read(path, "totals0.json") == read(path, "totals1.json") == {"guilds": 40} and read(
+                path, "invalidate0.json"
+            ) == [42]:
+                break
+            time.sleep(0.1)
+        assert read(path, "totals0.json") == read(path, "totals1.json") == {"guilds": 40}
+        # invalidations are relayed to the other workers only
+        assert read(path, "invalidate0.json") == [42]
+        assert read(path, "invalidate1.json") is None
+        assert launcher.restarts == 1
+    finally:
+        launcher.stop()
+        thread.join(30)
+    assert not thread.is_alive()
+    assert all(not i.process.is_alive() for i in launcher.workers)
@@ -0,0 +1,143 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+
+import aiosqlite
+import pytest
+
+from src.client.database import Database
+
+
+@pytest.fixture
+async def database(tmp_path):
+    db = Database(str(tmp_path / "database.db"))
+    await db.initialize()
+    yield db
+    await db.close()
+
+
+async def test_initialize_uses_wal(database):
+    db = await database._connection()
+    async with db.execute("PRAGMA journal_mode") as cursor:
+        assert (await cursor.fetchone())[0] == "wal"
+
+
+async def test_connection_is_reused(database):
+    first = await database._connection()
+    await database.get_user(1)
+    await database.opt_out(1)
+    assert await database._connection() is first
+
+
+async def test_get_user(database):
+    assert await database.get_user(1) is None
+    await database.opt_out(1)
+    await database.set_language(1, "zh-TW")
+    user = await database.get_user(1)
+    assert user["opt_out"] == 1
+    assert user["language"] == "zh-TW"
+    await database.opt_out(1, False)
+    assert (await database.get_user(1))["opt_out"] == 0
+
+
+async def test_lazy_connection(tmp_path):
+    db = Database(str(tmp_path / "database.db"))
+    assert await db.get_user(1) is None
+    await db.close()
+    await db.close()
+
+
+async def test_cache_hits_and_misses(database):
+    assert await database.get_user(1) is None
+    assert await database.get_user(1) is None
+    assert database.cache.info()["hits"] == 1
+    assert database.cache.info()["misses"] == 1
+
+
+async def test_cache_updated_on_write(database):
+    await database.get_user(1)
+    await database.get_user(2)
+    await database.opt_out(1)
+    await database.set_language(2, "zh-CN")
+    misses = database.cache.misses
+    assert (await database.get_user(1))["opt_out"] == 1
+    assert (await database.get_user(2))["language"] == "zh-CN"
+    assert database.cache.misses == misses
+
+
+async def test_uncached_write_is_read_back(database):
+    await database.set_language(1, "zh-TW")
+    await database.opt_out(1)
+    user = await database.get_user(1)
+    assert user["language"] == "zh-TW"
+    assert user["opt_out"] == 1
+
+
+async def _count_rows(path):
+    async with aiosqlite.connect(path) as db:
+        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def test_writes_are_batched(tmp_path):
+    path = str(tmp_path / "database.db")
+    db = Database(path, flush_interval=60, flush_threshold=1000)
+    await db.initialize()
+    for i in range(10):
+        await db.opt_out(i)
+    await db.set_language(0, "zh-TW")
+    assert await _count_rows(path) == 0
+    user = await db.get_user(0)
+    assert user["opt_out"] == 1
+    assert user["language"] == "zh-TW"
+    await db.flush()
+    assert await _count_rows(path) == 10
+    await db.close()
+
+
+async def test_close_flushes(tmp_path):
+    path = str(tmp_path / "database.db")
+    db = Database(path, flush_interval=60)
+    await db.set_language(1, "zh-CN")
+    await db.close()
+    db = Database(path)
+    assert (await db.get_user(1))["language"] == "zh-CN"
+    await db.close()
+
+
+async def test_threshold_triggers_flush(tmp_path):
+    path = str(tmp_path / "database.db")
+    db = Database(path, flush_interval=60, flush_threshold=5)
+    await db.initialize()
+    for i in range(5):
+        await db.opt_out(i)
+    for _ in range(10):
+        await asyncio.sleep(0.05)
+        if await _count_rows(path) == 5:
+            break
+    assert await _count_rows(path) == 5
+    await db.close()
+
+
+async def test_flush_reports_written_users(database):
+    flushed = []
+    database.on_flush = flushed.extend
+    await database.opt_out(1)
+    await database.set_language(2, "zh-TW")
+    await database.flush()
+    assert sorted(flushed) == [1, 2]
+
+
+async def test_invalidate(tmp_path):
+    path = str(tmp_path / "database.db")
+    first, second = Database(path, flush_interval=0), Database(path, flush_interval=0)
+    await second.get_user(1)
+    await first.opt_out(1)
+    assert await second.get_user(1) is None
+    second.invalidate([1])
+    assert (await second.get_user(1))["opt_out"] == 1
+    await first.close()
+    await second.close()
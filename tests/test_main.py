@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+
+from src.main import Bot
+
+
+def test_gateway_options_default():
+    options = Bot.gateway_options({})
+    assert options["intents"].message_content
+    assert options["intents"].voice_states
+    assert options["max_messages"] == 1000
+    assert not options["chunk_guilds_at_startup"]
+    assert Bot.gateway_options({"message-cache": 0})["max_messages"] is None
+
+
+async def test_gateway_options_lean():
+    options = Bot.gateway_options({"lean": True, "message-cache": 1000})
+    intents = options["intents"]
+    assert intents.guilds and intents.guild_messages and intents.message_content
+    assert not (intents.dm_messages or intents.voice_states or intents.guild_reactions)
+    assert options["member_cache_flags"] == discord.MemberCacheFlags.none()
+    assert options["max_messages"] is None
+    assert not options["chunk_guilds_at_startup"]
+    # the client accepts the combination
+    discord.Client(**options)
@@ -0,0 +1,74 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+import pytest
+
+from src.utils.metrics import Counter, Gauge, Histogram, Metric, MetricsServer, Registry
+
+
+def test_counter():
+    counter = Counter("scans_total", "Scans.", labelnames=("result",))
+    counter.inc(result="clean")
+    counter.inc(2, result="clean")
+    counter.inc(result="detected")
+    assert counter.get(result="clean") == 3
+    assert 'scans_total{result="detected"} 1' in counter.render()
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_metric_requires_samples():
+    class Incomplete(Metric):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "Incomplete.")
+
+
+def test_gauge():
+    gauge = Gauge("running", "Running.")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.get() == 1
+    assert Gauge("size", "Size.", function=lambda: 42).render().endswith("size 42\n")
+
+
+def test_histogram():
+    histogram = Histogram("seconds", "Seconds.", buckets=(0.1, 1), labelnames=("stage",))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value, stage="sniff")
+    with histogram.time(stage="regex"):
+        pass
+    assert histogram.count(stage="sniff") == 4
+    assert histogram.count(stage="regex") == 1
+    lines = histogram.render().splitlines()
+    assert 'seconds_bucket{stage="sniff",le="0.1"} 2' in lines
+    assert 'seconds_bucket{stage="sniff",le="1"} 3' in lines
+    assert 'seconds_bucket{stage="sniff",le="+Inf"} 4' in lines
+    assert 'seconds_sum{stage="sniff"} 2.65' in lines
+    assert 'seconds_count{stage="sniff"} 4' in lines
+
+
+def test_registry_duplicate():
+    registry = Registry()
+    registry.register(Counter("total", "Total."))
+    with pytest.raises(ValueError):
+        registry.register(Counter("total", "Total."))
+
+
+async def test_server(unused_tcp_port):
+    registry = Registry()
+    registry.register(Counter("total", "Total.")).inc()
+    server = MetricsServer(registry, port=unused_tcp_port)
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{unused_tcp_port}/metrics") as resp:
+                assert resp.status == 200
+                assert "total 1\n" in await resp.text()
+    finally:
+        await server.stop()
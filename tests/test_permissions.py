@@ -0,0 +1,74 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from types import SimpleNamespace
+
+from src.utils.permissions import PermissionCache
+
+
+class FakeChannel:
+    def __init__(self, channel_id, parent=None):
+        self.id = channel_id
+        self.parent = parent
+        self.calls = 0
+
+    def permissions_for(self, member):
+        self.calls += 1
+        return SimpleNamespace(send_messages=True, calls=self.calls)
+
+
+GUILD = SimpleNamespace(id=1, me=SimpleNamespace(id=0))
+OTHER = SimpleNamespace(id=2, me=SimpleNamespace(id=0))
+
+
+def test_cached():
+    cache = PermissionCache()
+    channel = FakeChannel(10)
+    assert cache.permissions_for(GUILD, channel) is cache.permissions_for(GUILD, channel)
+    assert channel.calls == 1
+
+
+def test_thread_uses_parent():
+    cache = PermissionCache()
+    parent = FakeChannel(10)
+    thread = FakeChannel(11, parent)
+    cache.permissions_for(GUILD, thread)
+    cache.permissions_for(GUILD, parent)
+    assert parent.calls == 1
+    assert thread.calls == 0
+
+
+def test_invalidate_channel():
+    cache = PermissionCache()
+    first, second = FakeChannel(10), FakeChannel(20)
+    cache.permissions_for(GUILD, first)
+    cache.permissions_for(GUILD, second)
+    cache.invalidate_channel(GUILD.id, first.id)
+    cache.permissions_for(GUILD, first)
+    cache.permissions_for(GUILD, second)
+    assert (first.calls, second.calls) == (2, 1)
+
+
+def test_invalidate_guild():
+    cache = PermissionCache()
+    first, second, other = FakeChannel(10), FakeChannel(20), FakeChannel(30)
+    for guild, channel in ((GUILD, first), (GUILD, second), (OTHER, other)):
+        cache.permissions_for(guild, channel)
+    cache.invalidate_guild(GUILD.id)
+    for guild, channel in ((GUILD, first), (GUILD, second), (OTHER, other)):
+        cache.permissions_for(guild, channel)
+    assert (first.calls, second.calls, other.calls) == (2, 2, 1)
+    # a channel dropped after a guild invalidation is resolved again too
+    cache.invalidate_channel(GUILD.id, first.id)
+    cache.permissions_for(GUILD, first)
+    assert first.calls == 3
+
+
+def test_ttl():
+    cache = PermissionCache(ttl=-1)
+    channel = FakeChannel(10)
+    cache.permissions_for(GUILD, channel)
+    cache.permissions_for(GUILD, channel)
+    assert channel.calls == 2
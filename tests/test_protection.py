@@ -0,0 +1,303 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+from src.client.config import Config
+from src.client.i18n import I18n
+from src.cogs.protection import Protection
+from src.utils.metrics import SCANS, SCANS_RUNNING, SCANS_WAITING
+from src.utils.scheduler import ScanScheduler
+from src.utils.token_detection import TokenDetector
+
+EDIT_TOKEN = "MTA3MjYyNTE0OTM3MjgxMzM1NA.ABCDEF.abcdefghijklmnopqrstuvwxyz123456"
+
+
+@pytest.fixture
+def cog():
+    bot = SimpleNamespace(
+        config=Config(), logger=logging.getLogger("test"), database=None, session=None
+    )
+    cog = Protection(bot)
+    yield cog
+    cog.cog_unload()
+
+
+@pytest.mark.parametrize(
+    "key, value, changed",
+    [
+        ("workers", 8, False),
+        ("executor", "thread", False),
+        ("scan-concurrency", 2, False),
+        ("validation-concurrency", 1, False),
+        ("archive-max-depth", 1, True),
+        ("archive-max-size", 1, True),
+    ],
+)
+def test_scan_rules_version(key, value, changed):
+    config = {**Config._config, "scanner": {**Config._config.get("scanner", {})}}
+    versions = []
+    for scanner in (config["scanner"], {**config["scanner"], key: value}):
+        bot = SimpleNamespace(
+            config={**config, "scanner": scanner},
+            logger=logging.getLogger("test"),
+            database=None,
+            session=None,
+        )
+        cog = Protection(bot)
+        versions.append(cog.scan_cache.rules)
+        cog.cog_unload()
+    assert (versions[0] != versions[1]) is changed
+
+
+def attachments(*specs):
+    return [
+        SimpleNamespace(
+            delay=i, result=j, url=f"file{n}", size=0, filename="file.txt", content_type=None
+        )
+        for n, (i, j) in enumerate(specs)
+    ]
+
+
+@pytest.fixture
+def fake_scan(monkeypatch):
+    """
+    Replace the attachment scan, the attachments are made with `attachments`.
+    """
+    state = {"running": 0, "peak": 0, "cancelled": 0}
+
+    async def scan_attachment(attachment, *args):
+        delay, result = attachment.delay, attachment.result
+        state["running"] += 1
+        state["peak"] = max(state["peak"], state["running"])
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            state["cancelled"] += 1
+            raise
+        finally:
+            state["running"] -= 1
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(TokenDetector, "scan_attachment", scan_attachment)
+    return state
+
+
+async def test_scan_attachments_first_hit(cog, fake_scan):
+    start = time.perf_counter()
+    assert await cog.scan_attachments(attachments((5, False), (0.05, True), (5, False)))
+    assert time.perf_counter() - start < 1
+    await asyncio.sleep(0)
+    assert fake_scan["cancelled"] == 2
+
+
+async def test_scan_attachments_concurrency(cog, fake_scan):
+    cog.attachment_concurrency = 2
+    start = time.perf_counter()
+    assert not await cog.scan_attachments(attachments(*[(0.1, False)] * 4))
+    assert fake_scan["peak"] == 2
+    assert 0.2 <= time.perf_counter() - start < 0.4
+
+
+async def test_scan_attachments_failure(cog, fake_scan):
+    assert await cog.scan_attachments(attachments((0, ValueError("boom")), (0.05, True)))
+    assert not await cog.scan_attachments(attachments((0, ValueError("boom"))))
+
+
+async def test_scan_attachments_metrics(cog, fake_scan):
+    errors = SCANS.get(result="error")
+    detected = SCANS.get(result="detected")
+    cog.attachment_concurrency = 1
+    assert await cog.scan_attachments(attachments((0, ValueError("boom")), (0, True), (5, False)))
+    await asyncio.sleep(0)
+    assert SCANS.get(result="error") == errors + 1
+    assert SCANS.get(result="detected") == detected + 1
+    assert SCANS_WAITING.get() == SCANS_RUNNING.get() == 0
+
+
+async def test_scan_attachments_shed(cog, fake_scan):
+    cog.scheduler = ScanScheduler(concurrency=1, max_queue=0)
+    shed = SCANS.get(result="shed")
+    # the token is in the shed attachment
+    assert not await cog.scan_attachments(attachments((0.05, False), (0, True)), guild_id=1)
+    assert SCANS.get(result="shed") == shed + 1
+    assert cog.scheduler.shed_count == 1
+
+
+async def test_member_update_invalidates_permissions(cog):
+    guild = SimpleNamespace(id=1, me=SimpleNamespace(id=0))
+    calls = []
+    channel = SimpleNamespace(id=10, permissions_for=lambda member: calls.append(member) or 1)
+    cog.permissions.permissions_for(guild, channel)
+    await cog.on_member_update(None, SimpleNamespace(id=5, guild=guild))
+    cog.permissions.permissions_for(guild, channel)
+    assert len(calls) == 1
+    await cog.on_member_update(None, SimpleNamespace(id=0, guild=guild))
+    cog.permissions.permissions_for(guild, channel)
+    assert len(calls) == 2
+
+
+def flagged_channel(manage_messages=True):
+    """
+    Make a channel recording the API calls, and a function making its messages.
+    """
+    calls = []
+
+    async def record(*args):
+        calls.append(args)
+
+    permissions = SimpleNamespace(read_message_history=True, manage_messages=manage_messages)
+    channel = SimpleNamespace(
+        id=10,
+        permissions_for=lambda member: permissions,
+        send=lambda text: record("send", text),
+        delete_messages=lambda messages: record("bulk", [i.id for i in messages]),
+    )
+    guild = SimpleNamespace(id=1, me=SimpleNamespace(id=0))
+
+    def message(message_id, author=1, age=timedelta(0)):
+        message_id = message_id + discord.utils.time_snowflake(discord.utils.utcnow() - age)
+        return SimpleNamespace(
+            id=message_id,
+            guild=guild,
+            channel=channel,
+            author=SimpleNamespace(mention=f"<@{author}>"),
+            reply=lambda text: record("reply", text),
+            delete=lambda: record("delete", message_id),
+        )
+
+    return calls, message
+
+
+async def test_delete_message_single(cog):
+    calls, message = flagged_channel()
+    await cog.delete_message(message(0), "en-US")
+    assert [i[0] for i in calls] == ["reply", "delete"]
+
+
+async def test_delete_messages_bulk(cog):
+    calls, message = flagged_channel()
+    old = message(0, author=2, age=timedelta(days=20))
+    messages = [message(1), message(2, author=2), message(3), old]
+    await cog.delete_messages([(i, "zh-TW") for i in messages[:3]] + [(old, "en-US")])
+    assert calls[0] == ("delete", old.id)
+    assert calls[1] == ("bulk", [i.id for i in messages[:3]])
+    assert calls[2] == (
+        "send",
+        I18n.get("event.protection.deleted-bulk", "zh-TW", count=4, authors="<@1>, <@2>"),
+    )
+    assert len(calls) == 3
+
+
+async def test_delete_messages_bulk_missing_perms(cog):
+    calls, message = flagged_channel(manage_messages=False)
+    await cog.delete_messages([(message(i), "en-US") for i in range(3)])
+    assert calls == [
+        ("send", I18n.get("event.protection.missing-perms-bulk", count=3, authors="<@1>"))
+    ]
+
+
+async def test_delete_message_burst(cog):
+    calls, message = flagged_channel()
+    cog.actions.window = 0
+    messages = [message(i) for i in range(6)]
+    first = asyncio.create_task(cog.delete_message(messages[0], "en-US"))
+    await asyncio.sleep(0)
+    await asyncio.gather(first, *(cog.delete_message(i, "en-US") for i in messages[1:]))
+    assert [i[0] for i in calls] == ["reply", "delete", "bulk", "send"]
+    assert calls[2][1] == [i.id for i in messages[1:]]
+
+
+@pytest.fixture
+def edit_cog(cog, monkeypatch):
+    """
+    The cog with the messages of the edit events made from the payloads, and the deletions and
+    the scans recorded.
+    """
+    calls = {"deleted": [], "scanned": []}
+
+    async def get_user(user_id):
+        return None
+
+    async def delete_message(message, locale):
+        calls["deleted"].append(message.id)
+
+    detect, detect_edit = TokenDetector.detect, TokenDetector.detect_edit
+
+    async def record_detect(content, client=None):
+        calls["scanned"].append(("full", content))
+        return await detect(content, client)
+
+    async def record_detect_edit(previous, content, client=None):
+        calls["scanned"].append(("edit", content))
+        return await detect_edit(previous, content, client)
+
+    permissions = SimpleNamespace(send_messages=True)
+    guild = SimpleNamespace(id=1, me=SimpleNamespace(id=0), preferred_locale=None)
+    channel = SimpleNamespace(id=10, parent=None, permissions_for=lambda member: permissions)
+
+    def edited_message(payload):
+        return SimpleNamespace(
+            id=payload.message_id,
+            guild=guild,
+            channel=channel,
+            author=SimpleNamespace(id=2, bot=False),
+            content=payload.data["content"],
+            attachments=[],
+        )
+
+    cog.database = SimpleNamespace(get_user=get_user)
+    cog.validate_userid = False
+    monkeypatch.setattr(cog, "delete_message", delete_message)
+    monkeypatch.setattr(cog, "_edited_message", edited_message)
+    monkeypatch.setattr(TokenDetector, "detect", record_detect)
+    monkeypatch.setattr(TokenDetector, "detect_edit", record_detect_edit)
+    return cog, calls, edited_message
+
+
+def edit(message_id, content):
+    return SimpleNamespace(
+        message_id=message_id, guild_id=1, data={"id": message_id, "content": content}
+    )
+
+
+async def test_edit_scans_the_changes(edit_cog):
+    cog, calls, make = edit_cog
+    await cog.on_message(make(edit(1, "see you later")))
+    assert cog.edits.peek(1) == "see you later"
+    await cog.on_raw_message_edit(edit(1, "see you much later"))
+    assert calls["scanned"][1] == ("edit", "see you much later")
+    assert cog.edits.peek(1) == "see you much later"
+    # an update of the embeds only
+    scanned = len(calls["scanned"])
+    await cog.on_raw_message_edit(edit(1, "see you much later"))
+    assert len(calls["scanned"]) == scanned
+    await cog.on_raw_message_edit(edit(1, "see you " + EDIT_TOKEN))
+    assert calls["deleted"] == [1]
+    assert 1 not in cog.edits
+
+
+async def test_edit_of_unknown_message(edit_cog):
+    cog, calls, _ = edit_cog
+    await cog.on_raw_message_edit(edit(2, "see you " + EDIT_TOKEN))
+    assert calls["scanned"] == [("full", "see you " + EDIT_TOKEN)]
+    assert calls["deleted"] == [2]
+
+
+async def test_edits_disabled(edit_cog):
+    cog, calls, make = edit_cog
+    cog.check_edits = False
+    await cog.on_message(make(edit(1, "see you later")))
+    await cog.on_raw_message_edit(edit(1, "see you " + EDIT_TOKEN))
+    assert calls["deleted"] == [] and 1 not in cog.edits
@@ -0,0 +1,128 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+
+import pytest
+
+from src.utils.scheduler import ScanScheduler, ScanShed
+
+TEXT, ARCHIVE = ScanScheduler.TEXT, ScanScheduler.ARCHIVE
+
+
+class Recorder:
+    def __init__(self):
+        self.order = []
+        self.running = 0
+        self.peak = 0
+        self.gate = asyncio.Event()
+
+    def job(self, name, delay=0.0, gated=False):
+        async def run():
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            self.order.append(name)
+            try:
+                if gated:
+                    await self.gate.wait()
+                await asyncio.sleep(delay)
+            finally:
+                self.running -= 1
+            return name
+
+        return run
+
+
+async def queue_up(scheduler, recorder, *jobs):
+    """
+    Hold the only slot with a gated job, queue the jobs, then release the slot.
+    """
+    blocker = asyncio.create_task(scheduler.run(0, TEXT, recorder.job("blocker", gated=True)))
+    await asyncio.sleep(0)
+    tasks = []
+    for guild_id, priority, name in jobs:
+        tasks.append(asyncio.create_task(scheduler.run(guild_id, priority, recorder.job(name))))
+        await asyncio.sleep(0)
+    recorder.gate.set()
+    return await asyncio.gather(blocker, *tasks, return_exceptions=True)
+
+
+async def test_concurrency():
+    scheduler = ScanScheduler(concurrency=2)
+    recorder = Recorder()
+    await asyncio.gather(*(scheduler.run(1, TEXT, recorder.job(i, 0.02)) for i in range(6)))
+    assert recorder.peak == 2
+    assert scheduler.stats() == {"running": 0, "waiting": 0, "shed": 0}
+
+
+async def test_text_before_archives():
+    scheduler = ScanScheduler(concurrency=1)
+    recorder = Recorder()
+    await queue_up(scheduler, recorder, (1, ARCHIVE, "archive"), (1, TEXT, "text"))
+    assert recorder.order == ["blocker", "text", "archive"]
+
+
+async def test_guilds_take_turns():
+    scheduler = ScanScheduler(concurrency=1)
+    recorder = Recorder()
+    await queue_up(
+        scheduler, recorder, (1, TEXT, "a1"), (1, TEXT, "a2"), (1, TEXT, "a3"), (2, TEXT, "b1")
+    )
+    assert recorder.order == ["blocker", "a1", "b1", "a2", "a3"]
+
+
+async def test_shed_newest():
+    scheduler = ScanScheduler(concurrency=1, max_queue=1)
+    recorder = Recorder()
+    results = await queue_up(scheduler, recorder, (1, TEXT, "queued"), (1, TEXT, "rejected"))
+    assert results[1] == "queued"
+    assert isinstance(results[2], ScanShed)
+    assert scheduler.shed_count == 1
+
+
+async def test_shed_oldest_archive_of_busiest_guild():
+    scheduler = ScanScheduler(concurrency=1, max_queue=3, shed="oldest")
+    recorder = Recorder()
+    results = await queue_up(
+        scheduler,
+        recorder,
+        (1, ARCHIVE, "a1"),
+        (2, ARCHIVE, "b1"),
+        (2, ARCHIVE, "b2"),
+        (3, TEXT, "c1"),
+    )
+    assert isinstance(results[2], ScanShed)
+    assert recorder.order == ["blocker", "c1", "a1", "b2"]
+
+
+async def test_shed_oldest_keeps_higher_priority():
+    scheduler = ScanScheduler(concurrency=1, max_queue=1, shed="oldest")
+    recorder = Recorder()
+    results = await queue_up(scheduler, recorder, (1, TEXT, "text"), (2, ARCHIVE, "archive"))
+    assert results[1] == "text"
+    assert isinstance(results[2], ScanShed)
+
+
+async def test_cancelled_scan_leaves_the_queue():
+    scheduler = ScanScheduler(concurrency=1, max_queue=1)
+    recorder = Recorder()
+    blocker = asyncio.create_task(scheduler.run(0, TEXT, recorder.job("blocker", gated=True)))
+    await asyncio.sleep(0)
+    waiting = asyncio.create_task(scheduler.run(1, TEXT, recorder.job("cancelled")))
+    await asyncio.sleep(0)
+    assert len(scheduler) == 1
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+    assert len(scheduler) == 0
+    recorder.gate.set()
+    await blocker
+    assert await scheduler.run(1, TEXT, recorder.job("next")) == "next"
+    assert scheduler.running == 0
+    assert "cancelled" not in recorder.order
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        ScanScheduler(shed="random")
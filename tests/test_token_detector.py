@@ -3,11 +3,31 @@ import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import asyncio
+import base64
+import gzip
 import io
+import tarfile
+import time
+import zipfile
+from types import SimpleNamespace
 
+import aiohttp
+import discord
+import py7zr
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
-from src.utils.token_detection import TokenDetector
+from src.client.database import Database
+from src.utils.cache import TTLCache
+from src.utils.token_detection import (
+    ChunkScanner,
+    ScanCache,
+    ScanResult,
+    ScanTimedOut,
+    TokenDetector,
+)
 
 
 @pytest.mark.parametrize(
@@ -49,6 +69,46 @@ async def test_detect(content, expected):
     assert result == expected
 
 
+@pytest.mark.parametrize(
+    "previous, content, expected",
+    [
+        # the run touching the change is included, as it may continue a token
+        ("hello world", "hello there world", (6, 17)),
+        ("hello world", "hello world", (11, 11)),
+        # a deletion joins two words into one run
+        ("abc def", "abcdef", (0, 6)),
+        ("abc  def", "abc def", (4, 7)),
+        ("one two three", "one 2 three", (4, 5)),
+        ("", "abc", (0, 3)),
+    ],
+)
+def test_changed_region(previous, content, expected):
+    assert TokenDetector.changed_region(previous, content) == expected
+
+
+EDIT_TOKEN = "MTA3MjYyNTE0OTM3MjgxMzM1NA.ABCDEF.abcdefghijklmnopqrstuvwxyz123456"
+# long enough for the edits to be scanned incrementally
+PADDING = "some text " * 60
+
+
+@pytest.mark.parametrize(
+    "previous, content, expected",
+    [
+        ("see you later", f"see {EDIT_TOKEN} later", True),
+        # the token is completed by the edit
+        (f"token {EDIT_TOKEN[:40]}", f"token {EDIT_TOKEN}", True),
+        # the dot that joins the parts of the token is restored
+        (f"a {EDIT_TOKEN.replace('.', ' ', 1)} b", f"a {EDIT_TOKEN} b", True),
+        ("see you later", "see you much later", False),
+        # the previous content is known to be clean, the text outside the edit is not scanned
+        (f"a {EDIT_TOKEN} b", f"a {EDIT_TOKEN} b c", False),
+    ],
+)
+async def test_detect_edit(previous, content, expected):
+    previous, content = PADDING + previous + PADDING, PADDING + content + PADDING
+    assert await TokenDetector.detect_edit(previous, content) == expected
+
+
 @pytest.mark.parametrize(
     "data, expected",
     [
@@ -57,6 +117,14 @@ async def test_detect(content, expected):
             True,
         ),
         (b"\xff\xfe\xfd with some invalid UTF-8 bytes", False),
+        (
+            b"\xff stray byte before a token MTA3MjYyNTE0OTM3MjgxMzM1NA.ABCDEF.abcdefghijklmnopqrstuvwxyz123456",
+            True,
+        ),
+        (
+            memoryview(b"MTA3MjYyNTE0OTM3MjgxMzM1NA.ABCDEF.abcdefghijklmnopqrstuvwxyz123456"),
+            True,
+        ),
         (b"", False),
     ],
 )
@@ -169,3 +237,449 @@ async def test_scan_zip(file_obj, expected):
 async def test_scan_archive(ft, buffer, expected):
     result = await TokenDetector.scan_archive(ft, buffer)
     assert result == expected
+
+
+TOKEN = b"MTA3MjYyNTE0OTM3MjgxMzM1NA.ABCDEF.abcdefghijklmnopqrstuvwxyz123456"
+
+
+@pytest.mark.parametrize("split", [1, 20, 26, 27, 40, len(TOKEN) - 1])
+def test_chunk_scanner_split_token(split):
+    data = b"some text " + TOKEN + b" more text"
+    cut = len(b"some text ") + split
+    scanner = ChunkScanner(overlap=128)
+    found = scanner.feed(data[:cut]) + scanner.feed(data[cut:]) + scanner.flush()
+    assert TOKEN.decode() in found
+
+
+def test_chunk_scanner_token_at_end():
+    scanner = ChunkScanner()
+    assert scanner.feed(b"text " + TOKEN) == []
+    assert scanner.flush() == [TOKEN.decode()]
+
+
+@pytest.fixture
+async def cdn():
+    """
+    A local stand-in for the attachment CDN, serving text slowly in chunks.
+    """
+
+    async def handler(request):
+        resp = web.StreamResponse()
+        resp.content_type = "text/plain"
+        await resp.prepare(request)
+        if request.match_info["name"] == "danger.txt":
+            await resp.write(b"leaked " + TOKEN + b"\n" + b"filler line\n" * 10000)
+        for _ in range(20):
+            await resp.write(b"filler line\n" * 10000)
+            await asyncio.sleep(0.1)
+        await resp.write(b"the end\n")
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/{name}", handler)
+    server = TestServer(app)
+    await server.start_server()
+    async with aiohttp.ClientSession() as session:
+        yield server, session
+    await server.close()
+
+
+@pytest.mark.parametrize("name, expected", [("danger.txt", True), ("safe.txt", False)])
+async def test_scan_attachment_stream(cdn, name, expected):
+    server, session = cdn
+    attachment = SimpleNamespace(
+        url=str(server.make_url(f"/{name}")), size=1024, filename=name, content_type=None
+    )
+    start = time.perf_counter()
+    result = await TokenDetector.scan_attachment(attachment, True, True, session=session)
+    assert result == expected
+    # a detected token stops the download before the slow remainder is sent
+    assert (time.perf_counter() - start < 1) == expected
+
+
+async def test_scan_attachment_truncated(cdn, monkeypatch):
+    server, session = cdn
+    monkeypatch.setattr(TokenDetector, "MAX_ATTACHMENT_SIZE", 256 * 1024)
+    cache = ScanCache("rules")
+    attachment = SimpleNamespace(
+        url=str(server.make_url("/safe.txt")), size=1024, filename="safe.txt", content_type=None
+    )
+    result = await TokenDetector.scan_attachment(
+        attachment, True, True, session=session, cache=cache
+    )
+    # the end of the file was not scanned, it is neither clean nor remembered as clean
+    assert result is ScanResult.TRUNCATED
+    assert not result
+    assert await cache.get_url(attachment.url) is None
+    # a token before the cut is still detected
+    attachment.url = str(server.make_url("/danger.txt"))
+    assert await TokenDetector.scan_attachment(
+        attachment, True, True, session=session, cache=cache
+    )
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("tests/assets/plain/safe.txt", False),
+        ("tests/assets/plain/danger.txt", True),
+        ("tests/assets/zip/danger.zip", True),
+        ("tests/assets/gzip/danger.tar.gz", True),
+    ],
+)
+async def test_scan_attachment_read(path, expected):
+    buffer = open(path, "rb").read()
+
+    async def read():
+        return buffer
+
+    attachment = SimpleNamespace(
+        size=len(buffer), filename=os.path.basename(path), content_type=None, read=read
+    )
+    assert await TokenDetector.scan_attachment(attachment, True, True) == expected
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+async def test_scan_archive_executor(executor):
+    TokenDetector.configure(executor=executor, workers=1)
+    try:
+        for path, ft, expected in [
+            ("tests/assets/zip/danger.zip", "application/zip", True),
+            ("tests/assets/7zip/danger.7z", "application/x-7z-compressed", True),
+            ("tests/assets/bzip2/safe.tar.bz2", "application/x-bzip2", False),
+        ]:
+            assert await TokenDetector.scan_archive(ft, open(path, "rb").read()) == expected
+    finally:
+        TokenDetector.shutdown()
+
+
+async def test_scan_timeout(monkeypatch):
+    def slow(*args):
+        time.sleep(0.5)
+        return [TOKEN.decode()]
+
+    monkeypatch.setattr(TokenDetector, "scan_timeout", 0.05)
+    monkeypatch.setattr(TokenDetector, "collect_archive", slow)
+    assert await TokenDetector.scan_archive("application/zip", b"") is ScanResult.TIMED_OUT
+
+
+def test_find_tokens_until():
+    data = b"filler line\n" * 20000
+    # a token across a chunk boundary
+    position = TokenDetector.CHUNK_SIZE * 2 - 30
+    data = data[:position] + b" " + TOKEN + b" " + data[position:]
+    deadline = time.monotonic() + 60
+    assert TokenDetector.find_tokens_until(data, False, deadline) == [TOKEN.decode()]
+    assert TokenDetector.find_tokens_until(data, True, deadline) == [TOKEN.decode()]
+    assert TokenDetector.find_tokens_until(b"filler", False, deadline) == []
+    # the worker is released at the deadline instead of scanning the whole data
+    with pytest.raises(ScanTimedOut):
+        TokenDetector.find_tokens_until(data, False, time.monotonic() - 1)
+
+
+def test_collect_archive_stop_at_first():
+    data = open("tests/assets/tar/danger.tar", "rb").read()
+    assert TokenDetector.collect_archive("tar", data, stop_at_first=True) == (
+        [TOKEN.decode()],
+        ScanResult.CLEAN,
+    )
+    assert TokenDetector.collect_archive("zip", b"not a zip") == ([], ScanResult.CLEAN)
+
+
+def make_zip(members):
+    file_obj = io.BytesIO()
+    with zipfile.ZipFile(file_obj, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, content in members.items():
+            zf.writestr(name, content)
+    return file_obj.getvalue()
+
+
+def make_tar_gz(members):
+    file_obj = io.BytesIO()
+    with tarfile.open(fileobj=file_obj, mode="w:gz") as tf:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tf.addfile(info, io.BytesIO(content))
+    return file_obj.getvalue()
+
+
+@pytest.mark.parametrize("make, ft", [(make_zip, "zip"), (make_tar_gz, "gzip")])
+@pytest.mark.parametrize(
+    "max_bytes, max_ratio, expected",
+    [
+        (100 * 1024 * 1024, 100, ScanResult.BUDGET_EXCEEDED),
+        (1024 * 1024, 10000, ScanResult.BUDGET_EXCEEDED),
+        (100 * 1024 * 1024, 10000, ScanResult.DETECTED),
+    ],
+)
+async def test_scan_archive_budget(monkeypatch, make, ft, max_bytes, max_ratio, expected):
+    monkeypatch.setattr(TokenDetector, "archive_max_bytes", max_bytes)
+    monkeypatch.setattr(TokenDetector, "archive_max_ratio", max_ratio)
+    data = make({"bomb.txt": b"\0" * 16 * 1024 * 1024, "token.txt": TOKEN})
+    assert await TokenDetector.scan_archive(f"application/{ft}", data) is expected
+
+
+@pytest.mark.parametrize("size", [TokenDetector.CHUNK_SIZE - 20, TokenDetector.CHUNK_SIZE * 3])
+def test_collect_archive_split_member(size):
+    content = b"x" * size + b" " + TOKEN + b" " + b"x" * size
+    tokens, result = TokenDetector.collect_archive("zip", make_zip({"log.txt": content}))
+    assert tokens == [TOKEN.decode()]
+    assert result is ScanResult.CLEAN
+
+
+@pytest.mark.parametrize(
+    "content, stage",
+    [
+        ("short message", "length"),
+        ("a long message without enough dots to ever hold a discord token in it.", "dots"),
+        ("a long message. with two dots. but no token shaped middle part in between", "middle"),
+        (b"a long message. with two dots. but no token shaped middle part in between", "middle"),
+        ("Text MTA3MjYyNTE0OTM3MjgxMzM1NA.ABCDEF.abcdefghijklmnopqrstuvwxyz123456", None),
+    ],
+)
+def test_prefilter(monkeypatch, content, stage):
+    rejections = {"length": 0, "dots": 0, "middle": 0}
+    monkeypatch.setattr(TokenDetector, "prefilter_rejections", rejections)
+    start = TokenDetector.prefilter(content)
+    if stage is None:
+        assert 0 <= start <= len("Text ")
+        assert not any(rejections.values())
+    else:
+        assert start == -1
+        assert rejections[stage] == 1
+
+
+class FakeClient:
+    def __init__(self, bots=(), error=None):
+        self.bots = set(bots)
+        self.error = error
+        self.calls = 0
+
+    def get_user(self, user_id):
+        return None
+
+    async def fetch_user(self, user_id):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        if self.error is not None:
+            raise self.error
+        return SimpleNamespace(id=user_id, bot=user_id in self.bots)
+
+
+@pytest.fixture
+def validation_cache(monkeypatch):
+    monkeypatch.setattr(TokenDetector, "validation_cache", TTLCache(100))
+    monkeypatch.setattr(TokenDetector, "_inflight", {})
+    return TokenDetector.validation_cache
+
+
+async def test_validate_single_flight(validation_cache):
+    client = FakeClient(bots=[1072625149372813354])
+    results = await asyncio.gather(
+        *(TokenDetector.validate(TOKEN.decode(), client) for _ in range(10))
+    )
+    assert all(results)
+    assert client.calls == 1
+    assert await TokenDetector.validate(TOKEN.decode(), client)
+    assert client.calls == 1
+    assert validation_cache.info()["hits"] == 1
+
+
+async def test_validate_cache_ttl(monkeypatch, validation_cache):
+    monkeypatch.setattr(TokenDetector, "negative_ttl", -1)
+    client = FakeClient()
+    assert not await TokenDetector.validate(TOKEN.decode(), client)
+    assert not await TokenDetector.validate(TOKEN.decode(), client)
+    assert client.calls == 2
+
+
+@pytest.mark.parametrize(
+    "error, cached",
+    [
+        (discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "unknown user"), True),
+        (discord.HTTPException(SimpleNamespace(status=503, reason="Unavailable"), "down"), False),
+        (aiohttp.ClientConnectionError(), False),
+    ],
+)
+async def test_validate_lookup_errors(validation_cache, error, cached):
+    client = FakeClient(error=error)
+    assert not await TokenDetector.validate(TOKEN.decode(), client)
+    assert not await TokenDetector.validate(TOKEN.decode(), client)
+    # only a user id that does not exist is remembered, a failed request is retried
+    assert client.calls == (1 if cached else 2)
+
+
+async def test_validate_cached_user(validation_cache):
+    client = FakeClient()
+    client.get_user = lambda user_id: SimpleNamespace(id=user_id, bot=True)
+    assert await TokenDetector.validate(TOKEN.decode(), client)
+    assert client.calls == 0
+
+
+async def test_validate_cancelled_caller(validation_cache):
+    client = FakeClient(bots=[1072625149372813354])
+    first = asyncio.ensure_future(TokenDetector.validate(TOKEN.decode(), client))
+    second = asyncio.ensure_future(TokenDetector.validate(TOKEN.decode(), client))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    assert await second
+    assert client.calls == 1
+
+
+def make_token(user_id):
+    return base64.b64encode(str(user_id).encode()).decode().rstrip("=") + ".ABCDEF." + "a" * 27
+
+
+async def test_validate_any_dedupes_and_batches(monkeypatch, validation_cache):
+    monkeypatch.setattr(TokenDetector, "validation_concurrency", 10)
+    client = FakeClient(bots=[1000000000000000049])
+    ids = [1000000000000000000 + i for i in range(50)]
+    content = " ".join(make_token(i) for i in ids * 2) + " badencoding.ABCDEF." + "a" * 27
+    start = time.perf_counter()
+    assert await TokenDetector.detect(content, client)
+    # 50 unique user ids in batches of 10 instead of 100 sequential lookups
+    assert time.perf_counter() - start < 0.5
+    assert client.calls <= 50
+
+
+async def test_validate_any_no_bot(validation_cache):
+    client = FakeClient()
+    tokens = [make_token(1000000000000000000 + i) for i in range(3)]
+    assert not await TokenDetector.validate_any(tokens * 2, client)
+    assert client.calls == 3
+
+
+def make_7z(members):
+    file_obj = io.BytesIO()
+    with py7zr.SevenZipFile(file_obj, "w") as zf:
+        for name, content in members.items():
+            zf.writestr(content, name)
+    return file_obj.getvalue()
+
+
+def test_collect_nested_archives():
+    inner = make_zip({"readme.txt": b"nothing here", "token.txt": TOKEN})
+    middle = make_tar_gz({"inner.zip": inner})
+    outer = make_7z({"notes.txt": b"hello", "middle.tar.gz": middle})
+    tokens, result = TokenDetector.collect_archive("7z", outer)
+    assert tokens == [TOKEN.decode()]
+    assert result is ScanResult.CLEAN
+    assert TokenDetector.collect_archive("gzip", gzip.compress(inner))[0] == [TOKEN.decode()]
+
+
+def test_collect_nested_depth_budget():
+    data = make_zip({"token.txt": TOKEN})
+    for i in range(3):
+        data = make_zip({f"level{i}.zip": data})
+    budget = TokenDetector.new_budget(len(data))
+    budget.max_depth = 2
+    assert TokenDetector.collect_archive("zip", data, budget=budget) == (
+        [],
+        ScanResult.BUDGET_EXCEEDED,
+    )
+    assert TokenDetector.collect_archive("zip", data)[0] == [TOKEN.decode()]
+
+
+def test_collect_nested_members_budget():
+    inner = make_zip({f"file{i}.txt": b"text" for i in range(20)})
+    data = make_zip({f"inner{i}.zip": inner for i in range(5)})
+    budget = TokenDetector.new_budget(len(data))
+    budget.max_members = 50
+    assert (
+        TokenDetector.collect_archive("zip", data, budget=budget)[1] is ScanResult.BUDGET_EXCEEDED
+    )
+    assert budget.members == 51
+
+
+def counting_attachment(buffer, url="https://cdn.example/attachments/1/2/file.zip?ex=1"):
+    attachment = SimpleNamespace(
+        size=len(buffer), url=url, filename="file.zip", content_type="application/zip", reads=0
+    )
+
+    async def read():
+        attachment.reads += 1
+        return buffer
+
+    attachment.read = read
+    return attachment
+
+
+async def test_scan_cache_skips_download():
+    cache = ScanCache("rules")
+    buffer = open("tests/assets/zip/danger.zip", "rb").read()
+    first = counting_attachment(buffer)
+    assert await TokenDetector.scan_attachment(first, True, True, cache=cache)
+    assert await TokenDetector.scan_attachment(first, True, True, cache=cache)
+    assert first.reads == 1
+    # a signed url of the same attachment hits too
+    again = counting_attachment(buffer, first.url.replace("ex=1", "ex=2"))
+    assert await TokenDetector.scan_attachment(again, True, True, cache=cache)
+    assert again.reads == 0
+
+
+async def test_scan_cache_skips_archive_scan(monkeypatch):
+    cache = ScanCache("rules")
+    buffer = open("tests/assets/zip/safe.zip", "rb").read()
+    assert await TokenDetector.scan_attachment(
+        counting_attachment(buffer), True, True, cache=cache
+    ) == (ScanResult.CLEAN)
+
+    async def fail(*args):
+        raise AssertionError("scanned again")
+
+    monkeypatch.setattr(TokenDetector, "scan_archive", fail)
+    repost = counting_attachment(buffer, "https://cdn.example/attachments/3/4/file.zip")
+    assert await TokenDetector.scan_attachment(repost, True, True, cache=cache) is ScanResult.CLEAN
+    assert repost.reads == 1
+
+
+async def test_scan_cache_ignores_incomplete_results():
+    cache = ScanCache("rules")
+    await cache.set("key", ScanResult.BUDGET_EXCEEDED, "https://cdn.example/file")
+    assert await cache.get("key") is None
+    assert await cache.get_url("https://cdn.example/file") is None
+
+
+async def test_scan_cache_persistent(tmp_path):
+    database = Database(str(tmp_path / "database.db"))
+    cache = ScanCache("rules", database=database)
+    await cache.set("key", ScanResult.DETECTED)
+    assert await ScanCache("rules", database=database).get("key") is ScanResult.DETECTED
+    # results of other rules are expired
+    assert await ScanCache("changed", database=database).get("key") is None
+    await database.close()
+
+
+def test_scan_cache_rules_version():
+    version = ScanCache.rules_version("pattern", {"check-archive": True})
+    assert version == ScanCache.rules_version("pattern", {"check-archive": True})
+    assert version != ScanCache.rules_version("pattern", {"check-archive": False})
+
+
+@pytest.mark.parametrize(
+    "filename, content_type, check_textfile, check_archive, expected",
+    [
+        ("image.png", "image/png", True, True, False),
+        ("clip.mp4", None, True, True, False),
+        ("notes.txt", "text/plain; charset=utf-8", True, True, True),
+        ("notes.txt", "text/plain; charset=utf-8", False, True, False),
+        ("file.zip", "application/zip", True, True, True),
+        ("file.zip", "application/zip", True, False, False),
+        ("file.7z", None, True, False, False),
+        ("token", None, True, False, True),
+    ],
+)
+def test_needs_download(filename, content_type, check_textfile, check_archive, expected):
+    attachment = SimpleNamespace(size=1024, filename=filename, content_type=content_type)
+    assert TokenDetector.needs_download(attachment, check_textfile, check_archive) is expected
+
+
+async def test_scan_attachment_skips_media():
+    attachment = counting_attachment(open("tests/assets/plain/danger.txt", "rb").read())
+    attachment.filename, attachment.content_type = "image.png", "image/png"
+    assert await TokenDetector.scan_attachment(attachment, True, True) is ScanResult.CLEAN
+    assert await TokenDetector.scan_attachment(attachment, True, True, cache=ScanCache("r")) is (
+        ScanResult.CLEAN
+    )
+    assert attachment.reads == 0
@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import logging
+import time
+
+import pytest
+
+from src.utils.metrics import LOOP_STALLS
+from src.utils.watchdog import LoopWatchdog
+
+
+def block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+async def test_stall_is_logged_and_counted(caplog):
+    watchdog = LoopWatchdog(interval=0.01, threshold=0.1)
+    stalls = LOOP_STALLS.get()
+    watchdog.start()
+    try:
+        await asyncio.sleep(0.05)
+        with caplog.at_level(logging.WARNING, logger="src.utils.watchdog"):
+            block_the_loop(0.3)
+            await asyncio.sleep(0.05)
+    finally:
+        await watchdog.stop()
+    assert watchdog.stalls == 1
+    assert 0.2 <= watchdog.longest <= watchdog.stalled
+    assert LOOP_STALLS.get() == stalls + 1
+    [record] = caplog.records
+    assert "block_the_loop" in record.getMessage()
+
+
+async def test_no_stall():
+    watchdog = LoopWatchdog(interval=0.01, threshold=0.2)
+    watchdog.start()
+    await asyncio.sleep(0.1)
+    await watchdog.stop()
+    assert not watchdog.running
+    assert watchdog.stalls == 0
+
+
+def test_threshold_must_exceed_interval():
+    with pytest.raises(ValueError):
+        LoopWatchdog(interval=1, threshold=0.5)